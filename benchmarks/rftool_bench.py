@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+rftool_bench.py
+    - Benchmarks of the transport and the command hot paths of rftoolclient
+
+By default the benchmarks run against a stateful emulator started in this
+process (emulator/rftool_emulator.py), so that the numbers of two releases
+of the client can be compared on the same machine.  The results are written
+as JSON, and --baseline compares them with those of an earlier run.
+
+python3 rftool_bench.py -o bench.json
+python3 rftool_bench.py -o new.json --baseline bench.json --threshold 0.2
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import numpy as np
+
+try:
+    import rftoolclient as rftc
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import rftoolclient as rftc
+import rftoolclient.awgsa as ag
+import rftoolclient.stimgen as sg
+from rftoolclient.awgsa.wavesamplegen import WaveObjToSampleConverter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "emulator"))
+from rftool_emulator import RftoolEmulator
+from netshaping import NetworkProfile
+
+# Version of the layout of the JSON output
+SCHEMA_VERSION = 1
+
+MiB = 1 << 20
+# DRAM area used by the DRAM transfer benchmarks
+DRAM_BENCH_OFFSET = 0
+
+# STG のサンプリングレート (sample/s)
+STG_SAMPLING_RATE = 614.4e6
+
+LOWER_IS_BETTER = "lower"
+HIGHER_IS_BETTER = "higher"
+
+
+class BenchResults(object):
+    """Metrics collected by the benchmarks"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add_times(self, name, times, *, params = None, work = None, work_unit = None):
+        """Record the times (s) of the repetitions of a benchmark.
+
+        If work is given, the metric is the throughput (work / median time)
+        in work_unit/s.  Otherwise the metric is the median time in s.
+        """
+        median = statistics.median(times)
+        stats = {
+            "min" : min(times),
+            "median" : median,
+            "mean" : statistics.fmean(times),
+            "max" : max(times),
+            "stdev" : statistics.stdev(times) if len(times) > 1 else 0.0,
+            "repeat" : len(times),
+        }
+        if work is None:
+            metric = {"value" : median, "unit" : "s", "better" : LOWER_IS_BETTER}
+        else:
+            metric = {
+                "value" : work / median if median > 0 else float("inf"),
+                "unit" : "{}/s".format(work_unit),
+                "better" : HIGHER_IS_BETTER,
+            }
+        metric["params"] = params or {}
+        metric["times"] = stats
+        self.metrics[name] = metric
+        return metric
+
+
+def measure(func, repeat, warmup = 1, setup = None):
+    """Return the times (s) func takes in 'repeat' calls after 'warmup' calls"""
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        func()
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+# ---------------------------------------------------------------------------
+# benchmarks
+# ---------------------------------------------------------------------------
+
+def bench_put_latency(client, results, args):
+    """Round trip of one control command"""
+    if_ctrl = client.if_ctrl
+    times = measure(lambda: if_ctrl.put("GetBitstream"), args.num_commands)
+    results.add_times("put.latency", times, params = {"command" : "GetBitstream"})
+
+
+def bench_put_mult(client, results, args):
+    """Throughput of a series of control commands, sent one by one and pipelined"""
+    if_ctrl = client.if_ctrl
+    commands = ["GetBitstream"] * args.num_commands
+    params = {"command" : "GetBitstream", "num_commands" : args.num_commands}
+
+    def sequential():
+        for command in commands:
+            if_ctrl.put(command)
+
+    results.add_times(
+        "put.sequential", measure(sequential, args.repeat),
+        params = params, work = len(commands), work_unit = "cmd")
+    results.add_times(
+        "put_mult", measure(lambda: if_ctrl.put_mult(commands), args.repeat),
+        params = params, work = len(commands), work_unit = "cmd")
+
+
+def dram_sizes(max_size):
+    size = MiB
+    while size <= max_size:
+        yield size
+        size *= 4
+
+
+def bench_dram(client, results, args):
+    """write_dram / read_dram throughput from 1 MiB up to --max-dram-size"""
+    sizes = list(dram_sizes(args.max_dram_size))
+    if not sizes:
+        return
+    buf = np.random.default_rng(0).integers(0, 256, sizes[-1], dtype = np.uint8)
+    out = np.empty(sizes[-1], dtype = np.uint8)
+    cmd = client.awg_sa_cmd
+    for size in sizes:
+        # 大きな転送は 1 回の時間が長く, ばらつきも小さいので繰り返しを減らす
+        repeat = max(1, min(args.repeat, (64 * MiB) // size))
+        params = {"size" : size}
+        data = buf[:size]
+        times = measure(lambda: cmd.write_dram(DRAM_BENCH_OFFSET, data), repeat)
+        results.add_times(
+            "write_dram.{}MiB".format(size // MiB), times,
+            params = params, work = size / MiB, work_unit = "MiB")
+
+        dst = out[:size]
+        times = measure(lambda: cmd.read_dram(DRAM_BENCH_OFFSET, size, out = dst), repeat)
+        results.add_times(
+            "read_dram.{}MiB".format(size // MiB), times,
+            params = params, work = size / MiB, work_unit = "MiB")
+        if not np.array_equal(dst, data):
+            raise RuntimeError("read_dram returned data different from that written ({} bytes)".format(size))
+
+
+def make_stimulus(num_chunks, chunk_samples, seed):
+    rng = np.random.default_rng(seed)
+    stimulus = sg.Stimulus(0, 1, enable_lib_log = False)
+    for _ in range(num_chunks):
+        samples = rng.integers(-32768, 32768, chunk_samples).tolist()
+        stimulus.add_chunk(samples, 0, 1)
+    return stimulus
+
+
+def bench_set_stimulus(client, results, args):
+    """set_stimulus of 16 chunks to each of the 8 STGs"""
+    client.command.ConfigFpga(rftc.FpgaDesign.STIM_GEN, 10)
+    stg_list = sg.STG.all()
+    client.stg_ctrl.initialize(*stg_list)
+    num_chunks = sg.Stimulus.MAX_CHUNKS
+    stg_to_stim = {
+        stg_id : make_stimulus(num_chunks, args.chunk_samples, int(stg_id))
+        for stg_id in stg_list}
+    times = measure(lambda: client.stg_ctrl.set_stimulus(stg_to_stim), args.repeat)
+    results.add_times(
+        "set_stimulus", times,
+        params = {
+            "num_stgs" : len(stg_list),
+            "num_chunks" : num_chunks,
+            "chunk_samples" : args.chunk_samples
+        })
+
+
+def bench_read_capture_data(client, results, args):
+    """read_capture_data of one capture step of each of the 8 AWGs"""
+    adc_freq = 3440.64
+    dac_freq = 6554.0
+    client.command.ConfigFpga(rftc.FpgaDesign.AWG_SA, 10)
+    cmd = client.awg_sa_cmd
+    cmd.initialize_awg_sa()
+
+    awg_list = list(ag.AwgId)
+    capture_config = ag.CaptureConfig()
+    for awg_id in awg_list:
+        wave = ag.AwgWave(
+            wave_type = ag.AwgWave.SINE, frequency = 10.0 * (int(awg_id) + 1),
+            amplitude = 30000, num_cycles = 1)
+        wave_sequence = ag.WaveSequence(dac_freq).add_step(step_id = 0, wave = wave, post_blank = 0)
+        cmd.set_wave_sequence(awg_id, wave_sequence, num_repeats = 1)
+        capture = ag.AwgCapture(time = args.capture_time, delay = 0, do_accumulation = False)
+        capture_config.add_capture_sequence(
+            awg_id, ag.CaptureSequence(adc_freq).add_step(step_id = 0, capture = capture))
+    cmd.set_capture_config(capture_config)
+    cmd.enable_awg(*awg_list)
+    cmd.start_wave_sequence()
+    cmd.wait_for_sequences(60, *awg_list)
+
+    sizes = [cmd.get_capture_data_size(awg_id, 0) for awg_id in awg_list]
+    outs = [bytearray(size) for size in sizes]
+    def read_all():
+        for awg_id, out in zip(awg_list, outs):
+            cmd.read_capture_data(awg_id, 0, out = out)
+
+    times = measure(read_all, args.repeat)
+    results.add_times(
+        "read_capture_data.x8", times,
+        params = {"num_awgs" : len(awg_list), "bytes_per_awg" : sizes[0]},
+        work = sum(sizes) / MiB, work_unit = "MiB")
+
+
+def bench_sweep(client, results, args):
+    """AwgSweep of wave sequences repeated --sweep-repeats times on 2 AWGs"""
+    adc_freq = 3440.64
+    dac_freq = 6554.0
+    client.command.ConfigFpga(rftc.FpgaDesign.AWG_SA, 10)
+    cmd = client.awg_sa_cmd
+    cmd.initialize_awg_sa()
+
+    awg_list = [ag.AwgId.AWG_0, ag.AwgId.AWG_1]
+    capture_config = ag.CaptureConfig()
+    for awg_id in awg_list:
+        capture = ag.AwgCapture(time = args.capture_time, delay = 0, do_accumulation = False)
+        capture_config.add_capture_sequence(
+            awg_id, ag.CaptureSequence(adc_freq).add_step(step_id = 0, capture = capture))
+
+    def build(freq):
+        awg_to_seq = {}
+        for awg_id in awg_list:
+            wave = ag.AwgWave(
+                wave_type = ag.AwgWave.SINE, frequency = freq * (int(awg_id) + 1),
+                amplitude = 30000, num_cycles = 1)
+            awg_to_seq[awg_id] = \
+                ag.WaveSequence(dac_freq).add_step(step_id = 0, wave = wave, post_blank = 0)
+        return awg_to_seq
+
+    freqs = [10.0 * (i + 1) for i in range(args.sweep_points)]
+    sweep = rftc.AwgSweep(
+        cmd, {"freq" : freqs}, build, capture_config,
+        num_repeats = args.sweep_repeats, timeout = 60)
+    result = None
+    def run_sweep():
+        nonlocal result
+        result = sweep.run()
+
+    times = measure(run_sweep, args.repeat)
+    # The capture data of the last point is still in the DRAM of the board.
+    for awg_id in awg_list:
+        expected = cmd.read_capture_data(awg_id, 0)
+        if result.captures[(awg_id, 0)][-1].tobytes() != bytes(expected):
+            raise RuntimeError(
+                "AwgSweep captured data different from read_capture_data "
+                "(AWG {}, num_repeats {})".format(int(awg_id), args.sweep_repeats))
+    if not result.completed.all():
+        raise RuntimeError("AwgSweep did not run all the points")
+
+    # The wave sequences are sent from another thread while the capture data
+    # is received.  Each command must be credited with its own bytes.
+    client.enable_stats()
+    try:
+        client.reset_stats()
+        sweep.run()
+        stats = client.stats()
+    finally:
+        client.enable_stats(False)
+    capture_bytes = sum(array.nbytes for array in result.captures.values())
+    read_stat = stats["ReadCaptureData"]
+    upload_stat = stats["SetWaveSequence"]
+    if read_stat.bytes_received < capture_bytes or \
+       upload_stat.bytes_received > 64 * upload_stat.count:
+        raise RuntimeError(
+            "stats of the sweep credited the bytes to wrong commands "
+            "(ReadCaptureData received {} bytes of {}, SetWaveSequence received {} bytes)".format(
+                read_stat.bytes_received, capture_bytes, upload_stat.bytes_received))
+
+    size = sum(array[0].nbytes for array in result.captures.values())
+    results.add_times(
+        "sweep.x{}".format(len(awg_list)), times,
+        params = {
+            "num_awgs" : len(awg_list),
+            "num_points" : len(freqs),
+            "num_repeats" : args.sweep_repeats,
+            "bytes_per_point" : size
+        },
+        work = len(freqs), work_unit = "point")
+
+
+def bench_wave_samples(client, results, args):
+    """Sample generation of WaveObjToSampleConverter and common.wavesamplegen"""
+    dac_freq = 6554.0
+    num_cycles = args.wave_cycles
+    awg_waves = {
+        "sine" : ag.AwgWave(ag.AwgWave.SINE, 100.0, amplitude = 30000, num_cycles = num_cycles),
+        "square" : ag.AwgWave(ag.AwgWave.SQUARE, 100.0, amplitude = 30000, num_cycles = num_cycles),
+        "sawtooth" : ag.AwgWave(ag.AwgWave.SAWTOOTH, 100.0, amplitude = 30000, num_cycles = num_cycles),
+        "gaussian" : ag.AwgWave(ag.AwgWave.GAUSSIAN, 100.0, amplitude = 30000, num_cycles = num_cycles),
+    }
+    for name, wave in awg_waves.items():
+        num_samples = len(WaveObjToSampleConverter.gen_samples(wave, dac_freq))
+        times = measure(lambda: WaveObjToSampleConverter.gen_samples(wave, dac_freq), args.repeat)
+        results.add_times(
+            "WaveObjToSampleConverter.{}".format(name), times,
+            params = {"num_cycles" : num_cycles, "num_samples" : num_samples},
+            work = num_samples / 1e6, work_unit = "Msample")
+
+    stg_freq = STG_SAMPLING_RATE
+    params_waves = {
+        "sine" : rftc.SinWave(num_cycles, 1e6, 30000),
+        "square" : rftc.SquareWave(num_cycles, 1e6, 30000),
+        "sawtooth" : rftc.SawtoothWave(num_cycles, 1e6, 30000),
+        "gaussian" : rftc.GaussianPulse(num_cycles, 1e6, 30000),
+    }
+    for name, wave in params_waves.items():
+        num_samples = len(wave.gen_samples(stg_freq))
+        times = measure(lambda: wave.gen_samples(stg_freq), args.repeat)
+        results.add_times(
+            "wavesamplegen.{}".format(name), times,
+            params = {"num_samples" : num_samples},
+            work = num_samples / 1e6, work_unit = "Msample")
+
+
+BENCHMARKS = {
+    "put_latency" : bench_put_latency,
+    "put_mult" : bench_put_mult,
+    "dram" : bench_dram,
+    "set_stimulus" : bench_set_stimulus,
+    "read_capture_data" : bench_read_capture_data,
+    "sweep" : bench_sweep,
+    "wave_samples" : bench_wave_samples,
+}
+
+
+# ---------------------------------------------------------------------------
+# comparison with a baseline
+# ---------------------------------------------------------------------------
+
+def compare(results, baseline, threshold):
+    """Return the list of (name, baseline value, value, change) of the
+    metrics which got worse than the baseline by more than 'threshold'"""
+    regressions = []
+    for name, metric in results["metrics"].items():
+        base = baseline["metrics"].get(name)
+        if base is None or base["unit"] != metric["unit"] or base["value"] == 0:
+            continue
+        change = (metric["value"] - base["value"]) / base["value"]
+        worse = -change if metric["better"] == HIGHER_IS_BETTER else change
+        if worse > threshold:
+            regressions.append((name, base["value"], metric["value"], change))
+    return regressions
+
+
+# ---------------------------------------------------------------------------
+# main
+# ---------------------------------------------------------------------------
+
+def client_version():
+    try:
+        from importlib import metadata
+        return metadata.version("rftoolclient")
+    except Exception:
+        return None
+
+
+def run(args):
+    network = NetworkProfile.lab(args.seed) if args.lab_network else None
+    selected = args.benchmarks or list(BENCHMARKS)
+    results = BenchResults()
+    meta = {
+        "schema" : SCHEMA_VERSION,
+        "timestamp" : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "rftoolclient" : client_version(),
+        "python" : platform.python_version(),
+        "numpy" : np.__version__,
+        "platform" : platform.platform(),
+        "target" : args.address or "emulator",
+        "network" : repr(network) if network is not None else None,
+        "benchmarks" : selected,
+        "args" : {
+            "repeat" : args.repeat,
+            "num_commands" : args.num_commands,
+            "max_dram_size" : args.max_dram_size,
+            "chunk_samples" : args.chunk_samples,
+            "capture_time" : args.capture_time,
+            "wave_cycles" : args.wave_cycles,
+            "sweep_points" : args.sweep_points,
+            "sweep_repeats" : args.sweep_repeats,
+        },
+    }
+
+    emulator = None
+    if args.address is None:
+        emulator = RftoolEmulator("127.0.0.1", 0, 0, network = network).start()
+        address, ctrl_port, data_port = "127.0.0.1", emulator.ctrl_port, emulator.data_port
+    else:
+        address, ctrl_port, data_port = args.address, args.ctrl_port, args.data_port
+
+    try:
+        with rftc.RftoolClient(timeout = 60) as client:
+            client.connect(address, ctrl_port, data_port)
+            for name in selected:
+                print("running {} ...".format(name), file = sys.stderr)
+                BENCHMARKS[name](client, results, args)
+    finally:
+        if emulator is not None:
+            emulator.stop()
+
+    return {"meta" : meta, "metrics" : results.metrics}
+
+
+def print_summary(output):
+    for name, metric in output["metrics"].items():
+        print("{:40s} {:>14.6g} {}".format(name, metric["value"], metric["unit"]), file = sys.stderr)
+
+
+def parse_size(text):
+    units = {"K" : 1 << 10, "M" : 1 << 20, "G" : 1 << 30}
+    text = text.strip().upper().rstrip("IB").rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[2].strip(" -"))
+    parser.add_argument("benchmarks", nargs = "*",
+                        help = "benchmarks to run (default: all)  {}".format(", ".join(BENCHMARKS)))
+    parser.add_argument("-o", "--output", help = "JSON file to write the results to (default: stdout)")
+    parser.add_argument("--address", help = "run against the board at this address instead of the emulator")
+    parser.add_argument("--ctrl-port", type = int, default = 8081)
+    parser.add_argument("--data-port", type = int, default = 8082)
+    parser.add_argument("--lab-network", action = "store_true",
+                        help = "shape the emulator's connections like the lab network")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--repeat", type = int, default = 5, help = "repetitions per benchmark")
+    parser.add_argument("--num-commands", type = int, default = 200,
+                        help = "number of commands of the put benchmarks")
+    parser.add_argument("--max-dram-size", type = parse_size, default = 1 << 30,
+                        help = "largest DRAM transfer (e.g. 64M, 1G)")
+    parser.add_argument("--chunk-samples", type = int, default = 1024 * 16,
+                        help = "samples per wave chunk of the set_stimulus benchmark")
+    parser.add_argument("--capture-time", type = float, default = 100000.0,
+                        help = "capture time (ns) of the read_capture_data benchmark")
+    parser.add_argument("--wave-cycles", type = int, default = 100,
+                        help = "cycles of the waves of the wave_samples benchmark")
+    parser.add_argument("--sweep-points", type = int, default = 8,
+                        help = "points of the sweep benchmark")
+    parser.add_argument("--sweep-repeats", type = int, default = 3,
+                        help = "num_repeats of the wave sequences of the sweep benchmark")
+    parser.add_argument("--baseline", help = "JSON file of an earlier run to compare with")
+    parser.add_argument("--threshold", type = float, default = 0.2,
+                        help = "relative change regarded as a regression (default 0.2)")
+    args = parser.parse_args()
+    if args.repeat < 1 or args.num_commands < 1 or args.sweep_points < 1 or args.sweep_repeats < 1:
+        parser.error("--repeat, --num-commands, --sweep-points and --sweep-repeats must be positive")
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {}".format(name))
+
+    output = run(args)
+    print_summary(output)
+    text = json.dumps(output, indent = 2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(output, baseline, args.threshold)
+        for name, base, value, change in regressions:
+            print("REGRESSION {}: {:.6g} -> {:.6g} ({:+.1%})".format(name, base, value, change),
+                  file = sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+netshaping.py
+    - Network shaping and fault injection for rftool_emulator.py
+
+NetworkProfile delays and paces the bytes of every connection of the
+emulator, so that the client sees the latency, bandwidth and stalls of a
+real network.  FaultInjector makes chosen commands fail in scripted ways.
+Both are deterministic for a given seed and script, so the retry and
+timeout behavior of a client can be measured repeatably.
+"""
+
+import json
+import random
+import threading
+import time
+
+
+def precise_sleep(seconds):
+    """Sleep with sub-millisecond accuracy (time.sleep alone overshoots short sleeps)"""
+    deadline = time.perf_counter() + seconds
+    sleep_until(deadline)
+
+
+def sleep_until(deadline):
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return
+        if remaining > 0.002:
+            time.sleep(remaining - 0.001)
+
+
+class NetworkProfile(object):
+    """Network conditions applied to each connection.
+
+    Parameters
+    ----------
+    latency : float
+        One-way delay (s).  A command sees a round-trip time of 2 * latency.
+    bandwidth : float or None
+        Bytes per second in each direction.  None for no limit.
+    jitter : float
+        Standard deviation (s) of a random delay added to every round trip.
+    stall_probability : float
+        Probability of a stall per command and per chunk of bulk data.
+    stall_time : float
+        Length (s) of a stall.
+    seed : int or None
+        Seed of the random numbers.  Connection n uses seed + n, so a run
+        that opens the connections in the same order sees the same delays.
+    """
+
+    # 帯域制御を行う単位 (Bytes)
+    CHUNK_SIZE = 0x10000
+
+    def __init__(
+        self, latency = 0.0, bandwidth = None, jitter = 0.0,
+        stall_probability = 0.0, stall_time = 0.0, seed = None):
+        if latency < 0 or jitter < 0 or stall_time < 0:
+            raise ValueError("latency, jitter and stall_time must not be negative")
+        if bandwidth is not None and bandwidth <= 0:
+            raise ValueError("invalid bandwidth {}".format(bandwidth))
+        if not (0.0 <= stall_probability <= 1.0):
+            raise ValueError("invalid stall_probability {}".format(stall_probability))
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self.stall_probability = stall_probability
+        self.stall_time = stall_time
+        self.seed = seed
+        self.__num_conns = 0
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def lab(cls, seed = 0):
+        """1 Gbps, 0.3 ms RTT with a little jitter and rare 20 ms stalls"""
+        return cls(
+            latency = 150e-6, bandwidth = 125e6, jitter = 20e-6,
+            stall_probability = 1e-3, stall_time = 20e-3, seed = seed)
+
+    def __repr__(self):
+        return ("NetworkProfile(latency={}, bandwidth={}, jitter={}, "
+                "stall_probability={}, stall_time={}, seed={})").format(
+                    self.latency, self.bandwidth, self.jitter,
+                    self.stall_probability, self.stall_time, self.seed)
+
+    def new_shaper(self):
+        with self.__lock:
+            conn_no = self.__num_conns
+            self.__num_conns += 1
+        seed = None if self.seed is None else self.seed + conn_no
+        return ConnectionShaper(self, random.Random(seed))
+
+
+class ConnectionShaper(object):
+    """Delays of one connection shaped by a NetworkProfile"""
+
+    def __init__(self, profile, rand):
+        self.__profile = profile
+        self.__rand = rand
+        self.__reply_not_before = 0.0
+        self.__arrival_time = 0.0
+        self.__tx_free_time = 0.0
+        self.__rx_free_time = 0.0
+
+    def on_request(self, pipelined):
+        """Called when a command line has been received.
+
+        The reply of the command may not leave before a round trip from
+        the time the command arrived.  A pipelined command (one received
+        before the reply of the previous command was sent) is taken to have
+        arrived with the previous one, so that pipelined commands overlap
+        their round trips as they do on a real network.
+        """
+        profile = self.__profile
+        if not pipelined:
+            self.__arrival_time = time.perf_counter()
+        delay = 2 * profile.latency
+        if profile.jitter:
+            delay += abs(self.__rand.gauss(0.0, profile.jitter))
+        delay += self.__stall()
+        self.__reply_not_before = max(
+            self.__reply_not_before, self.__arrival_time + delay)
+
+    def before_send(self, nbytes):
+        """Wait until nbytes may be sent to the client"""
+        sleep_until(self.__reply_not_before)
+        self.__tx_free_time = self.__pace(self.__tx_free_time, nbytes)
+        sleep_until(self.__tx_free_time)
+
+    def after_recv(self, nbytes):
+        """Wait for the time nbytes received from the client take on the wire"""
+        self.__rx_free_time = self.__pace(self.__rx_free_time, nbytes)
+        sleep_until(self.__rx_free_time)
+
+    def __pace(self, free_time, nbytes):
+        profile = self.__profile
+        now = time.perf_counter()
+        if profile.bandwidth is None:
+            return now + self.__stall()
+        # 少しの遅れは次のチャンクで取り戻せるようにして, 平均の帯域を保つ
+        burst = 4 * NetworkProfile.CHUNK_SIZE / profile.bandwidth
+        start = free_time if free_time >= now - burst else now
+        return start + nbytes / profile.bandwidth + self.__stall()
+
+    def __stall(self):
+        profile = self.__profile
+        if profile.stall_probability and self.__rand.random() < profile.stall_probability:
+            return profile.stall_time
+        return 0.0
+
+
+class Fault(object):
+    """A fault injected into a command.
+
+    Parameters
+    ----------
+    kind : str
+        DROP            -> Close the connection after 'after_bytes' bytes of
+                           the command have been transferred.
+        ERROR           -> Answer the command with an 'ERROR' response
+                           without executing it.
+        DELAY           -> Hold the command for 'seconds' before executing it.
+        SLOW_COMPLETION -> The AWGs started by the command (StartWaveSequence
+                           or ExternalTriggerOn) keep reporting
+                           'not complete' to IsWaveSequenceComplete for
+                           'seconds' after their sequences have finished.
+    command : str
+        Name of the command the fault applies to.
+    skip : int
+        Number of the matching commands to let through before the first fault.
+    count : int or None
+        Number of times the fault is injected.  None for every time.
+    """
+
+    DROP = "drop"
+    ERROR = "error"
+    DELAY = "delay"
+    SLOW_COMPLETION = "slow_completion"
+    __KINDS = (DROP, ERROR, DELAY, SLOW_COMPLETION)
+
+    def __init__(
+        self, kind, command, *, after_bytes = 0, seconds = 0.0,
+        skip = 0, count = 1, message = "injected fault"):
+        if kind not in self.__KINDS:
+            raise ValueError("invalid fault kind {}".format(kind))
+        if after_bytes < 0 or seconds < 0 or skip < 0:
+            raise ValueError("after_bytes, seconds and skip must not be negative")
+        if count is not None and count <= 0:
+            raise ValueError("invalid count {}".format(count))
+        self.kind = kind
+        self.command = command
+        self.after_bytes = after_bytes
+        self.seconds = seconds
+        self.skip = skip
+        self.count = count
+        self.message = message
+        self.num_fired = 0
+        self.__num_seen = 0
+
+    def __repr__(self):
+        return "<Fault {} {} fired={}>".format(self.kind, self.command, self.num_fired)
+
+    def _try_fire(self, command):
+        if command != self.command:
+            return False
+        self.__num_seen += 1
+        if self.__num_seen <= self.skip:
+            return False
+        if self.count is not None and self.num_fired >= self.count:
+            return False
+        self.num_fired += 1
+        return True
+
+
+class FaultInjector(object):
+    """Script of faults injected into the commands the emulator receives.
+
+    The faults are checked in the order they were added, and the first one
+    that fires applies to the command.
+
+    injector.add(Fault(Fault.DROP, "ReadDram", after_bytes = 1 << 20))
+    injector.add(Fault(Fault.ERROR, "IsWaveSequenceComplete", skip = 3))
+    """
+
+    def __init__(self):
+        self.__faults = []
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__faults)
+
+    @property
+    def faults(self):
+        return list(self.__faults)
+
+    def add(self, fault):
+        with self.__lock:
+            self.__faults.append(fault)
+        return fault
+
+    def clear(self):
+        with self.__lock:
+            self.__faults = []
+
+    def load(self, path):
+        """Add the faults listed in a JSON file.
+
+        [{"kind": "drop", "command": "ReadDram", "after_bytes": 1048576},
+         {"kind": "error", "command": "IsWaveSequenceComplete", "skip": 3, "count": 2}]
+        """
+        with open(path) as f:
+            entries = json.load(f)
+        for entry in entries:
+            entry = dict(entry)
+            self.add(Fault(entry.pop("kind"), entry.pop("command"), **entry))
+
+    def match(self, command):
+        """Return the fault to inject into the command, or None"""
+        if not self.__faults:
+            return None
+        with self.__lock:
+            for fault in self.__faults:
+                if fault._try_fire(command):
+                    return fault
+        return None
@@ -0,0 +1,1509 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+rftool_emulator.py
+    - A stateful emulator of rftool-mod (the server running on ZCU111)
+
+The emulator speaks the same command protocol as the board on the control
+port (8081) and the data port (8082), and keeps the state the commands act on.
+
+    - AWG wave sequences and capture configs.  Starting the wave sequences
+      synthesizes the capture data by looping the waveforms back into the
+      capture windows, and stores it in the emulated DRAM.
+    - The 4 GiB DRAM behind ReadDram / WriteDram.  Only the pages written
+      are allocated.
+    - The register file of the Stimulus Generators and the digital output
+      modules behind ReadStimRegs / WriteStimRegs / *StimRegBits.
+      STGs and digital output modules become busy for the time their
+      waveforms / output patterns take, and then report done.
+
+Any number of clients may connect at the same time.  They share one board.
+The connections can be shaped by a NetworkProfile, and a FaultInjector makes
+chosen commands fail (see netshaping.py).
+
+    python3 rftool_emulator.py [--ctrl-port 8081] [--data-port 8082]
+
+or from Python
+
+    with RftoolEmulator(ctrl_port = 0, data_port = 0) as emu:
+        client.connect("127.0.0.1", emu.ctrl_port, emu.data_port)
+"""
+
+import argparse
+import math
+import os
+import select
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import numpy as np
+
+try:
+    import rftoolclient as rftc
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import rftoolclient as rftc
+import rftoolclient.awgsa as ag
+from rftoolclient.awgsa.wavesamplegen import WaveObjToSampleConverter
+from rftoolclient.awgsa.hardwareinfo import (
+    WaveChunkParamsLayout, CAPTURE_WAVE_SAMPLE_SIZE, NUM_REAL_SAMPLES_IN_CAPTURE_WORD, NUM_IQ_SAMPLES_IN_CAPTURE_WORD)
+from rftoolclient.stimgen.memorymap import (
+    StgMasterCtrlRegs, StgCtrlRegs, WaveParamRegs,
+    DigitalOutMasterCtrlRegs, DigitalOutCtrlRegs, DigitalOutputDataListRegs)
+from rftoolclient.stimgen.stghwparam import NUM_SAMPLES_IN_STG_WORD
+from netshaping import NetworkProfile, Fault, FaultInjector
+
+
+NUM_AWGS = 8
+NUM_STGS = 8
+NUM_DOUTS = 34
+# ZCU111 内部で DRAM がマップされている物理アドレス
+DRAM_ADDR_OFFSET = 0x4_0000_0000
+# AWG ごとにキャプチャデータを格納する DRAM の領域のサイズ. 0xC000_0000 以降はキャプチャに使わない.
+CAPTURE_AREA_SIZE = 0x1800_0000
+# Stimulus Generator のサンプリングレート (Msps)
+STG_SAMPLING_RATE = 614.4
+# ディジタル出力モジュールの出力時間の単位 (ns)
+DOUT_TIME_UNIT = 10.0
+FFT_SIZE = 8192
+STG_VERSION = 0x4101_1010   # 'A':2001/01/01-0
+DOUT_VERSION = 0x4101_1010
+FPGA_DESIGN_VERSION = "0x41010101"
+
+
+class _CommandError(Exception):
+    """Error reported to the client as an 'ERROR' response"""
+    pass
+
+
+class SparseDram(object):
+    """DRAM of which only the pages written hold memory"""
+
+    PAGE_SIZE = 0x10_0000
+
+    def __init__(self, size = rftc.PL_DDR4_RAM_SIZE):
+        self.__size = size
+        self.__pages = {}
+        self.__zero_page = bytes(self.PAGE_SIZE)
+        self.__lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def num_pages_allocated(self):
+        return len(self.__pages)
+
+    def clear(self):
+        with self.__lock:
+            self.__pages.clear()
+
+    def check_range(self, offset, size):
+        if offset < 0 or size < 0 or self.__size < offset + size:
+            raise _CommandError(
+                "invalid DRAM range  ({} - {})".format(offset, offset + size - 1))
+
+    def write(self, offset, data):
+        data = memoryview(data).cast("B")
+        for view in self.writable_views(offset, len(data)):
+            view[:] = data[:len(view)]
+            data = data[len(view):]
+
+    def read(self, offset, size):
+        data = bytearray(size)
+        pos = 0
+        for view in self.readable_views(offset, size):
+            data[pos : pos + len(view)] = view
+            pos += len(view)
+        return data
+
+    def readable_views(self, offset, size):
+        """Yield memoryviews covering [offset, offset + size) in order.
+
+        Pages never written are read as zeros without being allocated.
+        """
+        self.check_range(offset, size)
+        for page_no, begin, end in self.__split(offset, size):
+            page = self.__pages.get(page_no)
+            if page is None:
+                page = self.__zero_page
+            yield memoryview(page)[begin:end]
+
+    def writable_views(self, offset, size):
+        """Yield writable memoryviews covering [offset, offset + size) in order."""
+        self.check_range(offset, size)
+        for page_no, begin, end in self.__split(offset, size):
+            yield memoryview(self.__page(page_no))[begin:end]
+
+    def __page(self, page_no):
+        page = self.__pages.get(page_no)
+        if page is None:
+            with self.__lock:
+                page = self.__pages.setdefault(page_no, bytearray(self.PAGE_SIZE))
+        return page
+
+    def __split(self, offset, size):
+        end = offset + size
+        while offset < end:
+            page_no, begin = divmod(offset, self.PAGE_SIZE)
+            length = min(self.PAGE_SIZE - begin, end - offset)
+            yield (page_no, begin, begin + length)
+            offset += length
+
+
+class _Clock(object):
+    """Converts hardware time into wall-clock time"""
+
+    def __init__(self, time_scale):
+        self.time_scale = time_scale
+
+    def now(self):
+        return time.monotonic()
+
+    def deadline(self, hw_seconds):
+        if hw_seconds == float('inf'):
+            return float('inf')
+        return self.now() + hw_seconds * self.time_scale
+
+
+class _Unit(object):
+    """Run state of a Stimulus Generator or a digital output module"""
+
+    def __init__(self, clock):
+        self.__clock = clock
+        self.reset()
+
+    def reset(self):
+        self.wakeup = True
+        self.ready = False
+        self.__busy = False
+        self.__done = False
+        self.paused = False
+        self.__end_time = 0.0
+        self.__remaining = 0.0
+
+    def prepare(self):
+        if not self.__busy:
+            self.ready = True
+
+    def start(self, hw_seconds):
+        self.ready = False
+        self.paused = False
+        self.__busy = True
+        self.__done = False
+        self.__end_time = self.__clock.deadline(hw_seconds)
+
+    def terminate(self):
+        if self.__busy:
+            self.__busy = False
+            self.__done = True
+        self.paused = False
+
+    def clear_done(self):
+        self.__update()
+        self.__done = False
+
+    def pause(self):
+        if self.busy and not self.paused:
+            self.paused = True
+            self.__remaining = self.__end_time - self.__clock.now()
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self.__end_time = self.__clock.now() + self.__remaining
+
+    @property
+    def busy(self):
+        self.__update()
+        return self.__busy
+
+    @property
+    def done(self):
+        self.__update()
+        return self.__done
+
+    def __update(self):
+        if self.__busy and not self.paused and self.__clock.now() >= self.__end_time:
+            self.__busy = False
+            self.__done = True
+
+
+class StimRegFile(object):
+    """Registers of the Stimulus Generators and the digital output modules.
+
+    Registers without side effects are kept in a sparse dict.
+    The status registers are computed from the run state of the units, and
+    rising edges written to the control registers drive the units.
+    """
+
+    __STG_CTRL_BITS = StgMasterCtrlRegs.Bit
+    __DOUT_CTRL_BITS = DigitalOutMasterCtrlRegs.Bit
+
+    def __init__(self, clock):
+        self.__clock = clock
+        self.__regs = {}
+        self.__stgs = [_Unit(clock) for _ in range(NUM_STGS)]
+        self.__douts = [_Unit(clock) for _ in range(NUM_DOUTS)]
+        self.__stg_ctrl_addrs = {
+            StgCtrlRegs.Addr.stg(i) : i for i in range(NUM_STGS)}
+        self.__dout_ctrl_addrs = {
+            DigitalOutCtrlRegs.Addr.dout(i) : i for i in range(NUM_DOUTS)}
+
+    def clear(self):
+        self.__regs.clear()
+        for unit in self.__stgs + self.__douts:
+            unit.reset()
+
+    def read(self, addr):
+        master = StgMasterCtrlRegs.ADDR
+        offs = StgMasterCtrlRegs.Offset
+        if addr == master + offs.VERSION:
+            return STG_VERSION
+        if addr == master + offs.WAKEUP_STATUS:
+            return self.__aggregate(self.__stgs, lambda unit: unit.wakeup)
+        if addr == master + offs.BUSY_STATUS:
+            return self.__aggregate(self.__stgs, lambda unit: unit.busy)
+        if addr == master + offs.READY_STATUS:
+            return self.__aggregate(self.__stgs, lambda unit: unit.ready)
+        if addr == master + offs.DONE_STATUS:
+            return self.__aggregate(self.__stgs, lambda unit: unit.done)
+        if addr == master + offs.PAUSED_STATUS:
+            return self.__aggregate(self.__stgs, lambda unit: unit.paused)
+        if addr in (master + offs.READ_ERR, master + offs.SAMPLE_SHORTAGE_ERR):
+            return 0
+        if addr == DigitalOutMasterCtrlRegs.ADDR + DigitalOutMasterCtrlRegs.Offset.VERSION:
+            return DOUT_VERSION
+
+        base = addr & ~0x7F
+        if base in self.__stg_ctrl_addrs:
+            unit = self.__stgs[self.__stg_ctrl_addrs[base]]
+            if addr - base == StgCtrlRegs.Offset.STATUS:
+                bits = StgCtrlRegs.Bit
+                return ((unit.wakeup << bits.STATUS_WAKEUP) |
+                        (unit.busy << bits.STATUS_BUSY) |
+                        (unit.ready << bits.STATUS_READY) |
+                        (unit.done << bits.STATUS_DONE) |
+                        (unit.paused << bits.STATUS_PAUSED))
+            if addr - base == StgCtrlRegs.Offset.ERR:
+                return 0
+        if base in self.__dout_ctrl_addrs:
+            unit = self.__douts[self.__dout_ctrl_addrs[base]]
+            if addr - base == DigitalOutCtrlRegs.Offset.STATUS:
+                bits = DigitalOutCtrlRegs.Bit
+                return ((unit.wakeup << bits.STATUS_WAKEUP) |
+                        (unit.busy << bits.STATUS_BUSY) |
+                        (unit.done << bits.STATUS_DONE) |
+                        (unit.paused << bits.STATUS_PAUSED))
+
+        return self.__regs.get(addr, 0)
+
+    def write(self, addr, val):
+        val &= 0xFFFFFFFF
+        old = self.__regs.get(addr, 0)
+        self.__regs[addr] = val
+        rising = val & ~old
+        if not rising:
+            return
+
+        if addr == StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.CTRL:
+            sel = self.__regs.get(
+                StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.CTRL_TARGET_SEL, 0)
+            stg_ids = [i for i in range(NUM_STGS) if sel & (1 << i)]
+            self.__drive_stgs(rising, stg_ids)
+            return
+        if addr in self.__stg_ctrl_addrs:
+            self.__drive_stgs(rising, [self.__stg_ctrl_addrs[addr]])
+            return
+        if addr == DigitalOutMasterCtrlRegs.ADDR + DigitalOutMasterCtrlRegs.Offset.CTRL:
+            self.__drive_douts(rising, self.__selected_douts(
+                DigitalOutMasterCtrlRegs.Offset.CTRL_TARGET_SEL_0))
+            return
+        if addr in self.__dout_ctrl_addrs:
+            self.__drive_douts(rising, [self.__dout_ctrl_addrs[addr]])
+
+    def __drive_stgs(self, rising, stg_ids):
+        bits = self.__STG_CTRL_BITS
+        units = [self.__stgs[i] for i in stg_ids]
+        if rising & (1 << bits.CTRL_RESET):
+            for unit in units:
+                unit.reset()
+        if rising & (1 << bits.CTRL_PREPARE):
+            for unit in units:
+                unit.prepare()
+        if rising & (1 << bits.CTRL_START):
+            for stg_id in stg_ids:
+                self.__stgs[stg_id].start(self.__stg_duration(stg_id))
+            self.__drive_douts(
+                1 << self.__DOUT_CTRL_BITS.CTRL_START,
+                self.__selected_douts(DigitalOutMasterCtrlRegs.Offset.START_TRIG_MASK_0))
+        if rising & (1 << bits.CTRL_TERMINATE):
+            for unit in units:
+                unit.terminate()
+        if rising & (1 << bits.CTRL_DONE_CLR):
+            for unit in units:
+                unit.clear_done()
+        if rising & (1 << bits.CTRL_PAUSE):
+            for unit in units:
+                unit.pause()
+            self.__drive_douts(
+                1 << self.__DOUT_CTRL_BITS.CTRL_PAUSE,
+                self.__selected_douts(DigitalOutMasterCtrlRegs.Offset.PAUSE_TRIG_MASK_0))
+        if rising & (1 << bits.CTRL_RESUME):
+            for unit in units:
+                unit.resume()
+            self.__drive_douts(
+                1 << self.__DOUT_CTRL_BITS.CTRL_RESUME,
+                self.__selected_douts(DigitalOutMasterCtrlRegs.Offset.RESUME_TRIG_MASK_0))
+
+    def __drive_douts(self, rising, dout_ids):
+        bits = self.__DOUT_CTRL_BITS
+        units = [self.__douts[i] for i in dout_ids]
+        if rising & (1 << bits.CTRL_RESET):
+            for unit in units:
+                unit.reset()
+        if rising & ((1 << bits.CTRL_START) | (1 << bits.CTRL_RESTART)):
+            for dout_id in dout_ids:
+                self.__douts[dout_id].start(self.__dout_duration(dout_id))
+        if rising & (1 << bits.CTRL_TERMINATE):
+            for unit in units:
+                unit.terminate()
+        if rising & (1 << bits.CTRL_DONE_CLR):
+            for unit in units:
+                unit.clear_done()
+        if rising & (1 << bits.CTRL_PAUSE):
+            for unit in units:
+                unit.pause()
+        if rising & (1 << bits.CTRL_RESUME):
+            for unit in units:
+                unit.resume()
+
+    def __selected_douts(self, sel_0_offset):
+        """IDs of the digital output modules selected by a pair of 32-bit mask registers"""
+        base = DigitalOutMasterCtrlRegs.ADDR
+        mask = (self.__regs.get(base + sel_0_offset, 0) |
+                self.__regs.get(base + sel_0_offset + 4, 0) << 32)
+        return [i for i in range(NUM_DOUTS) if mask & (1 << i)]
+
+    def __stg_duration(self, stg_id):
+        """Time (s) an STG takes to output its wave sequence"""
+        base = WaveParamRegs.Addr.stg(stg_id)
+        offs = WaveParamRegs.Offset
+        num_wait_words = self.__regs.get(base + offs.NUM_WAIT_WORDS, 0)
+        num_repeats = self.__regs.get(base + offs.NUM_REPEATS, 0)
+        num_chunks = min(self.__regs.get(base + offs.NUM_CHUNKS, 0), 16)
+        num_seq_words = 0
+        for i in range(num_chunks):
+            chunk = base + offs.chunk(i)
+            num_words = (self.__regs.get(chunk + offs.NUM_WAVE_PART_WORDS, 0) +
+                         self.__regs.get(chunk + offs.NUM_BLANK_WORDS, 0))
+            num_seq_words += num_words * self.__regs.get(chunk + offs.NUM_CHUNK_REPEATS, 0)
+        num_words = num_wait_words + num_seq_words * num_repeats
+        return num_words * NUM_SAMPLES_IN_STG_WORD / (STG_SAMPLING_RATE * 1e6)
+
+    def __dout_duration(self, dout_id):
+        """Time (s) a digital output module takes to output its patterns"""
+        num_patterns = self.__regs.get(
+            DigitalOutCtrlRegs.Addr.dout(dout_id) + DigitalOutCtrlRegs.Offset.NUM_PATTERNS, 0)
+        base = DigitalOutputDataListRegs.Addr.dout(dout_id)
+        num_units = 0
+        for i in range(num_patterns):
+            addr = (base + DigitalOutputDataListRegs.Offset.pattern(i) +
+                    DigitalOutputDataListRegs.Offset.OUTPUT_TIME)
+            num_units += self.__regs.get(addr, 0) + 1
+        return num_units * DOUT_TIME_UNIT * 1e-9
+
+    @staticmethod
+    def __aggregate(units, pred):
+        val = 0
+        for i, unit in enumerate(units):
+            if pred(unit):
+                val |= 1 << i
+        return val
+
+
+class _WaveStep(object):
+    """One step of a wave sequence set to an AWG"""
+
+    def __init__(self, step_id, post_blank, duration, num_cycles, infinite, i_samples, q_samples):
+        self.step_id = step_id
+        self.post_blank = post_blank  # ns
+        self.duration = duration      # ns.  inf for infinite cycles
+        self.num_cycles = num_cycles
+        self.infinite = infinite
+        self.i_samples = i_samples    # samples of one cycle
+        self.q_samples = q_samples
+        self.start = 0.0              # ns from the start of the sequence
+
+
+class WaveSequenceModel(object):
+    """Wave sequence rebuilt from the bytes sent by SetWaveSequence"""
+
+    __HEADER = struct.Struct("<4sdII")
+    __STEP = struct.Struct("<IId")
+    __WAVE = struct.Struct("<IddddIdddddiI")
+    __ANY_WAVE = 1000
+
+    def __init__(self, data):
+        magic, self.sampling_rate, is_iq, num_steps = self.__HEADER.unpack_from(data, 0)
+        if magic != b"WSEQ":
+            raise _CommandError("invalid wave sequence data")
+        self.is_iq = bool(is_iq)
+        pos = self.__HEADER.size
+        self.steps = []
+        for _ in range(num_steps):
+            step_id, _ref_step_id, post_blank = self.__STEP.unpack_from(data, pos)
+            pos += self.__STEP.size
+            i_wave, pos = self.__parse_wave(data, pos)
+            if self.is_iq:
+                q_wave, pos = self.__parse_wave(data, pos)
+                i_samples, q_samples = WaveObjToSampleConverter.gen_iq_samples(
+                    ag.AwgIQWave(i_wave[0], q_wave[0]), self.sampling_rate)
+            else:
+                i_samples = WaveObjToSampleConverter.gen_samples(i_wave[0], self.sampling_rate)
+                q_samples = np.zeros(len(i_samples))
+            _, duration, num_cycles, infinite = i_wave
+            self.steps.append(_WaveStep(
+                step_id, post_blank, duration, num_cycles, infinite,
+                np.asarray(i_samples, np.float64), np.asarray(q_samples, np.float64)))
+
+        start = 0.0
+        for step in self.steps:
+            step.start = start
+            start += step.duration + step.post_blank
+        self.duration = start
+        self.__starts = np.array([step.start for step in self.steps])
+        self.__step_ids = {step.step_id : step for step in self.steps}
+
+    def step(self, step_id):
+        return self.__step_ids.get(step_id)
+
+    def sample(self, t):
+        """Return the (I, Q) DAC values at the times t (ns from the start of the sequence)"""
+        i_vals = np.zeros(len(t))
+        q_vals = np.zeros(len(t))
+        if not self.steps:
+            return (i_vals, q_vals)
+        step_idx = np.searchsorted(self.__starts, t, side = "right") - 1
+        for idx, step in enumerate(self.steps):
+            mask = (step_idx == idx) & (t >= 0)
+            if not mask.any() or len(step.i_samples) == 0:
+                continue
+            local = t[mask] - step.start
+            in_wave = local < step.duration
+            pos = np.floor(local * self.sampling_rate / 1000.0).astype(np.int64) % len(step.i_samples)
+            i_vals[mask] = np.where(in_wave, step.i_samples[pos], 0.0)
+            q_vals[mask] = np.where(in_wave, step.q_samples[pos], 0.0)
+        return (i_vals, q_vals)
+
+    def params_bytes(self):
+        """Reply of GetWaveSequenceParams"""
+        data = bytearray(struct.pack("<IId", len(self.steps), int(self.is_iq), self.sampling_rate))
+        for step in self.steps:
+            num_samples = len(step.i_samples) * (1 if step.infinite else step.num_cycles)
+            num_post_blank_samples = int(round(step.post_blank * self.sampling_rate / 1000.0))
+            if self.is_iq:
+                num_samples *= 2
+            data += struct.pack(
+                "<IIQQ", step.step_id, int(step.infinite), num_samples, num_post_blank_samples)
+        return bytes(data)
+
+    def wave_ram_bytes(self):
+        """Reply of GetWaveRAM.  Each step is stored as a chunk of one cycle."""
+        layout = WaveChunkParamsLayout
+        params_end = (layout.WAVE_CHUNK_PARAMS_SEGMENT_OFFSET +
+                      len(self.steps) * layout.WAVE_CHUNK_PARAMS_WORD_SIZE)
+        sample_data = bytearray()
+        chunk_params = []
+        for step in self.steps:
+            if self.is_iq:
+                samples = np.empty(2 * len(step.i_samples), np.int16)
+                samples[0::2] = step.i_samples
+                samples[1::2] = step.q_samples
+            else:
+                samples = step.i_samples.astype(np.int16)
+            flags = (1 << layout.BIT_ENABLED) | (int(step.infinite) << layout.BIT_INFINITE_CYCLES)
+            chunk_params.append(struct.pack(
+                "<IIIB", params_end + len(sample_data), len(samples), max(step.num_cycles, 1), flags))
+            sample_data += samples.tobytes()
+            sample_data += bytes(-len(sample_data) % 64)
+
+        data = bytearray(params_end)
+        for step_idx, param in enumerate(chunk_params):
+            offset = layout.WAVE_CHUNK_PARAMS_SEGMENT_OFFSET + step_idx * layout.WAVE_CHUNK_PARAMS_WORD_SIZE
+            data[offset : offset + len(param)] = param
+        return bytes(data + sample_data)
+
+    def __parse_wave(self, data, pos):
+        (wave_type, frequency, phase, amplitude, offset, num_cycles,
+         duty_cycle, crest_pos, variance, domain_begin, domain_end,
+         is_infinite, num_any_wave_samples) = self.__WAVE.unpack_from(data, pos)
+        pos += self.__WAVE.size
+        infinite = bool(is_infinite)
+
+        # 1 サイクル分のサンプルを作るためにサイクル数を無限にした波形オブジェクトを作る
+        if wave_type == self.__ANY_WAVE:
+            samples = np.frombuffer(data, np.int16, num_any_wave_samples, pos).copy()
+            pos += 2 * num_any_wave_samples
+            wave = ag.AwgAnyWave(samples, -1)
+            wave._set_sampling_rate(self.sampling_rate)
+        else:
+            wave = ag.AwgWave(
+                wave_type, frequency, phase = phase, amplitude = amplitude, offset = offset,
+                num_cycles = -1, duty_cycle = duty_cycle, crest_pos = crest_pos,
+                variance = variance, domain_begin = domain_begin, domain_end = domain_end)
+        duration = float('inf') if infinite else 1000.0 * num_cycles / frequency
+        return ((wave, duration, num_cycles, infinite), pos)
+
+
+class _CaptureStep(object):
+
+    def __init__(self, step_id, time, delay, accumulate, num_windows, infinite_windows):
+        self.step_id = step_id
+        self.time = time    # ns
+        self.delay = delay  # ns
+        self.accumulate = accumulate
+        self.num_windows = max(num_windows, 1)
+        self.infinite_windows = infinite_windows
+
+
+class CaptureSequenceModel(object):
+    """Capture sequence rebuilt from the bytes sent by SetCaptureConfig"""
+
+    __HEADER = struct.Struct("<dII")
+    __STEP = struct.Struct("<Iddiii")
+
+    def __init__(self, data):
+        self.sampling_rate, is_iq, num_steps = self.__HEADER.unpack_from(data, 0)
+        self.is_iq = bool(is_iq)
+        pos = self.__HEADER.size
+        self.steps = []
+        for _ in range(num_steps):
+            (step_id, time_ns, delay, accumulate,
+             num_windows, infinite_windows) = self.__STEP.unpack_from(data, pos)
+            pos += self.__STEP.size
+            self.steps.append(_CaptureStep(
+                step_id, time_ns, delay, bool(accumulate), num_windows, bool(infinite_windows)))
+
+    def num_samples(self, step):
+        """Number of samples in a window, rounded up to a multiple of a capture word"""
+        word = NUM_IQ_SAMPLES_IN_CAPTURE_WORD if self.is_iq else NUM_REAL_SAMPLES_IN_CAPTURE_WORD
+        num_samples = int(math.ceil(step.time * self.sampling_rate / 1000.0 - 1e-9))
+        return -(-num_samples // word) * word
+
+    @classmethod
+    def parse_config(cls, data):
+        """Return {awg_id -> CaptureSequenceModel} from the bytes of a CaptureConfig"""
+        if data[0:4] != b"CPCF":
+            raise _CommandError("invalid capture config data")
+        num_seqs = struct.unpack_from("<I", data, 4)[0]
+        pos = 8
+        awg_to_seq = {}
+        for _ in range(num_seqs):
+            awg_id, length = struct.unpack_from("<II", data, pos)
+            pos += 8
+            awg_to_seq[awg_id] = CaptureSequenceModel(bytes(data[pos : pos + length]))
+            pos += length
+        return awg_to_seq
+
+
+class _Awg(object):
+    """State of an AWG and its capture module"""
+
+    def __init__(self, clock):
+        self.__clock = clock
+        self.enabled = False
+        self.trigger_mode = ag.TriggerMode.MANUAL
+        self.wave_seq = None
+        self.num_repeats = 1
+        self.infinite_repeat = False
+        self.capture_seq = None
+        self.sections = {}      # step_id -> (DRAM offset, size)
+        self.skipped = set()
+        self.overranged = set()
+        self.fifo_overflowed = False
+        self.__start_time = None
+        self.__end_time = None
+        self.__complete_time = None
+        self.__repeat_time = 0.0
+        self.__terminated = False
+
+    def start(self, completion_delay = 0.0):
+        duration = self.wave_seq.duration * 1e-9
+        self.__start_time = self.__clock.now()
+        self.__repeat_time = duration * self.__clock.time_scale
+        if self.infinite_repeat:
+            duration = float('inf')
+        else:
+            duration *= self.num_repeats
+        self.__end_time = self.__clock.deadline(duration)
+        self.__complete_time = self.__end_time + completion_delay
+        self.__terminated = False
+
+    def terminate(self):
+        if self.working:
+            self.__end_time = self.__clock.now()
+            self.__complete_time = self.__end_time
+            self.__terminated = True
+
+    @property
+    def working(self):
+        return self.__end_time is not None and self.__clock.now() < self.__end_time
+
+    @property
+    def complete(self):
+        """False until the sequence has finished and the completion has been reported"""
+        return self.__complete_time is None or self.__complete_time <= self.__clock.now()
+
+    def num_completed(self):
+        if self.__start_time is None:
+            return 0
+        if self.__repeat_time <= 0:
+            return 0 if self.__terminated else self.num_repeats
+        num_completed = int((min(self.__clock.now(), self.__end_time) - self.__start_time) // self.__repeat_time)
+        if not self.infinite_repeat:
+            num_completed = min(num_completed, self.num_repeats)
+        return num_completed
+
+
+class EmulatedBoard(object):
+    """State of the emulated ZCU111 shared by all the connections"""
+
+    def __init__(self, time_scale = 1.0, bitstream_load_time = 0.0):
+        self.lock = threading.RLock()
+        self.clock = _Clock(time_scale)
+        self.dram = SparseDram()
+        self.stim_regs = StimRegFile(self.clock)
+        self.bitstream = 0
+        self.bitstream_load_time = bitstream_load_time
+        self.__bitstream_ready_time = 0.0
+        self.last_error = ""
+        self.__completion_delay = 0.0
+        self.__reset_awg_sa()
+
+    def __reset_awg_sa(self):
+        self.awgs = [_Awg(self.clock) for _ in range(NUM_AWGS)]
+        self.ext_trig_active = [False] * NUM_AWGS
+        self.ext_trig_sent = [False] * NUM_AWGS
+        self.ext_trig_params = {}
+        self.dsp_params = {}
+        self.src_clk = 0
+
+    def reset(self):
+        """Return the board to the state just after the FPGA is configured"""
+        with self.lock:
+            self.dram.clear()
+            self.stim_regs.clear()
+            self.__reset_awg_sa()
+
+    #### control port ####
+
+    def handle_ctrl(self, line, completion_delay = 0.0):
+        """Execute a command received on the control port and return the response line.
+
+        completion_delay delays the completion reported for the AWGs the command starts.
+        """
+        args = line.split()
+        if not args:
+            return ""
+        handler = getattr(self, "_ctrl_" + args[0], None)
+        try:
+            with self.lock:
+                if handler is None:
+                    return " ".join(args)  # 状態を持たないコマンドはそのまま返す
+                self.__completion_delay = completion_delay
+                return handler(args[1:])
+        except Exception as e:
+            return self.error_response(args[0], e)
+        finally:
+            self.__completion_delay = 0.0
+
+    def error_response(self, command, err):
+        self.last_error = "{}: {}".format(command, err)
+        return "ERROR: " + command
+
+    def _ctrl_GetLog(self, args):
+        log, self.last_error = self.last_error, ""
+        return "GetLog " + log
+
+    def _ctrl_Version(self, args):
+        return "Version 1.4"
+
+    def _ctrl_GetBitstream(self, args):
+        return "GetBitstream {}".format(self.bitstream)
+
+    def _ctrl_SetBitstream(self, args):
+        self.bitstream = int(args[0])
+        self.__bitstream_ready_time = self.clock.deadline(self.bitstream_load_time)
+        self.reset()
+        return "SetBitstream {}".format(self.bitstream)
+
+    def _ctrl_GetBitstreamStatus(self, args):
+        ready = 1 if self.clock.now() >= self.__bitstream_ready_time else 0
+        return "GetBitstreamStatus {}".format(ready)
+
+    def _ctrl_GetTriggerStatus(self, args):
+        return "GetTriggerStatus 0"
+
+    def _ctrl_GetIntrStatus(self, args):
+        return "GetIntrStatus {} {} {} 0".format(*args[0:3])
+
+    def _ctrl_InitializeAwgSa(self, args):
+        self.__reset_awg_sa()
+        return "AWG_SUCCESS"
+
+    def _ctrl_EnableAwg(self, args):
+        for awg, flag in zip(self.awgs, args):
+            if int(flag):
+                awg.enabled = True
+        return "AWG_SUCCESS"
+
+    def _ctrl_DisableAwg(self, args):
+        for awg, flag in zip(self.awgs, args):
+            if int(flag):
+                awg.enabled = False
+        return "AWG_SUCCESS"
+
+    def _ctrl_SetTriggerMode(self, args):
+        self.__awg(args[0]).trigger_mode = ag.TriggerMode.of(int(args[1]))
+        return "AWG_SUCCESS"
+
+    def _ctrl_GetTriggerMode(self, args):
+        return str(int(self.__awg(args[0]).trigger_mode))
+
+    def _ctrl_StartWaveSequence(self, args):
+        for awg_id, awg in enumerate(self.awgs):
+            if awg.enabled and awg.trigger_mode == ag.TriggerMode.MANUAL:
+                self.__start_awg(awg_id)
+        return "AWG_SUCCESS"
+
+    def _ctrl_ExternalTriggerOn(self, args):
+        oneshot = int(args[8]) if len(args) > 8 else 1
+        for trig_id, flag in enumerate(args[0:8]):
+            if not int(flag):
+                continue
+            # 外部トリガはすぐに条件を満たしたものとして, 対応する AWG を起動する
+            self.ext_trig_sent[trig_id] = True
+            self.ext_trig_active[trig_id] = not oneshot
+            for awg_id in range(trig_id, min(trig_id + 4, NUM_AWGS)):
+                awg = self.awgs[awg_id]
+                if awg.enabled and awg.trigger_mode == ag.TriggerMode.EXTERNAL:
+                    self.__start_awg(awg_id)
+        return "AWG_SUCCESS"
+
+    def _ctrl_ExternalTriggerOff(self, args):
+        for trig_id, flag in enumerate(args[0:8]):
+            if int(flag):
+                self.ext_trig_active[trig_id] = False
+        return "AWG_SUCCESS"
+
+    def _ctrl_SetExternalTriggerParam(self, args):
+        self.ext_trig_params[(int(args[0]), int(args[1]))] = int(args[2])
+        return "AWG_SUCCESS"
+
+    def _ctrl_GetExternalTriggerParam(self, args):
+        return str(self.ext_trig_params.get((int(args[0]), int(args[1])), 0))
+
+    def _ctrl_IsExternalTriggerActive(self, args):
+        return str(int(self.ext_trig_active[int(args[0])]))
+
+    def _ctrl_IsExternalTriggerSignalSent(self, args):
+        return str(int(self.ext_trig_sent[int(args[0])]))
+
+    def _ctrl_IsWaveSequenceComplete(self, args):
+        return "1" if self.__awg(args[0]).complete else "0"
+
+    def _ctrl_IsAwgWorking(self, args):
+        return "1" if self.__awg(args[0]).working else "0"
+
+    def _ctrl_GetNumWaveSequencesCompleted(self, args):
+        return str(self.__awg(args[0]).num_completed())
+
+    def _ctrl_TerminateAwgs(self, args):
+        for awg, flag in zip(self.awgs, args):
+            if int(flag):
+                awg.terminate()
+        return "AWG_SUCCESS"
+
+    def _ctrl_TerminateAllAwgs(self, args):
+        for awg in self.awgs:
+            awg.terminate()
+        return "AWG_SUCCESS"
+
+    def _ctrl_GetCaptureDataSize(self, args):
+        return str(self.__section(args[0], args[1])[1])
+
+    def _ctrl_GetCaptureSectionInfo(self, args):
+        offset, size = self.__section(args[0], args[1])
+        return "{},{}".format(DRAM_ADDR_OFFSET + offset, size)
+
+    def _ctrl_GetDramAddrOffset(self, args):
+        return str(DRAM_ADDR_OFFSET)
+
+    def _ctrl_IsCaptureStepSkipped(self, args):
+        return str(int(int(args[1]) in self.__awg(args[0]).skipped))
+
+    def _ctrl_IsAccumulatedValueOverranged(self, args):
+        return str(int(int(args[1]) in self.__awg(args[0]).overranged))
+
+    def _ctrl_IsCaptureDataFifoOverflowed(self, args):
+        return str(int(self.__awg(args[0]).fifo_overflowed))
+
+    def _ctrl_GetAccumulateOverrange(self, args):
+        return "GetAccumulateOverrange 0"
+
+    def _ctrl_IsAdcClockConvMissed(self, args):
+        return "0"
+
+    def _ctrl_IsDoutStepSkipped(self, args):
+        return "0"
+
+    def _ctrl_SelectSrcClk(self, args):
+        self.src_clk = int(args[0])
+        return "AWG_SUCCESS"
+
+    def _ctrl_GetSrcClk(self, args):
+        return str(self.src_clk)
+
+    def _ctrl_GetFpgaDesignVersion(self, args):
+        return FPGA_DESIGN_VERSION
+
+    def _ctrl_StartDsp(self, args):
+        return "AWG_SUCCESS"
+
+    def _ctrl_IsDspComplete(self, args):
+        return "1"
+
+    def _ctrl_IsDspReady(self, args):
+        return "1"
+
+    def _ctrl_SetGeneralDspParam(self, args):
+        self.dsp_params[int(args[0])] = int(args[1])
+        return "AWG_SUCCESS"
+
+    def _ctrl_GetGeneralDspParam(self, args):
+        return str(self.dsp_params.get(int(args[0]), 0))
+
+    def _ctrl_ReadStimRegBits(self, args):
+        addr, bit_offset, bit_len = (int(arg) for arg in args[0:3])
+        val = self.stim_regs.read(addr)
+        return str((val >> bit_offset) & ((1 << bit_len) - 1))
+
+    def _ctrl_WriteStimRegBits(self, args):
+        addr, bit_offset, bit_len, val = (int(arg) for arg in args[0:4])
+        mask = ((1 << bit_len) - 1) << bit_offset
+        reg = self.stim_regs.read(addr)
+        self.stim_regs.write(addr, (reg & ~mask) | ((val << bit_offset) & mask))
+        return "WriteStimRegBits"
+
+    #### data port ####
+
+    def handle_data(self, conn, line):
+        """Execute a command received on the data port"""
+        args = line.split()
+        if not args:
+            return
+        handler = getattr(self, "_data_" + args[0], None)
+        if handler is None:
+            conn.reply(*args)
+            return
+        handler(conn, args)
+
+    # データポートのコマンドが失敗したときのレスポンスの形式.
+    # (データの前のレスポンス, エラーの前に読み捨てるデータのサイズを持つ引数の位置)
+    __DATA_FAILURE_FORMATS = {
+        "ReadDram" : ("AWG_FAILURE", None),
+        "WriteDram" : ("AWG_FAILURE", None),
+        "ReadCaptureData" : ("AWG_FAILURE,0", None),
+        "GetWaveSequenceParams" : ("AWG_FAILURE,0", None),
+        "GetWaveRAM" : ("AWG_FAILURE,0", None),
+        "GetSpectrum" : ("SA_FAILURE,0", None),
+        "SetWaveSequence" : (None, 4),
+        "SetCaptureConfig" : (None, 1),
+        "SetDoutSequence" : (None, 2),
+        "WriteStimRegs" : (None, 2),
+        "WriteDataToMemory" : (None, 3),
+    }
+
+    def fail_data(self, conn, args, message):
+        """Answer a command received on the data port with an error without executing it"""
+        command = args[0]
+        header, size_arg = self.__DATA_FAILURE_FORMATS.get(command, (None, None))
+        if size_arg is not None:
+            conn.read(int(args[size_arg]))
+        if header is not None:
+            conn.reply(header)
+        if command == "ReadStimRegs":
+            # クライアントはレスポンスの前にレジスタ値を受け取る
+            conn.send(bytes(int(args[2])))
+        conn.reply(self.error_response(command, message))
+
+    def _data_ReadDram(self, conn, args):
+        offset, size = int(args[1]), int(args[2])
+        try:
+            self.dram.check_range(offset, size)
+        except _CommandError as e:
+            conn.reply("AWG_FAILURE")
+            conn.reply(self.error_response(args[0], e))
+            return
+        conn.reply("AWG_SUCCESS")
+        for view in self.dram.readable_views(offset, size):
+            conn.send(view)
+        conn.reply()
+        conn.reply(*args)
+
+    def _data_WriteDram(self, conn, args):
+        offset, size = int(args[1]), int(args[2])
+        try:
+            self.dram.check_range(offset, size)
+        except _CommandError as e:
+            conn.reply("AWG_FAILURE")
+            conn.reply(self.error_response(args[0], e))
+            return
+        conn.reply("AWG_SUCCESS")
+        for view in self.dram.writable_views(offset, size):
+            conn.readinto(view)
+        conn.reply(*args)
+
+    def _data_SetWaveSequence(self, conn, args):
+        awg_id, num_repeats, infinite_repeat, size = (int(arg) for arg in args[1:5])
+        data = conn.read(size)
+        try:
+            wave_seq = WaveSequenceModel(data)
+            with self.lock:
+                awg = self.__awg(awg_id)
+                awg.wave_seq = wave_seq
+                awg.num_repeats = max(num_repeats, 1)
+                awg.infinite_repeat = bool(infinite_repeat)
+        except (_CommandError, ValueError, IndexError, struct.error) as e:
+            conn.reply(self.error_response(args[0], e))
+            return
+        conn.reply(*args)
+
+    def _data_SetCaptureConfig(self, conn, args):
+        data = conn.read(int(args[1]))
+        try:
+            awg_to_seq = CaptureSequenceModel.parse_config(data)
+            with self.lock:
+                for awg_id, capture_seq in awg_to_seq.items():
+                    awg = self.__awg(awg_id)
+                    awg.capture_seq = capture_seq
+                    awg.sections = {}
+                    self.__layout_sections(awg_id)
+        except (_CommandError, ValueError, IndexError, struct.error) as e:
+            conn.reply(self.error_response(args[0], e))
+            return
+        conn.reply(*args)
+
+    def _data_SetDoutSequence(self, conn, args):
+        conn.read(int(args[2]))
+        conn.reply(*args)
+
+    def _data_ReadCaptureData(self, conn, args):
+        try:
+            with self.lock:
+                offset, size = self.__section(args[1], args[2])
+        except (_CommandError, ValueError) as e:
+            conn.reply("AWG_FAILURE,0")
+            conn.reply(self.error_response(args[0], e))
+            return
+        conn.reply("AWG_SUCCESS,{}".format(size))
+        for view in self.dram.readable_views(offset, size):
+            conn.send(view)
+        conn.reply(*args)
+        conn.reply(*args)
+
+    def _data_GetWaveSequenceParams(self, conn, args):
+        self.__send_wave_seq_data(conn, args, WaveSequenceModel.params_bytes)
+
+    def _data_GetWaveRAM(self, conn, args):
+        self.__send_wave_seq_data(conn, args, WaveSequenceModel.wave_ram_bytes)
+
+    def _data_GetSpectrum(self, conn, args):
+        try:
+            awg_id, step_id, start_sample_idx, num_frames, is_iq = (int(arg) for arg in args[1:6])
+            with self.lock:
+                offset, size = self.__section(awg_id, step_id)
+            samples = np.frombuffer(self.dram.read(offset, size), "<i4").astype(np.float64)
+            if is_iq:
+                samples = samples[0::2] + 1j * samples[1::2]
+            frames = np.zeros((num_frames, FFT_SIZE), samples.dtype)
+            for i in range(num_frames):
+                frame = samples[start_sample_idx + i * FFT_SIZE : start_sample_idx + (i + 1) * FFT_SIZE]
+                frames[i, :len(frame)] = frame
+            spectrum = np.fft.fft(frames, axis = 1)
+            data = np.empty((num_frames, FFT_SIZE, 2), "<i8")
+            data[:, :, 0] = np.round(spectrum.real)
+            data[:, :, 1] = np.round(spectrum.imag)
+            data = data.tobytes()
+        except (_CommandError, ValueError) as e:
+            conn.reply("SA_FAILURE,0")
+            conn.reply(self.error_response(args[0], e))
+            return
+        conn.reply("SA_SUCCESS,{}".format(len(data)))
+        conn.send(data)
+        conn.reply(*args)
+        conn.reply(*args)
+
+    def _data_ReadStimRegs(self, conn, args):
+        addr, size = int(args[1]), int(args[2])
+        with self.lock:
+            vals = [self.stim_regs.read(addr + i * 4) for i in range(size // 4)]
+        conn.send(struct.pack("<{}I".format(len(vals)), *vals))
+        conn.reply(*args)
+
+    def _data_WriteStimRegs(self, conn, args):
+        addr, size = int(args[1]), int(args[2])
+        data = conn.read(size)
+        vals = struct.unpack("<{}I".format(size // 4), data[0 : size - size % 4])
+        with self.lock:
+            for i, val in enumerate(vals):
+                self.stim_regs.write(addr + i * 4, val)
+        conn.reply(*args)
+
+    def _data_ReadDataFromMemory(self, conn, args):
+        conn.send(bytes(int(args[3])))
+        conn.reply()
+        conn.reply(*args)
+
+    def _data_WriteDataToMemory(self, conn, args):
+        conn.read(int(args[3]))
+        conn.reply(*args)
+        conn.reply()
+
+    #### AWG ####
+
+    def __awg(self, awg_id):
+        awg_id = int(awg_id)
+        if not (0 <= awg_id < NUM_AWGS):
+            raise _CommandError("invalid awg_id {}".format(awg_id))
+        return self.awgs[awg_id]
+
+    def __section(self, awg_id, step_id):
+        awg = self.__awg(awg_id)
+        step_id = int(step_id)
+        if step_id not in awg.sections:
+            raise _CommandError(
+                "capture step {} is not set to AWG {}".format(step_id, int(awg_id)))
+        return awg.sections[step_id]
+
+    def __send_wave_seq_data(self, conn, args, to_bytes):
+        try:
+            with self.lock:
+                wave_seq = self.__awg(args[1]).wave_seq
+            if wave_seq is None:
+                raise _CommandError("no wave sequence is set to AWG {}".format(args[1]))
+            data = to_bytes(wave_seq)
+        except (_CommandError, ValueError) as e:
+            conn.reply("AWG_FAILURE,0")
+            conn.reply(self.error_response(args[0], e))
+            return
+        conn.reply("AWG_SUCCESS,{}".format(len(data)))
+        conn.send(data)
+        conn.reply(*args)
+        conn.reply(*args)
+
+    def __layout_sections(self, awg_id):
+        """Assign DRAM sections to the capture steps of an AWG.  They are packed contiguously."""
+        awg = self.awgs[awg_id]
+        capture_seq = awg.capture_seq
+        num_repeats = 1 if awg.infinite_repeat else awg.num_repeats
+        sample_size = CAPTURE_WAVE_SAMPLE_SIZE
+        if capture_seq.is_iq:
+            sample_size *= 2
+        offset = awg_id * CAPTURE_AREA_SIZE
+        end = offset + CAPTURE_AREA_SIZE
+        awg.fifo_overflowed = False
+        for step in capture_seq.steps:
+            size = capture_seq.num_samples(step) * sample_size
+            if not step.accumulate:
+                size *= num_repeats
+            if end < offset + size:
+                size = max(end - offset, 0)
+                awg.fifo_overflowed = True
+            awg.sections[step.step_id] = (offset, size)
+            offset += size
+
+    def __start_awg(self, awg_id):
+        awg = self.awgs[awg_id]
+        if awg.wave_seq is None:
+            return
+        if awg.capture_seq is not None:
+            self.__layout_sections(awg_id)
+            self.__capture(awg_id)
+        awg.start(self.__completion_delay)
+
+    def __capture(self, awg_id):
+        """Synthesize the capture data by looping the wave sequence back into the capture windows"""
+        awg = self.awgs[awg_id]
+        wave_seq = awg.wave_seq
+        capture_seq = awg.capture_seq
+        num_repeats = 1 if awg.infinite_repeat else awg.num_repeats
+        awg.skipped = set()
+        awg.overranged = set()
+        for step in capture_seq.steps:
+            offset, size = awg.sections[step.step_id]
+            wave_step = wave_seq.step(step.step_id)
+            if wave_step is None:
+                awg.skipped.add(step.step_id)
+                continue
+
+            num_samples = capture_seq.num_samples(step)
+            t = wave_step.start + step.delay + np.arange(num_samples) * (1000.0 / capture_seq.sampling_rate)
+            i_vals = np.zeros(num_samples)
+            q_vals = np.zeros(num_samples)
+            for window in range(step.num_windows):
+                (i_win, q_win) = wave_seq.sample(t + window * step.time)
+                i_vals += i_win
+                q_vals += q_win
+
+            if capture_seq.is_iq:
+                samples = np.empty(2 * num_samples)
+                samples[0::2] = i_vals
+                samples[1::2] = q_vals
+            else:
+                samples = i_vals
+            if step.accumulate:
+                samples = samples * num_repeats
+            else:
+                samples = np.tile(samples, num_repeats)
+
+            info = np.iinfo(np.int32)
+            if samples.size and (samples.max() > info.max or samples.min() < info.min):
+                awg.overranged.add(step.step_id)
+            samples = np.clip(np.round(samples), info.min, info.max).astype("<i4")
+            self.dram.write(offset, memoryview(samples.tobytes())[:size])
+
+
+class _ConnectionDropped(ConnectionError):
+    pass
+
+
+class _Connection(object):
+    """Socket of a client with a buffered reader.
+
+    All the bytes of a connection go through this class, so that the network
+    shaping and the dropped connections apply to every command.
+    """
+
+    __RECV_SIZE = 0x10000
+
+    def __init__(self, sock, shaper = None):
+        self.sock = sock
+        self.__buf = bytearray()
+        self.__pos = 0
+        self.__shaper = shaper
+        self.__chunk_size = NetworkProfile.CHUNK_SIZE
+        self.__drop_after = None
+        self.__pipelined = False
+        self.__replying = False
+
+    def readline(self):
+        while True:
+            idx = self.__buf.find(b"\n", self.__pos)
+            if idx >= 0:
+                break
+            data = self.sock.recv(self.__RECV_SIZE)
+            if not data:
+                return b""
+            self.__buf += data
+
+        line = bytes(self.__buf[self.__pos : idx + 1])
+        self.__consume(len(line))
+        if self.__shaper is not None:
+            self.__shaper.on_request(self.__pipelined)
+            self.__pipelined = False
+            self.__replying = True
+        return line
+
+    def readinto(self, view):
+        """Fill the whole of a writable buffer"""
+        view = memoryview(view).cast("B")
+        while len(view):
+            size = self.__limit(len(view))
+            if self.__shaper is not None:
+                size = min(size, self.__chunk_size)
+            nbytes = min(size, len(self.__buf) - self.__pos)
+            if nbytes:
+                view[:nbytes] = self.__buf[self.__pos : self.__pos + nbytes]
+                self.__consume(nbytes)
+            else:
+                nbytes = self.sock.recv_into(view[:size])
+                if not nbytes:
+                    raise ConnectionError("connection closed by the client")
+            if self.__shaper is not None:
+                self.__shaper.after_recv(nbytes)
+            self.__count(nbytes)
+            view = view[nbytes:]
+
+    def read(self, size):
+        data = bytearray(size)
+        self.readinto(data)
+        return data
+
+    def send(self, data):
+        if self.__shaper is None and self.__drop_after is None:
+            self.sock.sendall(data)
+            return
+
+        if self.__replying:
+            # 応答を返す前に次のコマンドが届いていれば, パイプライン化されている
+            self.__replying = False
+            self.__pipelined = self.__has_pending_input()
+
+        view = memoryview(data).cast("B")
+        while len(view):
+            size = min(self.__limit(len(view)), self.__chunk_size)
+            if self.__shaper is not None:
+                self.__shaper.before_send(size)
+            self.sock.sendall(view[:size])
+            self.__count(size)
+            view = view[size:]
+
+    def __consume(self, nbytes):
+        self.__pos += nbytes
+        if self.__pos == len(self.__buf):
+            self.__buf = bytearray()
+            self.__pos = 0
+        elif self.__pos > self.__RECV_SIZE:
+            del self.__buf[:self.__pos]
+            self.__pos = 0
+
+    def __has_pending_input(self):
+        if self.__pos < len(self.__buf):
+            return True
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable)
+
+    def drop_after(self, nbytes):
+        """Drop the connection after nbytes more have been sent or received.  None to disarm."""
+        self.__drop_after = nbytes
+        if nbytes == 0:
+            self.__drop()
+
+    def __limit(self, size):
+        if self.__drop_after is None:
+            return size
+        return min(size, self.__drop_after)
+
+    def __count(self, nbytes):
+        if self.__drop_after is None:
+            return
+        self.__drop_after -= nbytes
+        if self.__drop_after <= 0:
+            self.__drop()
+
+    def __drop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        raise _ConnectionDropped("connection dropped by an injected fault")
+
+    def reply(self, *values):
+        self.send(" ".join(str(val) for val in values).encode("utf-8") + b"\r\n")
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        network = self.server.network
+        shaper = None if network is None else network.new_shaper()
+        conn = _Connection(self.request, shaper)
+        try:
+            self.server.serve(conn)
+        except (ConnectionError, OSError):
+            pass
+
+
+class _Server(socketserver.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, board, role, verbose, network, faults):
+        super().__init__(address, _RequestHandler)
+        self.board = board
+        self.role = role
+        self.verbose = verbose
+        self.network = network
+        self.faults = faults
+
+    def serve(self, conn):
+        while True:
+            line = conn.readline()
+            if not line:
+                return
+            line = line.decode("utf-8", "replace").strip()
+            if self.verbose:
+                print("[{}] {}".format(self.role, line))
+            args = line.split()
+            if not args:
+                continue
+            if self.role == "CTRL" and args[0] == "disconnect":
+                conn.reply("disconnect")
+                return
+
+            fault = self.faults.match(args[0])
+            if fault is not None and self.verbose:
+                print("[{}] inject {} into {}".format(self.role, fault.kind, args[0]))
+            self.__execute(conn, line, args, fault)
+
+    def __execute(self, conn, line, args, fault):
+        completion_delay = 0.0
+        if fault is not None:
+            if fault.kind == Fault.DELAY:
+                time.sleep(fault.seconds)
+            elif fault.kind == Fault.DROP:
+                conn.drop_after(fault.after_bytes)
+            elif fault.kind == Fault.SLOW_COMPLETION:
+                completion_delay = fault.seconds
+            elif fault.kind == Fault.ERROR:
+                if self.role == "CTRL":
+                    conn.reply(self.board.error_response(args[0], fault.message))
+                else:
+                    self.board.fail_data(conn, args, fault.message)
+                return
+
+        if self.role == "CTRL":
+            conn.reply(self.board.handle_ctrl(line, completion_delay))
+        else:
+            self.board.handle_data(conn, line)
+        conn.drop_after(None)
+
+
+class RftoolEmulator(object):
+    """Emulated ZCU111 listening on the control and data ports.
+
+    Parameters
+    ----------
+    address : str
+        Address to listen on.
+    ctrl_port, data_port : int
+        Ports to listen on.  0 picks free ports (see ctrl_port / data_port).
+    time_scale : float
+        Wall-clock seconds per hardware second of the modeled waveform outputs.
+    bitstream_load_time : float
+        Seconds GetBitstreamStatus reports 'not ready' after SetBitstream.
+    network : NetworkProfile or None
+        Network conditions applied to each connection.  None for no shaping.
+    faults : FaultInjector or None
+        Faults injected into the commands.  Faults can also be added later
+        through the faults property.
+    """
+
+    def __init__(
+        self, address = "0.0.0.0", ctrl_port = 8081, data_port = 8082, *,
+        time_scale = 1.0, bitstream_load_time = 0.0, network = None, faults = None,
+        verbose = False):
+        self.board = EmulatedBoard(time_scale, bitstream_load_time)
+        self.__faults = faults if faults is not None else FaultInjector()
+        self.__ctrl_server = _Server(
+            (address, ctrl_port), self.board, "CTRL", verbose, network, self.__faults)
+        self.__data_server = _Server(
+            (address, data_port), self.board, "DATA", verbose, network, self.__faults)
+        self.__threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, trace):
+        self.stop()
+
+    @property
+    def faults(self):
+        return self.__faults
+
+    @property
+    def ctrl_port(self):
+        return self.__ctrl_server.server_address[1]
+
+    @property
+    def data_port(self):
+        return self.__data_server.server_address[1]
+
+    def start(self):
+        for server in (self.__ctrl_server, self.__data_server):
+            thread = threading.Thread(
+                target = server.serve_forever, name = "RftoolEmulator-" + server.role, daemon = True)
+            thread.start()
+            self.__threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in (self.__ctrl_server, self.__data_server):
+            server.shutdown()
+            server.server_close()
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "rftool-mod emulator")
+    parser.add_argument("--address", default = "0.0.0.0")
+    parser.add_argument("--ctrl-port", type = int, default = 8081)
+    parser.add_argument("--data-port", type = int, default = 8082)
+    parser.add_argument("--time-scale", type = float, default = 1.0,
+                        help = "wall-clock seconds per hardware second")
+    parser.add_argument("--bitstream-load-time", type = float, default = 0.0)
+    parser.add_argument("--lab-network", action = "store_true",
+                        help = "1 Gbps, 0.3 ms RTT with jitter and rare stalls")
+    parser.add_argument("--latency-ms", type = float, default = 0.0, help = "one-way delay")
+    parser.add_argument("--bandwidth-mbps", type = float, default = None)
+    parser.add_argument("--jitter-ms", type = float, default = 0.0)
+    parser.add_argument("--stall-probability", type = float, default = 0.0)
+    parser.add_argument("--stall-ms", type = float, default = 0.0)
+    parser.add_argument("--seed", type = int, default = None)
+    parser.add_argument("--faults", default = None, help = "JSON file listing the faults to inject")
+    parser.add_argument("-v", "--verbose", action = "store_true")
+    args = parser.parse_args()
+
+    if args.lab_network:
+        network = NetworkProfile.lab(seed = args.seed or 0)
+    elif (args.latency_ms or args.bandwidth_mbps or args.jitter_ms or args.stall_probability):
+        network = NetworkProfile(
+            latency = args.latency_ms * 1e-3,
+            bandwidth = None if args.bandwidth_mbps is None else args.bandwidth_mbps * 1e6 / 8,
+            jitter = args.jitter_ms * 1e-3,
+            stall_probability = args.stall_probability,
+            stall_time = args.stall_ms * 1e-3,
+            seed = args.seed)
+    else:
+        network = None
+
+    faults = FaultInjector()
+    if args.faults is not None:
+        faults.load(args.faults)
+
+    emulator = RftoolEmulator(
+        args.address, args.ctrl_port, args.data_port,
+        time_scale = args.time_scale,
+        bitstream_load_time = args.bitstream_load_time,
+        network = network,
+        faults = faults,
+        verbose = args.verbose)
+    print("listening on ctrl={} data={}".format(emulator.ctrl_port, emulator.data_port))
+    emulator.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -19,9 +19,30 @@ from .common import (
 
 from .core import (
     RftoolClient,
+    AsyncRftoolClient,
+    RftoolClientPool,
+    PoolResult,
+    CommandBatch,
+    BatchedCall,
+    CommandStats,
+    CommandStat,
+    TrafficRecording,
+    WaitPolicy,
+    RunFuture,
+    SequenceResult,
+    StgRunResult,
+    CaptureHealth,
+    AwgSweep,
+    SweepResult,
+    UploadCacheInfo,
+    CaptureReadout,
+    CaptureReadPlan,
+    load_capture_file,
     RftoolClientError,
     RftoolExecuteCommandError,
-    RftoolInterfaceError)
+    RftoolInterfaceError,
+    RftoolReplayError,
+    RftoolPoolError)
 
 __all__ = [
     set(common.__all__) |
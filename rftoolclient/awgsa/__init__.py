@@ -17,6 +17,7 @@ __all__ = [
     'DspParamId',
     'InvalidOperationError',
     'DspTimeoutError',
+    'AwgTimeoutError',
     'FlattenedWaveformSequence',
     'FlattenedIQWaveformSequence',
     'AWG_WAVE_SAMPLE_SIZE'
@@ -34,6 +35,6 @@ from .externaltriggerid import ExternalTriggerId
 from .digitaloutputvector import DigitalOutputVector
 from .digitaloutputsequence import DigitalOutputSequence
 from .dspctrl import DspParamId
-from .awgsaerror import InvalidOperationError, DspTimeoutError
+from .awgsaerror import InvalidOperationError, DspTimeoutError, AwgTimeoutError
 from .flattenedwaveformsequence import FlattenedWaveformSequence, FlattenedIQWaveformSequence
 from .hardwareinfo import AWG_WAVE_SAMPLE_SIZE
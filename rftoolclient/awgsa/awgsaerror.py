@@ -7,3 +7,6 @@ class InvalidOperationError(Exception):
 
 class DspTimeoutError(Exception):
     pass
+
+class AwgTimeoutError(Exception):
+    pass
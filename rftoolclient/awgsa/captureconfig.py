@@ -57,6 +57,13 @@ class CaptureConfig(object):
         return len(self.__capture_sequence_list)
 
 
+    def get_awg_id_list(self):
+        """
+        キャプチャシーケンスをセットした AWG の ID を昇順に並べてリストにして返す.
+        """
+        return [ag.AwgId(awg_id) for awg_id in sorted(self.__capture_sequence_list.keys())]
+
+
     def get_capture_sequence(self, awg_id):
         """
         Parameters
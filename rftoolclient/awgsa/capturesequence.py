@@ -88,3 +88,39 @@ class CaptureSequence(object):
         このキャプチャシーケンスに登録されたステップの ID を出力順に並べてリストにして返す.
         """
         return sorted(self.__capture_list.keys())
+
+
+    def get_capture(self, step_id):
+        """
+        引数で指定したステップのキャプチャを返す.
+
+        Parameters
+        ----------
+        step_id : int
+            取得するキャプチャのステップ ID
+
+        Returns
+        ----------
+        capture : AwgCapture, AwgWindowedCapture
+            step_id のステップに登録されたキャプチャ
+        """
+        return self.__capture_list[step_id]
+
+
+    def is_iq_data(self):
+        """
+        I/Q データをキャプチャするシーケンスかどうかを返す.
+
+        Returns
+        ----------
+        is_iq_data : bool
+            True: I/Q データをキャプチャする, False: Real データをキャプチャする
+        """
+        return self.__is_iq_data == 1
+
+
+    def get_sampling_rate(self):
+        """
+        ADC サンプリングレート [Msps] を返す.
+        """
+        return self.__sampling_rate
@@ -1,10 +1,42 @@
 
 __all__ = [
     'RftoolClient',
+    'AsyncRftoolClient',
+    'RftoolClientPool',
+    'PoolResult',
+    'CommandBatch',
+    'BatchedCall',
+    'CommandStats',
+    'CommandStat',
+    'TrafficRecording',
+    'WaitPolicy',
+    'RunFuture',
+    'SequenceResult',
+    'StgRunResult',
+    'CaptureHealth',
+    'AwgSweep',
+    'SweepResult',
+    'UploadCacheInfo',
+    'CaptureReadout',
+    'CaptureReadPlan',
+    'load_capture_file',
     'RftoolClientError',
     'RftoolExecuteCommandError',
-    'RftoolInterfaceError'
+    'RftoolInterfaceError',
+    'RftoolReplayError',
+    'RftoolPoolError'
 ]
 
 from .client import RftoolClient
-from .rfterr import RftoolClientError, RftoolExecuteCommandError, RftoolInterfaceError
+from .asyncclient import AsyncRftoolClient
+from .clientpool import RftoolClientPool, PoolResult
+from .cmdbatch import CommandBatch, BatchedCall
+from .cmdstats import CommandStats, CommandStat
+from .trafficrec import TrafficRecording
+from .waitpolicy import WaitPolicy
+from .runfuture import RunFuture, SequenceResult, StgRunResult, CaptureHealth
+from .awgsweep import AwgSweep, SweepResult
+from .awgsacmd import UploadCacheInfo
+from .capturereadout import CaptureReadout, CaptureReadPlan
+from .capturefile import load_capture_file
+from .rfterr import RftoolClientError, RftoolExecuteCommandError, RftoolInterfaceError, RftoolReplayError, RftoolPoolError
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+asyncclient.py
+    - An asyncio client for command/data interface of RFTOOL
+"""
+
+import asyncio
+import functools
+import inspect
+import logging
+import socket
+import rftoolclient as rftc
+from .rftcmd import RftoolCommand
+from .awgsacmd import AwgSaCommand
+from .rftinterface import RftoolInterface
+from .commoncmd import CommonCommand
+from .stimgenctrl import StimGenCtrl
+from .digitaloutctrl import DigitalOutCtrl
+from . import waitpolicy
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
+
+
+if greenlet is not None:
+    class _CommandGreenlet(greenlet.greenlet):
+        """Greenlet which runs a method of a command class for AsyncRftoolClient"""
+
+
+def _check_greenlet():
+    if not isinstance(greenlet.getcurrent(), _CommandGreenlet):
+        raise rftc.RftoolInterfaceError(
+            "the interfaces of AsyncRftoolClient can only be used through its coroutine methods")
+
+
+def _await(awaitable):
+    """Wait for awaitable from a method run by _run_in_greenlet.
+
+    The greenlet switches to the coroutine driving it, which awaits
+    awaitable on the event loop and switches back with the result.
+    Call _check_greenlet before making awaitable.
+    """
+    return greenlet.getcurrent().parent.switch(awaitable)
+
+
+def _sleep(seconds):
+    _check_greenlet()
+    _await(asyncio.sleep(seconds))
+
+
+async def _run_in_greenlet(func, *args, **kwargs):
+    """Run a blocking function on the event loop thread.
+
+    func runs in a greenlet.  Whenever it waits for socket I/O (or sleeps),
+    this coroutine awaits the operation and resumes func with the result,
+    so that the event loop is never blocked.
+    """
+    def run():
+        waitpolicy._sleep.set(_sleep)
+        return func(*args, **kwargs)
+
+    glet = _CommandGreenlet(run)
+    value = glet.switch()
+    while not glet.dead:
+        try:
+            result = await value
+        except BaseException as e:
+            # also CancelledError, so that func unwinds before this task ends
+            value = glet.throw(e)
+        else:
+            value = glet.switch(result)
+    return value
+
+
+class AsyncRftoolInterface(RftoolInterface):
+    """RftoolInterface whose socket I/O is done by the event loop.
+
+    The socket is non-blocking and is read and written with loop.sock_*.
+    The command classes call this interface from a greenlet run by
+    AsyncRftoolClient, and are suspended while the event loop moves their
+    bytes.  Received data is written directly into the caller's buffer.
+    """
+
+    def __init__(self, logger=None, executor=None):
+        super().__init__(logger)
+        self.__loop = None
+        self.__timeout = None
+        self.__executor = executor
+
+    async def open(self, address, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (address, port)), self.__timeout)
+        except BaseException:
+            sock.close()
+            raise
+        self.__loop = loop
+        self.attach_socket(sock)
+
+    def close(self):
+        if self.sock is None:
+            return
+        sock = self.sock
+        self.attach_socket(None)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def settimeout(self, timeout):
+        self.__timeout = timeout
+
+    def run_cpu_bound(self, func, *args):
+        _check_greenlet()
+        return _await(self.__loop.run_in_executor(
+            self.__executor, functools.partial(func, *args)))
+
+    def _sock_sendall(self, data):
+        sock = self.__connected_sock()
+        return self.__wait_io(self.__loop.sock_sendall(sock, data))
+
+    def _sock_recv(self, bufsize):
+        sock = self.__connected_sock()
+        return self.__wait_io(self.__loop.sock_recv(sock, bufsize))
+
+    def _sock_recv_into(self, buf, nbytes):
+        sock = self.__connected_sock()
+        return self.__wait_io(self.__loop.sock_recv_into(sock, memoryview(buf)[:nbytes]))
+
+    def __connected_sock(self):
+        _check_greenlet()
+        if self.sock is None:
+            raise ConnectionError("socket is not connected")
+        return self.sock
+
+    def __wait_io(self, coro):
+        if self.__timeout is not None:
+            coro = asyncio.wait_for(coro, self.__timeout)
+        try:
+            return _await(coro)
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out")
+        except asyncio.CancelledError:
+            # the rest of the transfer is still in flight
+            self.err_connection = True
+            raise
+
+
+class _AsyncProxy(object):
+    """Expose the methods of a command object as coroutine functions run by AsyncRftoolClient"""
+
+    def __init__(self, client, target):
+        self._client = client
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            if kwargs.get("as_future"):
+                raise ValueError(
+                    "as_future is not supported by AsyncRftoolClient.  "
+                    "Run the wait method in an asyncio task instead.")
+            res = await self._client.run(attr, *args, **kwargs)
+            if inspect.isgenerator(res):
+                return _AsyncIterator(self._client, res)
+            return res
+        return method
+
+
+class _AsyncIterator(object):
+    """Async iterator which advances an iterator of a command method (e.g. iter_dram) on the client"""
+
+    __END = object()
+
+    def __init__(self, client, iterator):
+        self.__client = client
+        self.__iterator = iterator
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.__client.run(next, self.__iterator, self.__END)
+        if item is self.__END:
+            raise StopAsyncIteration
+        return item
+
+
+class AsyncAwgSaCommand(_AsyncProxy):
+    """Coroutine version of AwgSaCommand"""
+
+    async def read_captures_and_set_wave_sequences(self, awg_step_to_out, awg_to_seq, *, num_repeats = 1):
+        """Read the capture data and then set the next wave sequences.
+
+        AwgSaCommand.read_captures_and_set_wave_sequences sends the wave
+        sequences from a second thread.  This client has no thread to send
+        them from, so the two run one after the other.
+        See AwgSaCommand.read_captures_and_set_wave_sequences.
+        """
+        def read_and_set():
+            for (awg_id, step_id), out in awg_step_to_out.items():
+                self._target.read_capture_data(awg_id, step_id, out = out)
+            self._target.set_wave_sequences(awg_to_seq, num_repeats = num_repeats)
+        await self._client.run(read_and_set)
+
+
+class AsyncRftoolClient(object):
+    """asyncio version of RftoolClient.
+
+    command, awg_sa_cmd, stg_ctrl and digital_out_ctrl have the same methods
+    as those of RftoolClient, but every method is a coroutine function.
+    The methods run on the event loop thread in a greenlet, which is
+    suspended while the event loop moves its bytes with loop.sock_* and
+    while it sleeps in the wait methods, so that one event loop can drive
+    many boards at once.  Only CPU-heavy work, such as serializing wave
+    sequences, is passed to executor.  Calls on one client are serialized.
+    as_future = True is not supported; run the wait methods in asyncio tasks
+    instead.  iter_dram and iter_capture_data return async iterators.
+
+    AsyncRftoolClient requires the greenlet package.
+
+    async with AsyncRftoolClient() as client:
+        await client.connect("192.168.1.3")
+        await client.command.ConfigFpga(FpgaDesign.AWG_SA, 10)
+        await client.awg_sa_cmd.start_wave_sequence()
+        await client.awg_sa_cmd.wait_for_sequences(10, AwgId.AWG_0)
+    """
+
+    def __init__(self, logger=None, timeout=10.0, executor=None):
+        if greenlet is None:
+            raise ImportError(
+                "AsyncRftoolClient requires the greenlet package.  (pip install greenlet)")
+
+        self._logger = logging.getLogger(__name__)
+        self._logger.addHandler(logging.NullHandler())
+        self._logger = logger or self._logger
+
+        self.if_ctrl = AsyncRftoolInterface(self._logger, executor)
+        self.if_data = AsyncRftoolInterface(self._logger, executor)
+        command = RftoolCommand(self.if_ctrl, self._logger)
+        common_cmd = CommonCommand(self.if_ctrl, self.if_data, self._logger)
+        command.add_bitstream_listener(common_cmd.stim_reg_access.invalidate_shadow_regs)
+        common_cmd.set_data_reconnector(self.__reconnect_data_from_command)
+        awg_sa_cmd = AwgSaCommand(self.if_ctrl, self.if_data, common_cmd, self._logger)
+        command.add_bitstream_listener(awg_sa_cmd.invalidate_upload_cache)
+        self.command = _AsyncProxy(self, command)
+        self.__awg_sa_cmd = awg_sa_cmd
+        self.awg_sa_cmd = AsyncAwgSaCommand(self, awg_sa_cmd)
+        self.stg_ctrl = _AsyncProxy(
+            self, StimGenCtrl(common_cmd, command, self._logger))
+        self.digital_out_ctrl = _AsyncProxy(
+            self, DigitalOutCtrl(common_cmd, self._logger))
+
+        self.address = ""
+        self.port_ctrl = 0
+        self.port_data = 0
+        self.err_connection = False
+        self.__lock = None
+        self.settimeout(timeout)
+        self._logger.debug("AsyncRftoolClient __init__")
+
+    async def __aenter__(self):
+        self._logger.debug("AsyncRftoolClient __aenter__")
+        return self
+
+    async def __aexit__(self, excep_type, excep_val, trace):
+        await self.close()
+        self._logger.debug("AsyncRftoolClient __aexit__")
+
+    def settimeout(self, timeout):
+        self.if_ctrl.settimeout(timeout)
+        self.if_data.settimeout(timeout)
+
+    async def connect(self, address, port_ctrl=8081, port_data=8082):
+        self.address = address
+        self.port_data = port_data
+        self.port_ctrl = port_ctrl
+        self.__lock = asyncio.Lock()
+        self.__awg_sa_cmd.invalidate_upload_cache()
+
+        try:
+            await self.if_data.open(self.address, self.port_data)
+            await self.if_ctrl.open(self.address, self.port_ctrl)
+        except (ConnectionError, asyncio.TimeoutError):
+            self.err_connection = True
+            raise
+
+        self._logger.debug("AsyncRftoolClient connect")
+
+    async def reconnect_data(self):
+        """Replace the data socket with a new connection to the board.
+
+        See RftoolClient.reconnect_data.
+        """
+        self.if_data.close()
+        await self.if_data.open(self.address, self.port_data)
+        self.if_data.err_connection = False
+        self.__awg_sa_cmd.invalidate_upload_cache()
+        self._logger.debug("AsyncRftoolClient reconnect_data")
+
+    def __reconnect_data_from_command(self):
+        _check_greenlet()
+        _await(self.reconnect_data())
+
+    async def close(self):
+        err_c = self.err_connection | \
+            self.if_ctrl.err_connection | self.if_data.err_connection
+
+        try:
+            if err_c == False and self.__lock is not None:
+                await self.run(self.if_ctrl.put, "disconnect")
+        finally:
+            self.if_data.close()
+            self.if_ctrl.close()
+
+        self._logger.debug("AsyncRftoolClient close")
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking function which uses this client's interfaces.
+
+        The function runs on the event loop thread in a greenlet, which is
+        suspended while its socket I/O and sleeps are awaited.
+        Calls on the same client never overlap.
+        """
+        if self.__lock is None:
+            raise rftc.RftoolInterfaceError("AsyncRftoolClient is not connected")
+
+        async with self.__lock:
+            return await _run_in_greenlet(func, *args, **kwargs)
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-import logging, time
+import logging
+import hashlib
+import threading
+from collections import namedtuple
+import numpy as np
 import rftoolclient as rftc
 import rftoolclient.awgsa as ag
 import rftoolclient.awgsa.hardwareinfo as hwi
 import rftoolclient.awgsa.flattenedwaveformsequence as fws
-from .cmdutil import CmdUtil
+from .cmdutil import CmdUtil, pipelined
+from .waitpolicy import WaitPolicy, CompletionTimes
+from .runfuture import RunFuture, SequenceResult, CaptureHealth
+from .capturereadout import CaptureReadout, CaptureReadPlan
+
+UploadCacheInfo = namedtuple("UploadCacheInfo", ["hits", "misses", "entries"])
 
 class AwgSaCommand(object):
     """AWG SA 制御用のコマンドを定義するクラス"""
@@ -21,6 +30,20 @@ class AwgSaCommand(object):
         self.__common_cmd = common_cmd
         self.__joinargs = CmdUtil.joinargs
         self.__split_response = CmdUtil.split_response
+        self.__wait_policy = WaitPolicy()
+        self.__dsp_wait_policy = WaitPolicy(max_interval = 0.1)
+        # AWG の波形シーケンスの最短の完了時刻
+        self.__completion_times = CompletionTimes()
+        self.__enabled_awgs = set()
+        # start_wave_sequence を呼んだ回数.  キャプチャデータがどの実行のものかを区別する.
+        self.__run_id = 0
+        # 最後に送ったシーケンスのハッシュ値.  {('wave', AwgId) / ('capture',) / ('dout', AwgId) -> digest}
+        self.__upload_cache = {}
+        self.__upload_cache_enabled = False
+        self.__upload_cache_hits = 0
+        self.__upload_cache_misses = 0
+        # set_capture_config でセットしたキャプチャシーケンス.  キャプチャデータの形式を決めるのに使う.
+        self.__awg_to_capture_seq = {}
         self.__awg_to_adc_tile = {
             ag.AwgId.AWG_0 : 0,
             ag.AwgId.AWG_1 : 0,
@@ -42,6 +65,12 @@ class AwgSaCommand(object):
         return
 
 
+    def _put_command(self, command):
+        """@pipelined のメソッドが組み立てたコマンドを送り, 応答を返す"""
+        return self.__rft_ctrl_if.put(command)
+
+
+    @pipelined
     def get_fpga_design_version(self):
         """
         現在 FPGA にコンフィギュレーションされているデザインのバージョンを調べる
@@ -51,7 +80,8 @@ class AwgSaCommand(object):
         version : string
             バージョン情報を示す文字列.  ('デザイナID':作成年月日-'デザインID')
         """
-        return self.__rft_ctrl_if.put("GetFpgaDesignVersion")
+        res = yield "GetFpgaDesignVersion"
+        return res
 
 
     def set_wave_sequence(self, awg_id, wave_sequence, *, num_repeats = 1):
@@ -79,11 +109,84 @@ class AwgSaCommand(object):
            raise ValueError("invalid num_repeats  " + str(num_repeats))
 
         infinite_repeat = 1 if num_repeats < 0 else 0
-        data = wave_sequence.serialize()
+        data = self.__rft_data_if.run_cpu_bound(wave_sequence.serialize)
         command = self.__joinargs("SetWaveSequence", [int(awg_id), num_repeats, infinite_repeat, len(data)])
-        self.__rft_data_if.PutCmdWithData(command, data)
+        self.__put_with_data_cached(("wave", ag.AwgId(awg_id)), command, data)
+        duration = None if infinite_repeat else wave_sequence.get_whole_duration() * 1e-9 * num_repeats
+        self.__completion_times.set_duration(awg_id, duration)
+
+
+    def set_wave_sequences(self, awg_to_seq, *, num_repeats = 1):
+        """
+        複数の AWG に波形シーケンスをまとめてセットする.
+        各 AWG へのコマンドは応答を待たずに続けて送るので, set_wave_sequence を繰り返し呼ぶよりも速い.
+
+        Parameters
+        ----------
+        awg_to_seq : {AwgId -> WaveSequence}
+            AWG ID と, その AWG にセットする波形シーケンスの辞書
+        num_repeats : int
+            波形シーケンスを繰り返す回数
+            負の数を指定すると AWG を強制停止させるまでシーケンスを繰り返し続ける
+        """
+        self.__check_wave_sequences(awg_to_seq, num_repeats)
+        uploads = self.__send_wave_sequences(awg_to_seq, num_repeats)
+        self.__recv_upload_responses(uploads)
 
 
+    def __check_wave_sequences(self, awg_to_seq, num_repeats):
+        for awg_id, wave_sequence in awg_to_seq.items():
+            if (not isinstance(wave_sequence, ag.WaveSequence)):
+                raise ValueError("invalid wave_sequence " + str(wave_sequence))
+            if (not ag.AwgId.includes(awg_id)):
+               raise ValueError("invalid awg_id  " + str(awg_id))
+
+        if (not isinstance(num_repeats, int)) or\
+           (num_repeats == 0 or 0xFFFFFFFE < num_repeats):
+           raise ValueError("invalid num_repeats  " + str(num_repeats))
+
+
+    def __send_wave_sequences(self, awg_to_seq, num_repeats):
+        """
+        SetWaveSequence と波形データを応答を待たずに続けて送り, __recv_upload_responses に渡すリストを返す
+        """
+        infinite_repeat = 1 if num_repeats < 0 else 0
+        for awg_id, wave_sequence in awg_to_seq.items():
+            duration = None if infinite_repeat else wave_sequence.get_whole_duration() * 1e-9 * num_repeats
+            self.__completion_times.set_duration(awg_id, duration)
+
+        # シリアライズに失敗したときに一部のコマンドだけが送られないように, 全て準備してから送る
+        commands = []
+        for awg_id, wave_sequence in awg_to_seq.items():
+            data = self.__rft_data_if.run_cpu_bound(wave_sequence.serialize)
+            command = self.__joinargs("SetWaveSequence", [int(awg_id), num_repeats, infinite_repeat, len(data)])
+            commands.append((("wave", ag.AwgId(awg_id)), command, data))
+
+        uploads = []
+        for key, command, data in commands:
+            digest = self.__lookup_upload_cache(key, command, data)
+            if digest is None:
+                continue
+            uploads.append((key, digest))
+            self.__rft_data_if.send_command(command)
+            self.__rft_data_if.send_data(data)
+        return uploads
+
+
+    def __recv_upload_responses(self, uploads):
+        errors = []
+        for key, digest in uploads:
+            res = self.__rft_data_if.recv_response().replace("\r\n", "")
+            if res[:5] == "ERROR":
+                errors.append(res)
+                continue
+            self.__store_upload_cache(key, digest)
+
+        if errors:
+            raise rftc.RftoolExecuteCommandError(" ".join(errors))
+
+
+    @pipelined
     def enable_awg(self, *awg_id_list):
         """
         引数で指定した AWG を有効にする
@@ -100,9 +203,11 @@ class AwgSaCommand(object):
             enable_list[int(awg_id)] = 1
 
         command = self.__joinargs("EnableAwg", enable_list)
-        self.__rft_ctrl_if.put(command)
+        yield command
+        self.__enabled_awgs.update(awg_id_list)
 
 
+    @pipelined
     def disable_awg(self, *awg_id_list):
         """
         引数で指定した AWG を無効にする
@@ -119,17 +224,72 @@ class AwgSaCommand(object):
             disable_list[int(awg_id)] = 1
 
         command = self.__joinargs("DisableAwg", disable_list)
-        self.__rft_ctrl_if.put(command)
+        yield command
+        self.__enabled_awgs.difference_update(awg_id_list)
+        self.__completion_times.stopped(*awg_id_list)
 
 
-    def start_wave_sequence(self):
+    @pipelined
+    def start_wave_sequence(self, *, as_future = False):
         """
         波形出力およびキャプチャ処理を開始する
+
+        Parameters
+        ----------
+        as_future : bool
+            True の場合, enable_awg で有効にした全ての AWG の波形シーケンスが完了したときに
+            完了する RunFuture を返す.
+            RunFuture の結果は SequenceResult で, キャプチャデータなどは読み出したときに取得される.
+
+        Returns
+        -------
+        future : RunFuture or None
+            as_future が True の場合 RunFuture. False の場合 None.
         """
         command = "StartWaveSequence"
-        self.__rft_ctrl_if.put(command)
+        yield command
+        self.__run_id += 1
+        self.__completion_times.started(*self.__enabled_awgs)
+        if not as_future:
+            return None
+
+        run_id = self.__run_id
+        awg_id_list = sorted(self.__enabled_awgs)
+        awg_to_status = {}
+        def sequences_complete():
+            self.__poll_sequences(awg_to_status, awg_id_list)
+            return len(awg_to_status) == len(awg_id_list)
+
+        return RunFuture(
+            sequences_complete,
+            lambda _: SequenceResult(self, run_id, awg_to_status),
+            self._time_to_completion(*awg_id_list),
+            self.__wait_policy)
+
+
+    @property
+    def _run_id(self):
+        return self.__run_id
+
+
+    def __poll_sequences(self, awg_to_status, awg_id_list):
+        """
+        完了していない AWG の波形シーケンスの状態をまとめて調べ, 完了したものを awg_to_status に加える
+        """
+        awg_id_list = [awg_id for awg_id in awg_id_list if awg_id not in awg_to_status]
+        results = self.__rft_ctrl_if.put_mult([
+            self.__joinargs("IsWaveSequenceComplete", [int(awg_id)]) for awg_id in awg_id_list])
+        for awg_id, res in zip(awg_id_list, results):
+            res = int(res)
+            if res == 1:
+                awg_to_status[awg_id] = ag.AwgSaCmdResult.WAVE_SEQUENCE_COMPLETE
+            elif res == 2:
+                awg_to_status[awg_id] = ag.AwgSaCmdResult.WAVE_SEQUENCE_ERROR
+            elif res != 0:
+                raise ValueError('unknown command result  {}'.format(res))
 
 
+    @pipelined
     def is_wave_sequence_complete(self, awg_id):
         """
         波形シーケンスの出力が完了しているかどうかを取得する
@@ -149,7 +309,7 @@ class AwgSaCommand(object):
         if (not ag.AwgId.includes(awg_id)):
             raise ValueError("invalid awg_id  " + str(awg_id))
         command = self.__joinargs("IsWaveSequenceComplete", [int(awg_id)])
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         res = int(res)
         if res == 0:
             return ag.AwgSaCmdResult.WAVE_SEQUENCE_NOT_COMPLETE
@@ -161,6 +321,61 @@ class AwgSaCommand(object):
         raise ValueError('unknown command result  {}'.format(res))
 
 
+    def wait_for_sequences(self, timeout, *awg_id_list):
+        """
+        引数で指定した全ての AWG の波形シーケンスの出力が完了するのを待つ.
+        エラーが発生した場合も, このメソッドを抜ける.
+
+        Parameters
+        ----------
+        timeout : int or float
+            タイムアウト値 (単位: 秒). タイムアウトした場合, 例外を発生させる.
+        *awg_id_list : AwgId
+            波形シーケンスの出力完了を待つ AWG の ID
+
+        Returns
+        -------
+        awg_to_status : {AwgId -> int}
+            AWG ID と is_wave_sequence_complete の結果 (WAVE_SEQUENCE_COMPLETE or WAVE_SEQUENCE_ERROR) の辞書
+
+        Raises
+        ------
+        AwgTimeoutError
+            タイムアウトした場合
+        """
+        if (not isinstance(timeout, (int, float))) or (timeout < 0):
+            raise ValueError('Invalid timeout {}'.format(timeout))
+        for awg_id in awg_id_list:
+            if (not ag.AwgId.includes(awg_id)):
+                raise ValueError("invalid awg_id  " + str(awg_id))
+
+        awg_to_status = {}
+        def sequences_complete():
+            for awg_id in awg_id_list:
+                if awg_id in awg_to_status:
+                    continue
+                res = self.is_wave_sequence_complete(awg_id)
+                if res != ag.AwgSaCmdResult.WAVE_SEQUENCE_NOT_COMPLETE:
+                    awg_to_status[awg_id] = res
+            return len(awg_to_status) == len(set(awg_id_list))
+
+        # 波形シーケンスの長さから求めた完了時刻の直前まで待ってから, 間隔を広げながら完了を確認する
+        if not self.__wait_policy.wait(
+            sequences_complete, timeout, self._time_to_completion(*awg_id_list)):
+            msg = 'AWG wave sequence timeout'
+            raise ag.AwgTimeoutError(msg)
+        return awg_to_status
+
+
+    def _time_to_completion(self, *awg_id_list):
+        """
+        引数で指定した全ての AWG の波形シーケンスが完了し得る最短の時刻までの時間 (単位: 秒) を返す.
+        分からない場合は 0 を返す.
+        """
+        return self.__completion_times.time_to_completion(*awg_id_list)
+
+
+    @pipelined
     def is_awg_working(self, awg_id):
         """
         AWG が動作中かどうかを調べる
@@ -179,7 +394,7 @@ class AwgSaCommand(object):
         if (not ag.AwgId.includes(awg_id)):
             raise ValueError("invalid awg_id  " + str(awg_id))
         command = self.__joinargs("IsAwgWorking", [int(awg_id)])
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         res = int(res)
         if res == 0:
             return False
@@ -201,12 +416,14 @@ class AwgSaCommand(object):
         if (not isinstance(capture_config, ag.CaptureConfig)):
             raise ValueError("invalid capture_config " + str(capture_config))
         
-        data = capture_config.serialize()
+        data = self.__rft_data_if.run_cpu_bound(capture_config.serialize)
         command = self.__joinargs("SetCaptureConfig", [len(data)])
-        self.__rft_data_if.PutCmdWithData(command, data)
+        self.__put_with_data_cached(("capture",), command, data)
+        for awg_id in capture_config.get_awg_id_list():
+            self.__awg_to_capture_seq[awg_id] = capture_config.get_capture_sequence(awg_id)
         
 
-    def read_capture_data(self, awg_id, step_id):
+    def read_capture_data(self, awg_id, step_id, *, out = None):
         """
         キャプチャデータを読み取る
         
@@ -216,11 +433,51 @@ class AwgSaCommand(object):
             読み取るキャプチャステップを含むキャプチャシーケンスをセットしたキャプチャモジュールの ID
         step_id : int
             読み取るキャプチャステップのID
+        out : 書き込み可能な bytes-like object (bytearray, numpy.ndarray など)
+            指定した場合, キャプチャデータを中間バッファを介さずに out の先頭から直接格納する.
+            out のサイズはキャプチャデータのサイズ以上でなければならない.
+        
+        Returns
+        -------
+        data : bytes or int
+            キャプチャデータ.
+            out を指定した場合は, out に格納したバイト数.
+        """
+        if (not ag.AwgId.includes(awg_id)):
+            raise ValueError("invalid awg_id  " + str(awg_id))
         
+        if (not isinstance(step_id, int) or (step_id < 0 or 0x7FFFFFFF < step_id)):
+            raise ValueError("invalid step_id " + str(step_id))
+
+        if out is not None:
+            CmdUtil.check_recv_buffer(out)
+
+        return self.__read_capture_data(awg_id, step_id, lambda data_size: out)
+
+
+    def read_capture_data_array(self, awg_id, step_id, *, out = None):
+        """
+        キャプチャデータを読み取り, numpy.ndarray として返す.
+        データの形式は set_capture_config でセットしたキャプチャシーケンスから決める.
+        積算したキャプチャデータも 32-bit 符号付き整数である.
+
+        Parameters
+        ----------
+        awg_id : AwgId
+            読み取るキャプチャステップを含むキャプチャシーケンスをセットしたキャプチャモジュールの ID
+        step_id : int
+            読み取るキャプチャステップのID
+        out : numpy.ndarray
+            dtype が int32 で C 連続な書き込み可能な配列.
+            指定した場合, キャプチャデータを out の先頭から直接格納する. 形状は問わない.
+            ループの中で同じ配列を渡せば, 読み取りのたびにメモリを確保しなくて済む.
+
         Returns
         -------
-        data : bytes
-            キャプチャデータ
+        data : numpy.ndarray
+            Real データの場合, サンプル値を並べた 1 次元配列.
+            I/Q データの場合, 形状が (サンプル数, 2) の配列. [:, 0] が I データ, [:, 1] が Q データ.
+            out を指定した場合は out のビューを返す.
         """
         if (not ag.AwgId.includes(awg_id)):
             raise ValueError("invalid awg_id  " + str(awg_id))
@@ -228,12 +485,249 @@ class AwgSaCommand(object):
         if (not isinstance(step_id, int) or (step_id < 0 or 0x7FFFFFFF < step_id)):
             raise ValueError("invalid step_id " + str(step_id))
 
+        capture_sequence = self.__get_set_capture_sequence(awg_id)
+        if out is not None:
+            out = self.__flatten_int32_out(out)
+
+        buf = []
+        def alloc(data_size):
+            if out is None:
+                buf.append(np.empty(data_size // hwi.CAPTURE_WAVE_SAMPLE_SIZE, dtype = np.int32))
+            else:
+                buf.append(out)
+            return buf[0]
+
+        data_size = self.__read_capture_data(awg_id, step_id, alloc)
+        data = buf[0][: data_size // hwi.CAPTURE_WAVE_SAMPLE_SIZE]
+        if capture_sequence.is_iq_data():
+            data = data.reshape(-1, 2)
+        return data
+
+
+    def read_capture_range(self, awg_id, step_id, start_sample, num_samples, *, out = None):
+        """
+        キャプチャデータの一部を読み取り, numpy.ndarray として返す.
+        キャプチャデータの格納先 (get_capture_section_info) から, 指定した範囲のサンプルのみを read_dram で読み取る.
+        データの形式は set_capture_config でセットしたキャプチャシーケンスから決める.
+
+        Parameters
+        ----------
+        awg_id : AwgId
+            読み取るキャプチャステップを含むキャプチャシーケンスをセットしたキャプチャモジュールの ID
+        step_id : int
+            読み取るキャプチャステップのID
+        start_sample : int
+            読み取る最初のサンプルの番号.  I/Q データは I と Q をまとめて 1 サンプルと数える.
+        num_samples : int
+            読み取るサンプル数
+        out : numpy.ndarray
+            dtype が int32 で C 連続な書き込み可能な配列.
+            指定した場合, キャプチャデータを out の先頭から直接格納する. 形状は問わない.
+
+        Returns
+        -------
+        data : numpy.ndarray
+            read_capture_data_array と同じ形式のキャプチャデータ.
+            out を指定した場合は out のビューを返す.
+        """
+        if (not isinstance(num_samples, int) or num_samples <= 0):
+            raise ValueError("invalid num_samples " + str(num_samples))
+
+        if out is not None:
+            out = self.__flatten_int32_out(out)
+
+        offset, num_samples, capture_sequence = self.__locate_capture_samples(
+            awg_id, step_id, start_sample, num_samples)
+        is_iq_data = capture_sequence.is_iq_data()
+        size = num_samples * self.get_capture_sample_size(is_iq_data)
+        if out is None:
+            out = np.empty(size // hwi.CAPTURE_WAVE_SAMPLE_SIZE, dtype = np.int32)
+        else:
+            CmdUtil.check_recv_buffer(out, size)
+
+        self.__common_cmd.read_dram(offset, size, out = out)
+        data = out[: size // hwi.CAPTURE_WAVE_SAMPLE_SIZE]
+        if is_iq_data:
+            data = data.reshape(-1, 2)
+        return data
+
+
+    def iter_capture_data(self, awg_id, step_id, chunk_samples = 0x400000, *, start_sample = 0, num_samples = None):
+        """
+        キャプチャデータを chunk_samples サンプルずつ読み取るイテレータを作る.
+        読み取ったデータは 1 チャンクずつ read_capture_data_array と同じ形式の numpy.ndarray として返される.
+        データの読み取り方は iter_dram と同じで, 途中で読み取りをやめてもよい.
+        全てのチャンクは同じバッファに格納されるため, チャンクを残しておく場合はコピーすること.
+
+        Parameters
+        ----------
+        awg_id : AwgId
+            読み取るキャプチャステップを含むキャプチャシーケンスをセットしたキャプチャモジュールの ID
+        step_id : int
+            読み取るキャプチャステップのID
+        chunk_samples : int
+            1 チャンクのサンプル数.  最後のチャンクはこれより小さい場合がある.
+            I/Q データは I と Q をまとめて 1 サンプルと数える.
+        start_sample : int
+            読み取る最初のサンプルの番号
+        num_samples : int
+            読み取るサンプル数.  None の場合は start_sample からキャプチャデータの最後まで読み取る.
+
+        Returns
+        -------
+        chunks : iterator of numpy.ndarray
+            キャプチャデータを先頭から chunk_samples サンプルずつ返すイテレータ
+        """
+        if (not isinstance(chunk_samples, int) or chunk_samples <= 0):
+            raise ValueError("invalid chunk_samples " + str(chunk_samples))
+
+        offset, num_samples, capture_sequence = self.__locate_capture_samples(
+            awg_id, step_id, start_sample, num_samples)
+        is_iq_data = capture_sequence.is_iq_data()
+        sample_size = self.get_capture_sample_size(is_iq_data)
+        chunks = self.__common_cmd.iter_dram(
+            offset, num_samples * sample_size, chunk_samples * sample_size)
+        if is_iq_data:
+            return (chunk.view(np.int32).reshape(-1, 2) for chunk in chunks)
+        return (chunk.view(np.int32) for chunk in chunks)
+
+
+    def save_capture_data(
+        self, path, awg_id, step_id, *, start_sample = 0, num_samples = None, chunk_samples = 0x400000, max_retries = 0):
+        """
+        キャプチャデータを読み取り, .npy ファイルに直接書き込む.
+        データの書き込み方は save_dram と同じで, 空きメモリより大きなキャプチャデータも保存できる.
+        データの形式は read_capture_data_array と同じ.
+        AWG ID, ステップ ID, I/Q データかどうか, サンプリングレート, 最初のサンプルの番号がメタデータとして保存される.
+
+        Parameters
+        ----------
+        path : str or path-like
+            キャプチャデータを保存する .npy ファイルのパス
+        awg_id : AwgId
+            読み取るキャプチャステップを含むキャプチャシーケンスをセットしたキャプチャモジュールの ID
+        step_id : int
+            読み取るキャプチャステップのID
+        start_sample : int
+            保存する最初のサンプルの番号
+        num_samples : int
+            保存するサンプル数.  None の場合は start_sample からキャプチャデータの最後まで保存する.
+        chunk_samples : int
+            1 回の ReadDram で読み取るサンプル数
+        max_retries : int
+            通信エラーで読み取りに失敗したチャンクを読み取り直す回数の上限.  save_dram を参照.
+
+        Returns
+        -------
+        data : numpy.memmap
+            保存したキャプチャデータ
+        """
+        if (not isinstance(chunk_samples, int) or chunk_samples <= 0):
+            raise ValueError("invalid chunk_samples " + str(chunk_samples))
+
+        offset, num_samples, capture_sequence = self.__locate_capture_samples(
+            awg_id, step_id, start_sample, num_samples)
+        is_iq_data = capture_sequence.is_iq_data()
+        sample_size = self.get_capture_sample_size(is_iq_data)
+        metadata = {
+            "awg_id" : int(awg_id),
+            "step_id" : step_id,
+            "is_iq_data" : is_iq_data,
+            "sampling_rate" : capture_sequence.get_sampling_rate(),
+            "start_sample" : start_sample }
+        return self.__common_cmd.save_dram(
+            path, offset, num_samples * sample_size,
+            chunk_size = chunk_samples * sample_size,
+            dtype = np.int32,
+            shape = (num_samples, 2) if is_iq_data else (num_samples,),
+            metadata = metadata,
+            max_retries = max_retries)
+
+
+    def iter_dram(self, offset, size, chunk_size = 0x1000000):
+        return self.__common_cmd.iter_dram(offset, size, chunk_size)
+
+
+    def save_dram(self, path, offset, size, **kwargs):
+        return self.__common_cmd.save_dram(path, offset, size, **kwargs)
+
+
+    def __locate_capture_samples(self, awg_id, step_id, start_sample, num_samples):
+        """
+        キャプチャデータの start_sample 番目から num_samples 個のサンプルの格納先を調べる.
+        num_samples が None の場合はキャプチャデータの最後まで.
+
+        Returns
+        -------
+        (offset, num_samples, capture_sequence) : (int, int, CaptureSequence)
+            最初のサンプルの DRAM 内部のアドレス, サンプル数, awg_id にセットしたキャプチャシーケンス
+        """
+        if (not ag.AwgId.includes(awg_id)):
+            raise ValueError("invalid awg_id  " + str(awg_id))
+        
+        if (not isinstance(step_id, int) or (step_id < 0 or 0x7FFFFFFF < step_id)):
+            raise ValueError("invalid step_id " + str(step_id))
+
+        if (not isinstance(start_sample, int) or start_sample < 0):
+            raise ValueError("invalid start_sample " + str(start_sample))
+
+        if (num_samples is not None and (not isinstance(num_samples, int) or num_samples <= 0)):
+            raise ValueError("invalid num_samples " + str(num_samples))
+
+        capture_sequence = self.__get_set_capture_sequence(awg_id)
+        sample_size = self.get_capture_sample_size(capture_sequence.is_iq_data())
+        offset, data_size = self.__get_capture_section(awg_id, step_id)
+        if num_samples is None:
+            num_samples = data_size // sample_size - start_sample
+        if num_samples <= 0 or data_size < (start_sample + num_samples) * sample_size:
+            raise ValueError(
+                "invalid sample range  ({} - {})\n".format(start_sample, start_sample + num_samples - 1) +
+                "The capture step has {} samples.".format(data_size // sample_size))
+
+        return (offset + start_sample * sample_size, num_samples, capture_sequence)
+
+
+    def __get_capture_section(self, awg_id, step_id):
+        """キャプチャデータの格納先の DRAM 内部のアドレスとサイズ (Bytes)"""
+        results = self.__rft_ctrl_if.put_mult([
+            "GetDramAddrOffset",
+            self.__joinargs("GetCaptureSectionInfo", [int(awg_id), step_id])])
+        [addr, data_size] = self.__split_response(results[1], ",")
+        return (int(addr) - int(results[0]), int(data_size))
+
+
+    def __get_set_capture_sequence(self, awg_id):
+        """set_capture_config で awg_id にセットしたキャプチャシーケンスを返す"""
+        capture_sequence = self.__awg_to_capture_seq.get(ag.AwgId(awg_id))
+        if capture_sequence is None:
+            raise ag.InvalidOperationError(
+                "No capture sequence has been set to AWG {}.".format(int(awg_id)))
+        return capture_sequence
+
+
+    def __flatten_int32_out(self, out):
+        """キャプチャデータの格納先に指定された out を調べて, 1 次元のビューを返す"""
+        if (not isinstance(out, np.ndarray) or out.dtype != np.int32):
+            raise ValueError("'out' must be a numpy.ndarray of int32, but {} found".format(
+                out.dtype if isinstance(out, np.ndarray) else type(out)))
+        if not out.flags.c_contiguous:
+            raise ValueError("'out' must be C-contiguous.")
+        CmdUtil.check_recv_buffer(out)
+        return out.reshape(-1)
+
+
+    def __read_capture_data(self, awg_id, step_id, alloc):
+        """
+        キャプチャデータを読み取る.
+        alloc にはキャプチャデータのバイト数が渡される.
+        alloc がバッファを返した場合はそこに格納してバイト数を返し, None を返した場合は bytes を返す.
+        """
         command = self.__joinargs("ReadCaptureData", [int(awg_id), step_id])
         self.__rft_data_if.send_command(command)
         res = self.__rft_data_if.recv_response() # キャプチャデータの前のコマンド成否レスポンス  [AWG_SUCCESS/AWG_FAILURE, data size]
         [result, data_size] = self.__split_response(res, ",")
         if (result == "AWG_SUCCESS"):
-            data = self.__rft_data_if.recv_data(data_size, show_progress = True)
+            data = self.__recv_payload(data_size, alloc(data_size))
             self.__rft_data_if.recv_response() # end of capture data
 
         res = self.__rft_data_if.recv_response() # end of 'ReadCaptureData' command
@@ -243,6 +737,216 @@ class AwgSaCommand(object):
         return data
 
 
+    def read_all_captures(self, capture_config):
+        """
+        capture_config の全キャプチャステップのキャプチャデータと異常の有無をまとめて読み取る.
+        キャプチャデータの読み取りコマンドは, 応答を待たずにデータ用のソケットに続けて送られる.
+        データは CaptureReadout が確保した配列に直接格納される.
+
+        Parameters
+        ----------
+        capture_config : CaptureConfig
+            set_capture_config でセットしたキャプチャコンフィギュレーション
+
+        Returns
+        -------
+        readout : CaptureReadout
+            キャプチャデータと, 各キャプチャステップの異常の有無
+        """
+        awg_step_list = self.__capture_steps(capture_config)
+        commands = [
+            self.__joinargs("GetCaptureDataSize", [int(awg_id), step_id])
+            for awg_id, step_id in awg_step_list]
+        sizes = [int(res) for res in self.__rft_ctrl_if.put_mult(commands)]
+        readout = CaptureReadout._alloc(capture_config, dict(zip(awg_step_list, sizes)))
+        self.__read_captures_into(readout._buffers())
+        readout.health = self.get_capture_health(awg_step_list)
+        return readout
+
+
+    def plan_capture_readout(self, capture_config, *, max_gap = 0x10000, max_transfer_size = 0x10000000):
+        """
+        capture_config の全キャプチャステップのキャプチャデータを, 少数の ReadDram でまとめて読み取る計画を立てる.
+        全キャプチャステップの DRAM 上の格納先 (get_capture_section_info) を 1 度に取得し,
+        隣接するかまたは近くにある格納先を 1 つの転送にまとめる.
+        キャプチャシーケンスと波形シーケンスの繰り返し回数をセットしてから呼ぶこと.
+
+        Parameters
+        ----------
+        capture_config : CaptureConfig
+            set_capture_config でセットしたキャプチャコンフィギュレーション
+        max_gap : int
+            1 つの転送にまとめる格納先の間の最大の隙間 (Bytes).  隙間のデータも転送される.
+        max_transfer_size : int
+            1 つの転送の最大サイズ (Bytes)
+
+        Returns
+        -------
+        plan : CaptureReadPlan
+            read_planned_captures に渡す読み取り計画
+        """
+        if (not isinstance(max_gap, int) or max_gap < 0):
+            raise ValueError("invalid max_gap " + str(max_gap))
+        if (not isinstance(max_transfer_size, int) or max_transfer_size <= 0):
+            raise ValueError("invalid max_transfer_size " + str(max_transfer_size))
+
+        awg_step_list = self.__capture_steps(capture_config)
+        commands = ["GetDramAddrOffset"] + [
+            self.__joinargs("GetCaptureSectionInfo", [int(awg_id), step_id])
+            for awg_id, step_id in awg_step_list]
+        results = self.__rft_ctrl_if.put_mult(commands)
+        dram_addr_offset = int(results[0])
+        sections = {}
+        for awg_step, res in zip(awg_step_list, results[1:]):
+            [addr, data_size] = self.__split_response(res, ",")
+            sections[awg_step] = (int(addr) - dram_addr_offset, int(data_size))
+
+        return CaptureReadPlan(
+            capture_config, sections, max_gap = max_gap, max_transfer_size = max_transfer_size)
+
+
+    def read_planned_captures(self, plan):
+        """
+        plan_capture_readout で立てた計画に従ってキャプチャデータと異常の有無を読み取る.
+        各キャプチャステップのデータは, 転送したデータをコピーせずに参照する配列として返す.
+
+        Parameters
+        ----------
+        plan : CaptureReadPlan
+            plan_capture_readout で立てた読み取り計画
+
+        Returns
+        -------
+        readout : CaptureReadout
+            キャプチャデータと, 各キャプチャステップの異常の有無.  readout.tensor は None.
+        """
+        if (not isinstance(plan, CaptureReadPlan)):
+            raise ValueError("invalid plan " + str(plan))
+
+        buffers = []
+        for transfer in plan.transfers:
+            buf = np.empty(transfer.size, dtype = np.uint8)
+            self.__common_cmd.read_dram(transfer.offset, transfer.size, out = buf)
+            buffers.append(buf)
+        readout = plan._readout(buffers)
+        readout.health = self.get_capture_health(list(plan.sections))
+        return readout
+
+
+    def __capture_steps(self, capture_config):
+        """capture_config の全キャプチャステップの (AWG ID, ステップ ID) のリスト"""
+        if (not isinstance(capture_config, ag.CaptureConfig)):
+            raise ValueError("invalid capture_config " + str(capture_config))
+
+        awg_step_list = [
+            (awg_id, step_id)
+            for awg_id in capture_config.get_awg_id_list()
+            for step_id in capture_config.get_capture_sequence(awg_id).get_step_id_list()]
+        if not awg_step_list:
+            raise ValueError("capture_config has no capture steps.")
+        return awg_step_list
+
+
+    def __read_captures_into(self, awg_step_to_buf):
+        """
+        複数のキャプチャステップのキャプチャデータを読み取る.
+        ReadCaptureData を全て送ってから, 応答を順に受信する.
+
+        Parameters
+        ----------
+        awg_step_to_buf : {(AwgId, int) -> 書き込み可能な bytes-like object}
+            キャプチャステップと, そのキャプチャデータを格納するバッファ
+        """
+        self.__send_capture_reads(awg_step_to_buf)
+        self.__recv_captures_into(awg_step_to_buf)
+
+
+    def __send_capture_reads(self, awg_step_list):
+        for awg_id, step_id in awg_step_list:
+            self.__rft_data_if.send_command(self.__joinargs("ReadCaptureData", [int(awg_id), step_id]))
+
+
+    def __recv_captures_into(self, awg_step_to_buf):
+        """
+        __send_capture_reads で送った ReadCaptureData の応答を順に受信する
+        """
+        # エラーがあっても, 後続の応答を受信し終えるまで例外を投げない
+        errors = []
+        for (awg_id, step_id), buf in awg_step_to_buf.items():
+            res = self.__rft_data_if.recv_response() # [AWG_SUCCESS/AWG_FAILURE, data size]
+            [result, data_size] = self.__split_response(res, ",")
+            if (result == "AWG_SUCCESS"):
+                if memoryview(buf).nbytes < data_size:
+                    self.__rft_data_if.recv_data(data_size, bufsize = 0x400000)
+                    errors.append("The capture data of AWG {} step {} is larger than expected.  ({} bytes)"
+                        .format(int(awg_id), step_id, data_size))
+                else:
+                    self.__rft_data_if.recv_data_into(buf, data_size)
+                self.__rft_data_if.recv_response() # end of capture data
+
+            res = self.__rft_data_if.recv_response() # end of 'ReadCaptureData' command
+            if res[:5] == "ERROR":
+                errors.append(res.replace("\r\n", ""))
+
+        if errors:
+            raise rftc.RftoolExecuteCommandError(" ".join(errors))
+
+
+    def read_captures_and_set_wave_sequences(self, awg_step_to_out, awg_to_seq, *, num_repeats = 1):
+        """
+        キャプチャデータを読み取りながら, 次に出力する波形シーケンスを AWG にセットする.
+        データ用のソケットに ReadCaptureData を全て送った後, 応答を待たずに SetWaveSequence と波形データを
+        別のスレッドから続けて送るので, 波形シーケンスの送信はキャプチャデータの受信と並行して進む.
+        波形シーケンスをセットしてもキャプチャデータは変わらないが,
+        次の start_wave_sequence でキャプチャデータは上書きされる.
+
+        Parameters
+        ----------
+        awg_step_to_out : {(AwgId, int) -> 書き込み可能な bytes-like object}
+            キャプチャステップと, そのキャプチャデータを格納するバッファ.
+            バッファは C-contiguous で, キャプチャデータのサイズ以上でなければならない.
+        awg_to_seq : {AwgId -> WaveSequence}
+            AWG ID と, その AWG にセットする波形シーケンスの辞書
+        num_repeats : int
+            波形シーケンスを繰り返す回数
+            負の数を指定すると AWG を強制停止させるまでシーケンスを繰り返し続ける
+        """
+        for (awg_id, step_id), out in awg_step_to_out.items():
+            if (not ag.AwgId.includes(awg_id)):
+                raise ValueError("invalid awg_id  " + str(awg_id))
+            if (not isinstance(step_id, int) or (step_id < 0 or 0x7FFFFFFF < step_id)):
+                raise ValueError("invalid step_id " + str(step_id))
+            CmdUtil.check_recv_buffer(out)
+        self.__check_wave_sequences(awg_to_seq, num_repeats)
+
+        self.__send_capture_reads(awg_step_to_out)
+        uploads = []
+        errors = []
+        def send_wave_sequences():
+            try:
+                uploads[:] = self.__send_wave_sequences(awg_to_seq, num_repeats)
+            except Exception as e:
+                errors.append(e)
+
+        sender = threading.Thread(target = send_wave_sequences, name = "AwgSaWaveSender", daemon = True)
+        sender.start()
+        try:
+            self.__recv_captures_into(awg_step_to_out)
+        except rftc.RftoolExecuteCommandError as e:
+            # SetWaveSequence の応答を受信し終えるまで例外を投げない
+            errors.append(e)
+        finally:
+            sender.join()
+
+        try:
+            self.__recv_upload_responses(uploads)
+        except rftc.RftoolExecuteCommandError as e:
+            errors.append(e)
+        if errors:
+            raise errors[0]
+
+
+    @pipelined
     def get_capture_data_size(self, awg_id, step_id):
         """
         キャプチャモジュール ID とキャプチャステップから, キャプチャデータサイズ (Bytes) を取得する
@@ -254,18 +958,106 @@ class AwgSaCommand(object):
             raise ValueError("invalid step_id " + str(step_id))
 
         command = self.__joinargs("GetCaptureDataSize ", [int(awg_id), step_id])
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         return int(res)  # byte
         
 
+    @pipelined
     def initialize_awg_sa(self):
         """
         AWG および AWG 制御用ライブラリの初期化を行う
         """
         command = "InitializeAwgSa"
-        self.__rft_ctrl_if.put(command)
+        self.invalidate_upload_cache()
+        yield command
+        self.__completion_times.clear()
+        self.__enabled_awgs.clear()
+        self.__awg_to_capture_seq.clear()
+
 
+    def enable_upload_cache(self, enable = True):
+        """
+        アップロードキャッシュの有効/無効を切り替える.  既定では無効.
+
+        有効な場合, set_wave_sequence(s), set_capture_config, set_digital_output_sequence は,
+        前回送ったものと同じ内容のシーケンスを送らずに済ませる.
+        シーケンスの内容はハッシュ値で比較する.
+        キャッシュは initialize_awg_sa, FPGA のコンフィギュレーション, 再接続 (connect, reconnect_data) で破棄される.
+        他のクライアントが同じボードの AWG を操作する場合は有効にしてはならない.
+
+        Parameters
+        ----------
+        enable : bool
+            True ならキャッシュを有効にする
+        """
+        self.__upload_cache_enabled = enable
+        self.invalidate_upload_cache()
+
+
+    def invalidate_upload_cache(self):
+        """
+        アップロードキャッシュを破棄する.
+        次の set_wave_sequence(s), set_capture_config, set_digital_output_sequence は必ずシーケンスを送る.
+        """
+        self.__upload_cache.clear()
+
+
+    def upload_cache_info(self):
+        """
+        アップロードキャッシュの統計を取得する
+
+        Returns
+        -------
+        info : UploadCacheInfo
+            hits: 送信を省略した回数, misses: シーケンスを送った回数, entries: キャッシュしているシーケンスの数
+        """
+        return UploadCacheInfo(
+            self.__upload_cache_hits, self.__upload_cache_misses, len(self.__upload_cache))
 
+
+    def reset_upload_cache_info(self):
+        """
+        アップロードキャッシュのヒット数とミス数を 0 にする
+        """
+        self.__upload_cache_hits = 0
+        self.__upload_cache_misses = 0
+
+
+    def __lookup_upload_cache(self, key, command, data):
+        """
+        key に前回送ったものと command, data が同じなら None を返す.
+        そうでなければ key のキャッシュを破棄して, 送信成功後に __store_upload_cache に渡すハッシュ値を返す.
+        キャッシュが無効な場合はハッシュ値を計算せずに空のバイト列を返す.
+        """
+        if not self.__upload_cache_enabled:
+            self.__upload_cache_misses += 1
+            return b""
+
+        digest = hashlib.blake2b(command.encode('utf-8'), digest_size = 16)
+        digest.update(data)
+        digest = digest.digest()
+        if self.__upload_cache.get(key) == digest:
+            self.__upload_cache_hits += 1
+            return None
+        self.__upload_cache_misses += 1
+        # 送信に失敗した場合, ボード側のシーケンスは不明
+        self.__upload_cache.pop(key, None)
+        return digest
+
+
+    def __store_upload_cache(self, key, digest):
+        if self.__upload_cache_enabled:
+            self.__upload_cache[key] = digest
+
+
+    def __put_with_data_cached(self, key, command, data):
+        digest = self.__lookup_upload_cache(key, command, data)
+        if digest is not None:
+            self.__rft_data_if.PutCmdWithData(command, data)
+            self.__store_upload_cache(key, digest)
+
+
+    @pipelined
     def is_capture_step_skipped(self, awg_id, step_id):
         """
         引数で指定したキャプチャステップがスキップされていたかどうかを調べる
@@ -290,10 +1082,11 @@ class AwgSaCommand(object):
             raise ValueError("invalid step_id " + str(step_id))
 
         command = self.__joinargs("IsCaptureStepSkipped ", [int(awg_id), step_id])
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         return False if int(res) == 0 else True
 
 
+    @pipelined
     def is_accumulated_value_overranged(self, awg_id, step_id):
         """
         引数で指定したキャプチャステップで積算値の範囲オーバーが発生したかどうかを調べる
@@ -318,7 +1111,7 @@ class AwgSaCommand(object):
             raise ValueError("invalid step_id " + str(step_id))
 
         command = self.__joinargs("IsAccumulatedValueOverranged", [int(awg_id), step_id])
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         return False if int(res) == 0 else True
 
 
@@ -353,7 +1146,45 @@ class AwgSaCommand(object):
         return False if (fifo_overflow == 0) and (cdc_missed == 0) else True
 
 
-    def get_spectrum(self, awg_id, step_id, start_sample_idx, num_frames, *, is_iq_data = False):
+    def get_capture_health(self, awg_step_list):
+        """
+        複数のキャプチャステップの異常の有無をまとめて調べる.
+        is_capture_step_skipped, is_capture_data_fifo_overflowed, is_accumulated_value_overranged を
+        全てのキャプチャステップについて調べるコマンドは, 応答を待たずに続けて送られる.
+
+        Parameters
+        ----------
+        awg_step_list : list of (AwgId, int)
+            調べたいキャプチャステップの (AWG ID, ステップ ID) のリスト
+
+        Returns
+        -------
+        health : {(AwgId, int) -> CaptureHealth}
+            キャプチャステップと, その異常の有無
+        """
+        commands = []
+        for awg_id, step_id in awg_step_list:
+            if (not ag.AwgId.includes(awg_id)):
+                raise ValueError("invalid awg_id  " + str(awg_id))
+            if (not isinstance(step_id, int) or (step_id < 0 or 0x7FFFFFFF < step_id)):
+                raise ValueError("invalid step_id " + str(step_id))
+            args = [int(awg_id), step_id]
+            commands += [
+                self.__joinargs("IsCaptureStepSkipped", args),
+                self.__joinargs("IsCaptureDataFifoOverflowed", args),
+                self.__joinargs("IsAdcClockConvMissed", args),
+                self.__joinargs("IsAccumulatedValueOverranged", args)]
+
+        results = self.__rft_ctrl_if.put_mult(commands) if commands else []
+        health = {}
+        for i, awg_step in enumerate(awg_step_list):
+            skipped, fifo_overflow, cdc_missed, overranged = [int(res) for res in results[i * 4 : i * 4 + 4]]
+            health[awg_step] = CaptureHealth(
+                skipped != 0, (fifo_overflow != 0) or (cdc_missed != 0), overranged != 0)
+        return health
+
+
+    def get_spectrum(self, awg_id, step_id, start_sample_idx, num_frames, *, is_iq_data = False, out = None):
         """
         キャプチャした AWGデータの FFT スペクトラムを取得する
         
@@ -370,11 +1201,15 @@ class AwgSaCommand(object):
             取得する FFT のフレーム数
         is_iq_data : bool
             キャプチャデータが I/Q データの場合 True. Real データの場合 False.
+        out : 書き込み可能な bytes-like object (bytearray, numpy.ndarray など)
+            指定した場合, スペクトラムデータを中間バッファを介さずに out の先頭から直接格納する.
+            out のサイズはスペクトラムデータのサイズ以上でなければならない.
         
         Returns
         -------
-        spectrum : bytes
-            スペクトラムデータ
+        spectrum : bytes or int
+            スペクトラムデータ.
+            out を指定した場合は, out に格納したバイト数.
         """
 
         if (not ag.AwgId.includes(awg_id)):
@@ -392,6 +1227,9 @@ class AwgSaCommand(object):
         if (not isinstance(is_iq_data, bool)):
             raise ValueError("invalid is_iq_data " + str(is_iq_data))
 
+        if out is not None:
+            CmdUtil.check_recv_buffer(out)
+
         if (is_iq_data and
             start_sample_idx % hwi.NUM_IQ_SAMPLES_IN_CAPTURE_WORD != 0):
            raise ValueError("'start_sample_idx' must be a multiple of 8 for I/Q data.  " + str(start_sample_idx))
@@ -408,7 +1246,7 @@ class AwgSaCommand(object):
         [result, data_size] = self.__split_response(res, ",")
 
         if (result == "SA_SUCCESS"):
-            spectrum = self.__rft_data_if.recv_data(data_size, show_progress = True)
+            spectrum = self.__recv_payload(data_size, out)
             self.__rft_data_if.recv_response() # end of spectrum data
 
         res = self.__rft_data_if.recv_response() # end of 'GetSpectrum' command
@@ -442,11 +1280,12 @@ class AwgSaCommand(object):
         if (not ag.AwgId.includes(awg_id)):
            raise ValueError("invalid awg_id  " + str(awg_id))
         
-        data = dout_sequence.serialize()
+        data = self.__rft_data_if.run_cpu_bound(dout_sequence.serialize)
         command = self.__joinargs("SetDoutSequence", [int(awg_id), len(data)])
-        self.__rft_data_if.PutCmdWithData(command, data)
+        self.__put_with_data_cached(("dout", ag.AwgId(awg_id)), command, data)
 
 
+    @pipelined
     def is_digital_output_step_skipped(self, awg_id, step_id):
         """
         引数で指定したデジタル出力ステップがスキップされていたかどうかを調べる
@@ -471,7 +1310,7 @@ class AwgSaCommand(object):
             raise ValueError("invalid step_id " + str(step_id))
 
         command = self.__joinargs("IsDoutStepSkipped", [int(awg_id), step_id])
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         return False if int(res) == 0 else True
 
 
@@ -536,6 +1375,25 @@ class AwgSaCommand(object):
         return fws.WaveSequenceParams.build_from_bytes(seq_params_bytes)
 
 
+    def __recv_payload(self, data_size, out):
+        """
+        コマンド成否レスポンスに続く data_size バイトのデータを受信する.
+        out を指定した場合は out に直接格納し, 格納したバイト数を返す.
+        """
+        if out is None:
+            return self.__rft_data_if.recv_data(data_size, show_progress = True)
+
+        if memoryview(out).nbytes < data_size:
+            # 後続のレスポンスを受信できるように, データを読み捨ててから例外を投げる
+            self.__rft_data_if.recv_data(data_size, bufsize = 0x400000)
+            self.__rft_data_if.recv_response()
+            self.__rft_data_if.recv_response()
+            raise ValueError(
+                "'out' is too small to store the data.  ({} < {} bytes)".format(memoryview(out).nbytes, data_size))
+
+        return self.__rft_data_if.recv_data_into(out, data_size, show_progress = True)
+
+
     def get_adc_tile_id_by_awg_id(self, awg_id):
         """
         AWG に対応する ADC のタイル ID を取得する
@@ -570,6 +1428,7 @@ class AwgSaCommand(object):
         self.__common_cmd.sync_adc_tiles()
 
 
+    @pipelined
     def external_trigger_on(self, *ext_trig_id_list, oneshot = True):
         """
         引数で指定した外部トリガモジュールを起動する.
@@ -593,9 +1452,10 @@ class AwgSaCommand(object):
             raise ValueError("invalid oneshot " + str(oneshot))
 
         command = self.__joinargs("ExternalTriggerOn", enable_list + [int(oneshot)])
-        self.__rft_ctrl_if.put(command)
+        yield command
 
 
+    @pipelined
     def external_trigger_off(self, *ext_trig_id_list):
         """
         引数で指定した外部トリガモジュールを停止する.
@@ -613,9 +1473,10 @@ class AwgSaCommand(object):
             enable_list[int(ext_trig_id)] = 1
 
         command = self.__joinargs("ExternalTriggerOff", enable_list)
-        self.__rft_ctrl_if.put(command)
+        yield command
 
 
+    @pipelined
     def set_trigger_mode(self, awg_id, trig_mode):
         """
         引数で指定した AWG のトリガモードを設定する.
@@ -635,9 +1496,10 @@ class AwgSaCommand(object):
             raise ValueError("invalid trig_mode  " + str(trig_mode))
         
         command = self.__joinargs("SetTriggerMode", [int(awg_id), int(trig_mode)])
-        self.__rft_ctrl_if.put(command)
+        yield command
 
 
+    @pipelined
     def get_trigger_mode(self, awg_id):
         """
         引数で指定した AWG のトリガモードを取得する.
@@ -656,10 +1518,11 @@ class AwgSaCommand(object):
             raise ValueError("invalid awg_id  " + str(awg_id))
         
         command = self.__joinargs("GetTriggerMode", [int(awg_id)])
-        res = self.__rft_ctrl_if.put(command)        
+        res = yield command
         return ag.TriggerMode.of(int(res))
 
 
+    @pipelined
     def set_external_trigger_param(self, ext_trig_id, param_id, param):
         """
         引数で指定した外部トリガモジュールにトリガパラメータを設定する
@@ -686,9 +1549,10 @@ class AwgSaCommand(object):
             param = param + (1 << 32) # to unsigned
 
         command = self.__joinargs("SetExternalTriggerParam", [int(ext_trig_id), param_id, param])
-        self.__rft_ctrl_if.put(command)
+        yield command
 
 
+    @pipelined
     def get_external_trigger_param(self, ext_trig_id, param_id, to_signed):
         """
         引数で指定した外部トリガモジュールのトリガパラメータを取得する
@@ -714,7 +1578,7 @@ class AwgSaCommand(object):
             raise ValueError("invalid param_id " + str(param_id))
 
         command = self.__joinargs("GetExternalTriggerParam", [int(ext_trig_id), param_id])
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         trigger_param = int(res) # コマンドの戻り値は unsigned
         if to_signed and (trigger_param & 0x80000000):
             trigger_param = trigger_param - 0x100000000
@@ -722,6 +1586,7 @@ class AwgSaCommand(object):
         return trigger_param
 
 
+    @pipelined
     def is_external_trigger_active(self, ext_trig_id):
         """
         引数で指定した外部トリガモジュールが動作中かどうか調べる
@@ -741,10 +1606,11 @@ class AwgSaCommand(object):
             raise ValueError("invalid external trigger id  " + str(ext_trig_id))
 
         command = self.__joinargs("IsExternalTriggerActive", [int(ext_trig_id)])
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         return False if int(res) == 0 else True
 
 
+    @pipelined
     def is_external_trigger_signal_sent(self, ext_trig_id):
         """
         引数で指定した外部トリガモジュールが, トリガを発行したかどうかを調べる
@@ -764,10 +1630,11 @@ class AwgSaCommand(object):
             raise ValueError("invalid external trigger id  " + str(ext_trig_id))
 
         command = self.__joinargs("IsExternalTriggerSignalSent", [int(ext_trig_id)])
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         return False if int(res) == 0 else True
 
 
+    @pipelined
     def terminate_awgs(self, *awg_list):
         """
         引数で指定した AWG に停止命令を発行する.
@@ -787,9 +1654,11 @@ class AwgSaCommand(object):
             termination_flag_list[int(awg_id)] = 1
 
         command = self.__joinargs("TerminateAwgs", termination_flag_list)
-        self.__rft_ctrl_if.put(command)
+        yield command
+        self.__completion_times.stopped(*awg_list)
 
 
+    @pipelined
     def terminate_all_awgs(self):
         """
         全ての AWG に停止命令を発行する.
@@ -797,9 +1666,11 @@ class AwgSaCommand(object):
         AWG が停止するまでブロックするわけではないので, 停止の確認は is_wave_sequence_complete メソッドの戻り値が
         AwgSaCmdResult.WAVE_SEQUENCE_COMPLETE かどうかで判断すること.
         """
-        self.__rft_ctrl_if.put("TerminateAllAwgs")
+        yield "TerminateAllAwgs"
+        self.__completion_times.stopped(*ag.AwgId)
 
 
+    @pipelined
     def get_capture_section_info(self, awg_id, step_id):
         """
         キャプチャモジュールの ID とキャプチャステップから, 
@@ -825,11 +1696,12 @@ class AwgSaCommand(object):
             raise ValueError("invalid step_id " + str(step_id))
 
         command = self.__joinargs("GetCaptureSectionInfo", [int(awg_id), step_id])
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         [addr, data_size] = self.__split_response(res, ",")
         return (int(addr), int(data_size))
 
 
+    @pipelined
     def get_dram_addr_offset(self):
         """
         ZCU111 内部で DRAM がマップされている物理アドレスを返す
@@ -839,7 +1711,7 @@ class AwgSaCommand(object):
         addr : int
             ZCU111 システム全体で DRAM がマップされている物理アドレス
         """
-        res = self.__rft_ctrl_if.put("GetDramAddrOffset")
+        res = yield "GetDramAddrOffset"
         return int(res)
 
 
@@ -861,6 +1733,7 @@ class AwgSaCommand(object):
         return (hwi.CAPTURE_WAVE_SAMPLE_SIZE * 2) if iq else hwi.CAPTURE_WAVE_SAMPLE_SIZE
 
 
+    @pipelined
     def select_src_clk(self, clk_sel):
         """
         DAC と ADC のソースクロックを選択する.
@@ -875,9 +1748,10 @@ class AwgSaCommand(object):
             raise ValueError("invalid clk_sel  " + str(clk_sel))
 
         command = self.__joinargs("SelectSrcClk", [int(clk_sel)])
-        self.__rft_ctrl_if.put(command)
+        yield command
 
 
+    @pipelined
     def get_src_clk(self):
         """
         使用中の DAC と ADC のソースクロックを取得する.
@@ -888,34 +1762,38 @@ class AwgSaCommand(object):
             現在選択されているソースクロック
         """
         command = "GetSrcClk"
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         return rftc.ClockSrc.of(int(res))
 
 
+    @pipelined
     def get_num_wave_sequence_completed(self, awg_id):
         """
         波形シーケンスの出力とそれに伴うキャプチャなどの処理が完了した回数を取得する.
         強制終了した場合は, 完了した回数に含まれない.
         """
         command = self.__joinargs("GetNumWaveSequencesCompleted", [int(awg_id)])
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         return int(res)
 
 
+    @pipelined
     def start_dsp(self):
         """
         DSP モジュールの動作を開始する
         """
-        self.__rft_ctrl_if.put("StartDsp")
+        yield "StartDsp"
 
 
+    @pipelined
     def reset_dsp(self):
         """
         DSP モジュールをリセットする
         """
-        self.__rft_ctrl_if.put("ResetDsp")
+        yield "ResetDsp"
 
 
+    @pipelined
     def is_dsp_complete(self):
         """
         DSP モジュールの処理が完了しているか調べる
@@ -927,7 +1805,7 @@ class AwgSaCommand(object):
             DSP_COMPLETE -> DSP 完了
             DSP_ERROR -> DSP にエラーが発生
         """
-        res = self.__rft_ctrl_if.put("IsDspComplete")
+        res = yield "IsDspComplete"
         res = int(res)
         if res == 0:
             return ag.AwgSaCmdResult.DSP_NOT_COMPLETE
@@ -939,6 +1817,7 @@ class AwgSaCommand(object):
         raise ValueError('unknown command result  {}'.format(res))
 
 
+    @pipelined
     def is_dsp_ready(self):
         """
         DSP モジュールが処理を開始できる状態かどうか調べる
@@ -949,10 +1828,11 @@ class AwgSaCommand(object):
             True -> 開始可能
             False -> 開始不可能
         """
-        res = self.__rft_ctrl_if.put("IsDspReady")
+        res = yield "IsDspReady"
         return False if int(res) == 0 else True
 
 
+    @pipelined
     def set_dsp_param(self, param_id, param):
         """
         DSP 制御パラメータを設定する
@@ -1006,9 +1886,10 @@ class AwgSaCommand(object):
         elif param_id == ag.DspParamId.GENERAL_3:
             command = self.__joinargs("SetGeneralDspParam", [3, param])
 
-        self.__rft_ctrl_if.put(command)
+        yield command
 
 
+    @pipelined
     def get_dsp_param(self, param_id, to_signed = False):
         """
         DSP 制御パラメータを設定する
@@ -1045,7 +1926,7 @@ class AwgSaCommand(object):
         elif param_id == ag.DspParamId.GENERAL_3:
             command = self.__joinargs("GetGeneralDspParam", [3])
 
-        res = self.__rft_ctrl_if.put(command)
+        res = yield command
         param = int(res) # コマンドの戻り値は unsigned
         if to_signed and (param & 0x80000000):
             param = param - 0x100000000
@@ -1071,17 +1952,13 @@ class AwgSaCommand(object):
         if (not isinstance(timeout, (int, float))) or (timeout < 0):
             raise ValueError('Invalid timeout {}'.format(timeout))
 
-        start = time.time()
-        while True:
+        def dsp_stopped():
             res = self.is_dsp_complete()
-            if (res == ag.AwgSaCmdResult.DSP_COMPLETE) or (res == ag.AwgSaCmdResult.DSP_ERROR):
-                return
-                
-            elapsed_time = time.time() - start
-            if elapsed_time > timeout:
-                msg = 'DSP stop timeout'
-                raise ag.DspTimeoutError(msg)
-            time.sleep(0.1)
+            return (res == ag.AwgSaCmdResult.DSP_COMPLETE) or (res == ag.AwgSaCmdResult.DSP_ERROR)
+
+        if not self.__dsp_wait_policy.wait(dsp_stopped, timeout):
+            msg = 'DSP stop timeout'
+            raise ag.DspTimeoutError(msg)
 
 
     def awg_to_dac_tile_block(self, awg_id):
@@ -1152,9 +2029,17 @@ class AwgSaCommand(object):
             return (3, 1)
     
     
-    def read_dram(self, offset, size):
-        return self.__common_cmd.read_dram(offset, size)
+    def read_dram(self, offset, size, *, out = None, max_retries = 0, segment_size = 0x4000000):
+        return self.__common_cmd.read_dram(
+            offset, size, out = out, max_retries = max_retries, segment_size = segment_size)
     
 
-    def write_dram(self, offset, data):
-        return self.__common_cmd.write_dram(offset, data)
+    def write_dram(self, offset, data, *, max_retries = 0, segment_size = 0x4000000):
+        return self.__common_cmd.write_dram(
+            offset, data, max_retries = max_retries, segment_size = segment_size)
+
+
+    @property
+    def last_transfer_retries(self):
+        """直前に max_retries を指定して行った DRAM の転送で, 通信エラーのためにやり直した回数"""
+        return self.__common_cmd.last_transfer_retries
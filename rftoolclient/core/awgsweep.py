@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rftoolclient.awgsa as ag
+
+"""
+awgsweep.py
+    - Pipelined parameter sweeps on the AWG SA design
+"""
+
+
+def _coords(axes, index):
+    return {name : values[i] for (name, values), i in zip(axes, index)}
+
+
+class SweepResult(object):
+    """Results of AwgSweep.run, indexed by the sweep coordinates.
+
+    Attributes
+    ----------
+    axes : list of (str, list)
+        Names and values of the sweep axes.
+    shape : tuple of int
+        Number of values of each axis.
+    captures : {(AwgId, int) -> numpy.ndarray}
+        Capture data of each (AWG, step) as 32-bit words.
+        The shape is shape + (number of words,).
+    health : {(AwgId, int) -> numpy.ndarray}
+        CaptureHealth flags of each (AWG, step) as bools.
+        The shape is shape + (3,).  Not set if check_health is False.
+    status : {AwgId -> numpy.ndarray}
+        AwgSaCmdResult value of the wave sequence of each AWG.  The shape is shape.
+        (1: WAVE_SEQUENCE_COMPLETE, 2: WAVE_SEQUENCE_ERROR, 0: the AWG was not used)
+    analysis : numpy.ndarray of object
+        Return values of analyze.  The shape is shape.
+    completed : numpy.ndarray of bool
+        True at the points which have been run.
+    """
+
+    def __init__(self, axes, captures, health, status):
+        self.axes = axes
+        self.shape = tuple(len(values) for _, values in axes)
+        self.captures = captures
+        self.health = health
+        self.status = status
+        self.analysis = np.full(self.shape, None, dtype = object)
+        self.completed = np.zeros(self.shape, dtype = bool)
+
+    def __repr__(self):
+        return "<SweepResult axes={} completed={}/{}>".format(
+            [name for name, _ in self.axes], int(self.completed.sum()), self.completed.size)
+
+    def coords(self, index):
+        """{axis name -> value} at index"""
+        return _coords(self.axes, index)
+
+
+class AwgSweep(object):
+    """Runs a wave sequence for every point of a parameter grid.
+
+    For each point, the stages below run in a pipeline.
+
+    1. build(**coords) -> {AwgId -> WaveSequence}, on the builder thread,
+       up to `prefetch` points ahead.
+    2. start_wave_sequence, and wait for the AWGs.
+    3. Read the capture data of every capture step of capture_config on the
+       data socket, directly into the arrays of SweepResult.  The wave
+       sequences of the next point are uploaded on the same socket while
+       the capture data is being received
+       (AwgSaCommand.read_captures_and_set_wave_sequences).  At the same
+       time, the health flags are read on the control socket by another
+       thread.
+    4. analyze(index, coords, captures) on the analysis thread, while the
+       next points go through stages 2 and 3.  captures is
+       {(AwgId, int) -> numpy.ndarray}, views of the SweepResult arrays.
+
+    Uploading wave sequences does not change the capture data, but the next
+    start_wave_sequence overwrites it.  So the next point is started only
+    after stage 3 of a point has finished.
+
+    Parameters
+    ----------
+    awg_sa_cmd : AwgSaCommand
+    axes : dict or list of (str, sequence)
+        Names and values of the sweep axes.  The first axis varies slowest.
+    build : callable
+        Called with the coordinates of a point as keyword arguments.
+        Returns {AwgId -> WaveSequence}.
+    capture_config : CaptureConfig
+        Capture sequences used at all the points.
+    num_repeats : int
+        Number of times each wave sequence is repeated.
+    analyze : callable
+        Called on the analysis thread.  Its return value is stored in SweepResult.analysis.
+    timeout : int or float
+        Timeout (s) of the wave sequences of one point.
+    prefetch : int
+        Number of points built ahead.
+    check_health : bool
+        Read the health flags of the capture steps at every point.
+    """
+
+    def __init__(
+        self, awg_sa_cmd, axes, build, capture_config, *,
+        num_repeats = 1, analyze = None, timeout = 10, prefetch = 2, check_health = True):
+
+        if isinstance(axes, dict):
+            axes = list(axes.items())
+        axes = [(name, list(values)) for name, values in axes]
+        if not axes or any(len(values) == 0 for _, values in axes):
+            raise ValueError('Sweep axes must not be empty.')
+        if not isinstance(capture_config, ag.CaptureConfig):
+            raise ValueError("invalid capture_config " + str(capture_config))
+        if (not isinstance(timeout, (int, float))) or (timeout < 0):
+            raise ValueError('Invalid timeout {}'.format(timeout))
+        if (not isinstance(prefetch, int)) or (prefetch < 1):
+            raise ValueError('Invalid prefetch {}'.format(prefetch))
+
+        self.__cmd = awg_sa_cmd
+        self.__axes = axes
+        self.__build = build
+        self.__capture_config = capture_config
+        self.__num_repeats = num_repeats
+        self.__analyze = analyze
+        self.__timeout = timeout
+        self.__prefetch = prefetch
+        self.__check_health = check_health
+        self.__awg_step_list = [
+            (awg_id, step_id)
+            for awg_id in capture_config.get_awg_id_list()
+            for step_id in capture_config.get_capture_sequence(awg_id).get_step_id_list()]
+
+    def run(self):
+        """Run all the points and return the SweepResult."""
+        cmd = self.__cmd
+        shape = tuple(len(values) for _, values in self.__axes)
+        indexes = list(itertools.product(*[range(n) for n in shape]))
+        builder = ThreadPoolExecutor(1, thread_name_prefix = "AwgSweepBuilder")
+        analyzer = ThreadPoolExecutor(1, thread_name_prefix = "AwgSweepAnalyzer")
+        health_reader = ThreadPoolExecutor(1, thread_name_prefix = "AwgSweepHealth")
+        builds = {}
+        analyses = []
+        enabled = set()
+        try:
+            def next_sequences(i):
+                if i == len(indexes):
+                    return {}
+                for ahead in indexes[i : i + self.__prefetch + 1]:
+                    if ahead not in builds:
+                        builds[ahead] = builder.submit(self.__build_point, _coords(self.__axes, ahead))
+                return builds.pop(indexes[i]).result()
+
+            awg_to_seq = next_sequences(0)
+            # The capture data size depends on num_repeats of the wave sequences.
+            # So the capture config is set, and the buffers are sized, after the
+            # wave sequences of the first point.
+            cmd.set_wave_sequences(awg_to_seq, num_repeats = self.__num_repeats)
+            cmd.set_capture_config(self.__capture_config)
+            result = self.__alloc_result(shape)
+            for i, index in enumerate(indexes):
+                if not set(awg_to_seq) <= enabled:
+                    enabled |= set(awg_to_seq)
+                    cmd.enable_awg(*enabled)
+                cmd.start_wave_sequence()
+                awg_to_status = cmd.wait_for_sequences(self.__timeout, *awg_to_seq)
+
+                health = None
+                if self.__check_health:
+                    health = health_reader.submit(cmd.get_capture_health, self.__awg_step_list)
+                captures = {
+                    awg_step : array[index] for awg_step, array in result.captures.items()}
+                awg_to_seq = next_sequences(i + 1)
+                cmd.read_captures_and_set_wave_sequences(
+                    captures, awg_to_seq, num_repeats = self.__num_repeats)
+
+                for awg_id, status in awg_to_status.items():
+                    result.status[awg_id][index] = status.value
+                if health is not None:
+                    for awg_step, flags in health.result().items():
+                        result.health[awg_step][index] = flags
+                result.completed[index] = True
+                if self.__analyze is not None:
+                    analyses.append(analyzer.submit(
+                        self.__analyze_point, result, index, captures))
+
+            for analysis in analyses:
+                analysis.result()
+        finally:
+            for future in builds.values():
+                future.cancel()
+            builder.shutdown()
+            health_reader.shutdown()
+            analyzer.shutdown()
+        return result
+
+    def __build_point(self, coords):
+        awg_to_seq = self.__build(**coords)
+        if not isinstance(awg_to_seq, dict) or not awg_to_seq:
+            raise ValueError(
+                "build must return {{AwgId -> WaveSequence}}, but {} found".format(awg_to_seq))
+        return awg_to_seq
+
+    def __analyze_point(self, result, index, captures):
+        result.analysis[index] = self.__analyze(index, result.coords(index), captures)
+
+    def __alloc_result(self, shape):
+        captures = {}
+        health = {}
+        for awg_step in self.__awg_step_list:
+            size = self.__cmd.get_capture_data_size(*awg_step)
+            captures[awg_step] = np.zeros(shape + (size // 4,), dtype = '<i4')
+            if self.__check_health:
+                health[awg_step] = np.zeros(shape + (3,), dtype = bool)
+        status = {
+            awg_id : np.zeros(shape, dtype = np.int8)
+            for awg_id in ag.AwgId}
+        return SweepResult(self.__axes, captures, health, status)
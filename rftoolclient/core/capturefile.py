@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import json
+import numpy as np
+
+"""
+capturefile.py
+    - .npy files into which DRAM and capture data are received directly
+"""
+
+
+def metadata_path(path):
+    """Path of the JSON file holding the metadata of the .npy file at path"""
+    return str(path) + ".json"
+
+
+def open_capture_file(path, dtype, shape):
+    """Create a .npy file of dtype and shape and return it as a writable numpy.memmap."""
+    return np.lib.format.open_memmap(str(path), mode = "w+", dtype = dtype, shape = shape)
+
+
+def write_metadata(path, metadata):
+    """Write the metadata of the .npy file at path.
+
+    The .npy header can only hold dtype, shape and order, so the rest of
+    the metadata is written to metadata_path(path).
+    """
+    with open(metadata_path(path), "w") as file:
+        json.dump(metadata, file, indent = 1, sort_keys = True)
+
+
+def load_capture_file(path, mmap_mode = "r"):
+    """Load a file written by save_dram or save_capture_data.
+
+    Parameters
+    ----------
+    path : str or path-like
+        Path of the .npy file.
+    mmap_mode : str or None
+        Passed to numpy.load.  By default the data is mapped read-only
+        instead of being read into memory.
+
+    Returns
+    -------
+    (data, metadata) : (numpy.ndarray, dict)
+        metadata is None if the file has no metadata, e.g. because the
+        transfer did not complete.
+    """
+    data = np.load(str(path), mmap_mode = mmap_mode)
+    try:
+        with open(metadata_path(path)) as file:
+            metadata = json.load(file)
+    except FileNotFoundError:
+        metadata = None
+    return data, metadata
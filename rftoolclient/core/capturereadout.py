@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+from collections import namedtuple
+import numpy as np
+import rftoolclient.awgsa.hardwareinfo as hwi
+
+"""
+capturereadout.py
+    - Capture data of all the capture steps of a CaptureConfig
+    - Planning of capture readouts coalesced into a few DRAM transfers
+"""
+
+
+class CaptureReadout(object):
+    """Capture data and health flags read by AwgSaCommand.read_all_captures
+    or AwgSaCommand.read_planned_captures.
+
+    If all the capture sequences have the same step IDs, and all the capture
+    steps have the same size and data type (real or I/Q), read_all_captures
+    holds the data of all the steps in one array, `tensor`, whose shape is
+    (AWG, step, sample) for real data or (AWG, step, sample, 2) for I/Q data.
+    Otherwise each capture step has its own array and `tensor` is None.
+
+    readout[awg_id, step_id] returns the data of one capture step in the
+    format of AwgSaCommand.read_capture_data_array.  It is a view of
+    `tensor` when there is one.
+
+    Attributes
+    ----------
+    awg_id_list : list of AwgId
+        The AWGs in the order of the first axis of `tensor`.
+    step_id_list : list of int
+        The step IDs in the order of the second axis of `tensor`.
+        None if `tensor` is None.
+    tensor : numpy.ndarray of int32
+        See above.
+    health : {(AwgId, int) -> CaptureHealth}
+        Health flags of each capture step.
+    """
+
+    def __init__(self, awg_id_list, arrays, *, step_id_list = None, tensor = None):
+        self.awg_id_list = list(awg_id_list)
+        self.step_id_list = step_id_list
+        self.tensor = tensor
+        self.health = {}
+        self.__arrays = arrays
+        self.__buffers = {awg_step : array.reshape(-1) for awg_step, array in arrays.items()}
+
+    @classmethod
+    def _alloc(cls, capture_config, awg_step_to_size):
+        """Allocate the arrays for the capture steps of capture_config."""
+        awg_id_list = capture_config.get_awg_id_list()
+        step_id_lists = [
+            capture_config.get_capture_sequence(awg_id).get_step_id_list()
+            for awg_id in awg_id_list]
+        iq_flags = _iq_flags(capture_config)
+        uniform = (
+            all(step_id_list == step_id_lists[0] for step_id_list in step_id_lists) and
+            len(set(awg_step_to_size.values())) == 1 and
+            len(set(iq_flags.values())) == 1)
+
+        arrays = {}
+        if not uniform:
+            for (awg_id, step_id), size in awg_step_to_size.items():
+                array = np.empty(size // hwi.CAPTURE_WAVE_SAMPLE_SIZE, dtype = np.int32)
+                arrays[(awg_id, step_id)] = _shape(array, iq_flags[awg_id])
+            return cls(awg_id_list, arrays)
+
+        step_id_list = list(step_id_lists[0])
+        num_words = next(iter(awg_step_to_size.values())) // hwi.CAPTURE_WAVE_SAMPLE_SIZE
+        sample_shape = (num_words // 2, 2) if iq_flags[awg_id_list[0]] else (num_words,)
+        tensor = np.empty((len(awg_id_list), len(step_id_list)) + sample_shape, dtype = np.int32)
+        for i, awg_id in enumerate(awg_id_list):
+            for j, step_id in enumerate(step_id_list):
+                arrays[(awg_id, step_id)] = tensor[i, j]
+        return cls(awg_id_list, arrays, step_id_list = step_id_list, tensor = tensor)
+
+    def __repr__(self):
+        return "<CaptureReadout steps={} tensor={}>".format(
+            len(self.__arrays), None if self.tensor is None else self.tensor.shape)
+
+    def __getitem__(self, awg_step):
+        return self.__arrays[awg_step]
+
+    def __contains__(self, awg_step):
+        return awg_step in self.__arrays
+
+    def __len__(self):
+        return len(self.__arrays)
+
+    def keys(self):
+        """(AwgId, step ID) of all the capture steps"""
+        return list(self.__arrays.keys())
+
+    @property
+    def failed_steps(self):
+        """(AwgId, step ID) of the capture steps with any health flag set"""
+        return [awg_step for awg_step, flags in self.health.items() if any(flags)]
+
+    def _buffers(self):
+        """{(AwgId, step ID) -> flat int32 array} into which the data is received"""
+        return self.__buffers
+
+
+DramTransfer = namedtuple("DramTransfer", ["offset", "size", "steps"])
+DramTransfer.__doc__ = """One ReadDram of a CaptureReadPlan.
+
+offset and size are those of the ReadDram.  steps is a list of
+((AwgId, step ID), start, size), where start is the position (bytes) of the
+capture data of the step in the transferred data.
+"""
+
+
+class CaptureReadPlan(object):
+    """Capture steps coalesced into a few ReadDram transfers.
+
+    Made by AwgSaCommand.plan_capture_readout from the DRAM sections of the
+    capture steps, and read by AwgSaCommand.read_planned_captures.
+    Sections whose gap is at most max_gap bytes are read with one ReadDram,
+    unless the transfer would grow beyond max_transfer_size bytes.  The
+    bytes in the gaps are read and thrown away.  A section larger than
+    max_transfer_size is read with one ReadDram of its own.
+
+    The sections change with the capture config and the number of repeats
+    of the wave sequences.  Make a new plan after changing either of them.
+
+    Attributes
+    ----------
+    awg_id_list : list of AwgId
+    sections : {(AwgId, int) -> (int, int)}
+        DRAM offset and size (bytes) of the capture data of each capture step.
+    transfers : list of DramTransfer
+        The ReadDram transfers in ascending order of offset.
+    """
+
+    def __init__(self, capture_config, sections, *, max_gap, max_transfer_size):
+        self.awg_id_list = capture_config.get_awg_id_list()
+        self.sections = dict(sections)
+        self.transfers = []
+        self.__iq_flags = _iq_flags(capture_config)
+
+        start = end = None
+        steps = []
+        for awg_step, (offset, size) in sorted(self.sections.items(), key = lambda item: item[1]):
+            if size == 0:
+                continue
+            if (start is not None and
+                offset - end <= max_gap and
+                max(end, offset + size) - start <= max_transfer_size):
+                end = max(end, offset + size)
+            else:
+                if start is not None:
+                    self.transfers.append(DramTransfer(start, end - start, steps))
+                start, end, steps = offset, offset + size, []
+            steps.append((awg_step, offset - start, size))
+        if start is not None:
+            self.transfers.append(DramTransfer(start, end - start, steps))
+
+    def __repr__(self):
+        return "<CaptureReadPlan steps={} transfers={} bytes={}>".format(
+            len(self.sections), len(self.transfers), self.transfer_size)
+
+    @property
+    def transfer_size(self):
+        """Total number of bytes transferred"""
+        return sum(transfer.size for transfer in self.transfers)
+
+    @property
+    def data_size(self):
+        """Total number of bytes of the capture data"""
+        return sum(size for _, size in self.sections.values())
+
+    def _readout(self, buffers):
+        """CaptureReadout whose arrays are views of buffers, the data of self.transfers"""
+        arrays = {
+            awg_step : _shape(np.empty(0, dtype = np.int32), self.__iq_flags[awg_step[0]])
+            for awg_step in self.sections}
+        for transfer, buf in zip(self.transfers, buffers):
+            for awg_step, start, size in transfer.steps:
+                array = buf[start : start + size].view(np.int32)
+                arrays[awg_step] = _shape(array, self.__iq_flags[awg_step[0]])
+        return CaptureReadout(self.awg_id_list, arrays)
+
+
+def _iq_flags(capture_config):
+    return {
+        awg_id : capture_config.get_capture_sequence(awg_id).is_iq_data()
+        for awg_id in capture_config.get_awg_id_list()}
+
+
+def _shape(array, is_iq_data):
+    return array.reshape(-1, 2) if is_iq_data else array
@@ -14,20 +14,53 @@ from .rftinterface import RftoolInterface
 from .commoncmd import CommonCommand
 from .stimgenctrl import StimGenCtrl
 from .digitaloutctrl import DigitalOutCtrl
+from .cmdbatch import CommandBatch
+from .cmdstats import CommandStats
+from . import trafficrec
 
 class RftoolClient(object):
-    def __init__(self, logger=None, timeout=10.0):
-
+    def __init__(self, logger=None, timeout=10.0, *, record=None, replay=None):
+        """
+        record : str
+            Write all the traffic with the board to this file.
+        replay : str or TrafficRecording
+            Do not connect to a board, but play back the board's side of a
+            file written with 'record'.  The client must issue the same
+            commands as it did in the recording.
+        """
         self._logger = logging.getLogger(__name__)
         self._logger.addHandler(logging.NullHandler())
         self._logger = logger or self._logger
 
-        self.if_ctrl = RftoolInterface(self._logger)
-        self.if_data = RftoolInterface(self._logger)
+        if record is not None and replay is not None:
+            raise ValueError("'record' and 'replay' cannot be used at the same time")
+        self.__recorder = None
+        self.__recording = None
+        if replay is not None:
+            self.__recording = replay if isinstance(replay, trafficrec.TrafficRecording) \
+                else trafficrec.TrafficRecording(replay)
+            self.if_ctrl = trafficrec.ReplayInterface(
+                self.__recording, trafficrec.CTRL, self._logger)
+            self.if_data = trafficrec.ReplayInterface(
+                self.__recording, trafficrec.DATA, self._logger)
+        elif record is not None:
+            self.__recorder = trafficrec.TrafficRecorder(record)
+            self.if_ctrl = trafficrec.RecordingInterface(
+                self.__recorder, trafficrec.CTRL, self._logger)
+            self.if_data = trafficrec.RecordingInterface(
+                self.__recorder, trafficrec.DATA, self._logger)
+        else:
+            self.if_ctrl = RftoolInterface(self._logger)
+            self.if_data = RftoolInterface(self._logger)
         self.command = RftoolCommand(self.if_ctrl, self._logger)
         common_cmd = CommonCommand(self.if_ctrl, self.if_data, self._logger)
+        self.__stim_reg_access = common_cmd.stim_reg_access
+        self.command.add_bitstream_listener(self.__stim_reg_access.invalidate_shadow_regs)
         self.awg_sa_cmd = AwgSaCommand(
             self.if_ctrl, self.if_data, common_cmd, self._logger)
+        self.command.add_bitstream_listener(self.awg_sa_cmd.invalidate_upload_cache)
+        if self.__recording is None:
+            common_cmd.set_data_reconnector(self.reconnect_data)
         self.stg_ctrl = StimGenCtrl(common_cmd, self.command, self._logger)
         self.digital_out_ctrl = DigitalOutCtrl(common_cmd, self._logger)
 
@@ -35,15 +68,24 @@ class RftoolClient(object):
         self.port_ctrl = 0
         self.port_data = 0
 
-        self.sock_data = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock_ctrl = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock_data = self.__new_socket()
+        self.sock_ctrl = self.__new_socket()
         self.err_connection = False
+        self.__stats = CommandStats()
 
         self.if_ctrl.attach_socket(self.sock_ctrl)
         self.if_data.attach_socket(self.sock_data)
         self.settimeout(timeout)
         self._logger.debug("RftoolClient __init__")
 
+    @staticmethod
+    def __new_socket():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Pipelined commands are written back to back before their responses
+        # are read, so Nagle's algorithm would hold them until a delayed ACK.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
     def __enter__(self):
         self._logger.debug("RftoolClient __enter__")
         return self
@@ -62,6 +104,12 @@ class RftoolClient(object):
         self.address = address
         self.port_data = port_data
         self.port_ctrl = port_ctrl
+        self.__stim_reg_access.invalidate_shadow_regs()
+        self.awg_sa_cmd.invalidate_upload_cache()
+
+        if self.__recording is not None:
+            self._logger.debug("RftoolClient connect (replay)")
+            return
 
         try:
             self.sock_data.connect((self.address, self.port_data))
@@ -72,16 +120,96 @@ class RftoolClient(object):
 
         self._logger.debug("RftoolClient connect")
 
+    def reconnect_data(self):
+        """Replace the data socket with a new connection to the board.
+
+        A transfer interrupted by a timeout leaves the rest of its payload
+        in flight, so the old connection cannot be used any more.  The DRAM
+        transfers called with max_retries call this before they retry.
+        The control socket is not touched.  The upload cache is invalidated.
+        """
+        timeout = self.sock_data.gettimeout()
+        try:
+            self.sock_data.close()
+        except OSError:
+            pass
+        self.sock_data = self.__new_socket()
+        self.sock_data.settimeout(timeout)
+        self.if_data.attach_socket(self.sock_data)
+        self.sock_data.connect((self.address, self.port_data))
+        self.if_data.err_connection = False
+        # an interrupted upload leaves an unknown sequence on the board
+        self.awg_sa_cmd.invalidate_upload_cache()
+        self._logger.debug("RftoolClient reconnect_data")
+
+    def batch(self):
+        """Create a CommandBatch which pipelines the commands of
+        self.command and self.awg_sa_cmd through the control socket.
+
+        with client.batch() as batch:
+            batch.command.SetupFIFO(1, 0, 1)
+            batch.awg_sa_cmd.initialize_awg_sa()
+        """
+        return CommandBatch(
+            self.if_ctrl, self.if_data, self._logger,
+            command = self.command, awg_sa_cmd = self.awg_sa_cmd)
+
+    def enable_shadow_regs(self, enable=True):
+        """Serve reads of the control and mask registers of the Stimulus
+        Generators and the digital output modules from a write-through
+        shadow copy, saving the read in their read-modify-writes.
+
+        Enable it only if no other client changes these registers.
+        See StimRegAccess.enable_shadow_regs.
+        """
+        self.__stim_reg_access.enable_shadow_regs(enable)
+
+    def enable_stats(self, enable=True):
+        """Start or stop collecting the per-command statistics returned by stats().
+
+        While disabled (the default), the interfaces skip all the bookkeeping.
+        """
+        instrument = self.__stats if enable else None
+        self.if_ctrl.set_instrument(instrument)
+        self.if_data.set_instrument(instrument)
+
+    def stats(self, reset=False):
+        """Return a snapshot of the per-command statistics (CommandStats).
+
+        Wall time, bytes sent / received, error count and a wall time
+        histogram are aggregated by command name.
+
+        print(client.stats().report())
+        """
+        self.if_ctrl.flush_instrument()
+        self.if_data.flush_instrument()
+        snapshot = self.__stats.snapshot()
+        if reset:
+            self.__stats.reset()
+        return snapshot
+
+    def reset_stats(self):
+        """Clear the per-command statistics (e.g. at the start of an experiment)."""
+        self.if_ctrl.flush_instrument()
+        self.if_data.flush_instrument()
+        self.__stats.reset()
+
     def close(self):
         err_c = self.err_connection | \
             self.if_ctrl.err_connection | self.if_data.err_connection
 
-        if err_c == False:
-            self.if_ctrl.put("disconnect")
-            self.sock_data.shutdown(socket.SHUT_RDWR)
-            self.sock_ctrl.shutdown(socket.SHUT_RDWR)
-
-        self.sock_data.close()
-        self.sock_ctrl.close()
+        try:
+            if err_c == False:
+                self.if_ctrl.put("disconnect")
+                if self.__recording is None:
+                    self.sock_data.shutdown(socket.SHUT_RDWR)
+                    self.sock_ctrl.shutdown(socket.SHUT_RDWR)
+        finally:
+            self.sock_data.close()
+            self.sock_ctrl.close()
+            if self.__recorder is not None:
+                self.__recorder.close()
+            if self.__recording is not None:
+                self.__recording.close()
 
         self._logger.debug("RftoolClient close")
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+clientpool.py
+    - A pool of RftoolClients which controls several boards in parallel
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .client import RftoolClient
+from .rfterr import RftoolPoolError
+
+
+class PoolResult(object):
+    """Per-board results of a call fanned out by RftoolClientPool"""
+
+    def __init__(self, addresses, values, errors):
+        self.__addresses = list(addresses)
+        self.__values = values
+        self.__errors = errors
+
+    def __repr__(self):
+        return "<PoolResult ok={} failed={}>".format(
+            list(self.__values.keys()), list(self.__errors.keys()))
+
+    def __getitem__(self, address):
+        """Return the result of the board, or raise the exception it raised."""
+        if address in self.__errors:
+            raise self.__errors[address]
+        return self.__values[address]
+
+    def __iter__(self):
+        return iter(self.__addresses)
+
+    def __len__(self):
+        return len(self.__addresses)
+
+    @property
+    def values(self):
+        """{address -> returned value} of the boards which succeeded"""
+        return dict(self.__values)
+
+    @property
+    def errors(self):
+        """{address -> raised exception} of the boards which failed"""
+        return dict(self.__errors)
+
+    @property
+    def ok(self):
+        return not self.__errors
+
+    def raise_for_errors(self):
+        """Raise RftoolPoolError if any board failed."""
+        if self.__errors:
+            raise RftoolPoolError(self.errors)
+
+
+class _PoolTarget(object):
+    """Proxy which fans out the public methods of a client member"""
+
+    def __init__(self, pool, member):
+        self.__pool = pool
+        self.__member = member
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            return self.__pool.map(
+                lambda client: getattr(getattr(client, self.__member), name)(*args, **kwargs))
+        method.__name__ = name
+        return method
+
+
+class RftoolClientPool(object):
+    """Controls several boards in parallel.
+
+    Every board has its own RftoolClient.  A call fanned out to the pool runs
+    on all the boards at the same time on a thread pool, so the time taken is
+    that of the slowest board.  The outcome of every board is collected into
+    a PoolResult instead of stopping at the first error.
+
+    with RftoolClientPool(["192.168.1.3", "192.168.1.4"]) as pool:
+        pool.connect().raise_for_errors()
+        pool.command.ConfigFpga(FpgaDesign.AWG_SA, 10).raise_for_errors()
+        captures = pool.awg_sa_cmd.read_capture_data(AwgId.AWG_0, 0)
+        # different arguments per board
+        pool.map(lambda client: client.awg_sa_cmd.set_wave_sequence(
+            AwgId.AWG_0, wave_seqs[client.address]))
+    """
+
+    def __init__(self, addresses, logger=None, timeout=10.0, max_workers=None):
+        self._logger = logging.getLogger(__name__)
+        self._logger.addHandler(logging.NullHandler())
+        self._logger = logger or self._logger
+
+        self.__addresses = list(addresses)
+        if len(set(self.__addresses)) != len(self.__addresses):
+            raise ValueError("duplicate board addresses  {}".format(self.__addresses))
+
+        self.__clients = {
+            address : RftoolClient(self._logger, timeout) for address in self.__addresses}
+        self.__executor = ThreadPoolExecutor(
+            max_workers = max_workers or max(1, len(self.__addresses)),
+            thread_name_prefix = "RftoolClientPool")
+        self.command = _PoolTarget(self, "command")
+        self.awg_sa_cmd = _PoolTarget(self, "awg_sa_cmd")
+        self.stg_ctrl = _PoolTarget(self, "stg_ctrl")
+        self.digital_out_ctrl = _PoolTarget(self, "digital_out_ctrl")
+        self.__closed = False
+        self._logger.debug("RftoolClientPool __init__")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excep_type, excep_val, trace):
+        self.close()
+
+    def __getitem__(self, address):
+        return self.__clients[address]
+
+    def __len__(self):
+        return len(self.__clients)
+
+    @property
+    def addresses(self):
+        return list(self.__addresses)
+
+    @property
+    def clients(self):
+        """{address -> RftoolClient}"""
+        return dict(self.__clients)
+
+    def settimeout(self, timeout):
+        for client in self.__clients.values():
+            client.settimeout(timeout)
+
+    def connect(self, port_ctrl=8081, port_data=8082):
+        """Connect to all the boards in parallel."""
+        return self.__fan_out(
+            lambda address, client: client.connect(address, port_ctrl, port_data))
+
+    def close(self):
+        """Close the connections to all the boards and stop the worker threads."""
+        if self.__closed:
+            return PoolResult(self.__addresses, {}, {})
+        self.__closed = True
+        try:
+            return self.map(lambda client: client.close())
+        finally:
+            self.__executor.shutdown()
+
+    def map(self, func, *args, **kwargs):
+        """Call func(client, *args, **kwargs) for every board in parallel.
+
+        Returns
+        -------
+        result : PoolResult
+            The value returned or the exception raised for each board.
+        """
+        return self.__fan_out(lambda address, client: func(client, *args, **kwargs))
+
+    def __fan_out(self, func):
+        futures = {
+            address : self.__executor.submit(func, address, client)
+            for address, client in self.__clients.items()}
+
+        values = {}
+        errors = {}
+        for address, future in futures.items():
+            try:
+                values[address] = future.result()
+            except Exception as e:
+                self._logger.error("{}: {}".format(address, e))
+                errors[address] = e
+        return PoolResult(self.__addresses, values, errors)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import functools
+import logging
+import rftoolclient as rftc
+from .cmdutil import parse_pipelined
+
+"""
+cmdbatch.py
+    - Pipelined command batch
+"""
+
+
+class _FlushHook(object):
+    """Interface hook which flushes a CommandBatch before any transaction,
+    so that no command overtakes the queued ones"""
+
+    def __init__(self, batch):
+        self.__batch = batch
+
+    def on_put(self, interface, command):
+        self.__batch.flush()
+        return None
+
+    def on_send(self, interface):
+        self.__batch.flush()
+
+
+class BatchedCall(object):
+    """Result of a call queued in a CommandBatch"""
+
+    def __init__(self, batch, func):
+        self.__batch = batch
+        self.__name = getattr(func, "__name__", repr(func))
+        self.__done = False
+        self.__retrieved = False
+        self.__result = None
+        self.__exception = None
+        # parse part of the queued call (see cmdutil.pipelined)
+        self.__steps = None
+        self.command = None
+
+    def __repr__(self):
+        state = "done" if self.__done else "pending"
+        return "<BatchedCall {} {}>".format(self.__name, state)
+
+    def done(self):
+        """Return True if the result of the call is available."""
+        return self.__done
+
+    def result(self):
+        """Return the value returned by the call.
+
+        If the call is still queued, the batch is flushed first.
+        If the call raised an exception, the exception is raised here.
+        """
+        exception = self.exception()
+        if exception is not None:
+            raise exception
+        return self.__result
+
+    def exception(self):
+        """Return the exception raised by the call, or None."""
+        if not self.__done:
+            self.__batch.flush()
+        self.__retrieved = True
+        return self.__exception
+
+    def _invoke(self, func, args, kwargs):
+        """Run the call at once."""
+        try:
+            self.__result = func(*args, **kwargs)
+        except Exception as e:
+            self.__exception = e
+        self.__done = True
+
+    def _queue(self, steps):
+        """Run the build part of a pipelined method and keep the command it yields."""
+        self.command = next(steps)
+        self.__steps = steps
+
+    def _resolve(self, response):
+        """Complete the call with the response (or the error) of the queued command."""
+        steps, self.__steps = self.__steps, None
+        if isinstance(response, Exception):
+            steps.close()
+            self.__exception = response
+        else:
+            try:
+                self.__result = parse_pipelined(steps, response)
+            except Exception as e:
+                self.__exception = e
+        self.__done = True
+
+    def _unretrieved_exception(self):
+        if self.__retrieved:
+            return None
+        return self.__exception
+
+
+class _BatchTarget(object):
+    """Proxy which queues the public methods of a command object"""
+
+    def __init__(self, batch, target):
+        self.__batch = batch
+        self.__target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self.__target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        return functools.partial(self.__batch.call, attr)
+
+
+class CommandBatch(object):
+    """Queue commands and send them through the control socket in one write.
+
+    Methods called through the proxies of a batch (batch.command and
+    batch.awg_sa_cmd) which send exactly one control command are queued:
+    the part of the method which builds the command runs at once, and a
+    BatchedCall is returned.  When the batch is flushed, the queued
+    commands are sent in one write, their responses are read in order, and
+    the part of each method which parses the response runs with its own
+    response.  The methods that can be queued are those decorated with
+    cmdutil.pipelined in the command classes.
+
+    Any other call (e.g. ConfigFpga, or sending wave data) flushes the queue
+    and runs immediately, so the order in which the commands reach the
+    server is always the order of the calls.  Direct calls made on the
+    client inside a 'with' block also flush the queue first.
+
+    When the 'with' block exits, the batch is flushed and the first error not
+    retrieved through BatchedCall.result() / exception() is raised.
+
+    Examples
+    --------
+    with client.batch() as batch:
+        batch.command.SetMixerSettings(...)
+        bitstream = batch.command.GetBitstream()
+    print(bitstream.result())
+    """
+
+    # キューに溜められるコマンドの最大数.  これを超えると自動的に送信する.
+    MAX_PENDING_COMMANDS = 64
+
+    def __init__(self, ctrl_interface, data_interface, logger=None, **targets):
+        self.__logger = logging.getLogger(__name__)
+        self.__logger.addHandler(logging.NullHandler())
+        self.__logger = logger or self.__logger
+        self.__ctrl_if = ctrl_interface
+        self.__data_if = data_interface
+        self.__pending = []
+        self.__calls = []
+        self.__prev_hooks = None
+        for name, target in targets.items():
+            setattr(self, name, _BatchTarget(self, target))
+
+    def __enter__(self):
+        self.__prev_hooks = self.__set_hooks(_FlushHook(self))
+        return self
+
+    def __exit__(self, exc_type, exc_val, trace):
+        try:
+            self.flush()
+        finally:
+            self.__restore_hooks(self.__prev_hooks)
+            self.__prev_hooks = None
+
+        if exc_type is None:
+            self.raise_for_errors()
+
+    @property
+    def ctrl_interface(self):
+        return self.__ctrl_if
+
+    @property
+    def num_pending(self):
+        """Number of queued commands not sent yet"""
+        return len(self.__pending)
+
+    def call(self, func, *args, **kwargs):
+        """Queue a call of a method of RftoolCommand / AwgSaCommand.
+
+        Errors raised by the call before its command is queued, and errors
+        of calls which run immediately, are raised here.
+
+        Returns
+        -------
+        handle : BatchedCall
+            Handle to get the result of the call.
+        """
+        handle = BatchedCall(self, func)
+        steps = self.__pipelined_steps(func, args, kwargs)
+        if steps is not None:
+            handle._queue(steps)
+            self.__pending.append(handle)
+        else:
+            self.flush()
+            prev_hooks = self.__set_hooks(_FlushHook(self))
+            try:
+                handle._invoke(func, args, kwargs)
+            finally:
+                self.__restore_hooks(prev_hooks)
+            # the call has finished without being queued
+            handle.result()
+
+        self.__calls.append(handle)
+        if len(self.__pending) >= self.MAX_PENDING_COMMANDS:
+            self.flush()
+        return handle
+
+    def flush(self):
+        """Send the queued commands and complete the calls with their responses."""
+        pending, self.__pending = self.__pending, []
+        if not pending:
+            return
+
+        prev_hooks = self.__set_hooks(None)
+        try:
+            responses = self.__ctrl_if.put_pipelined(
+                [handle.command for handle in pending])
+        except Exception as e:
+            for handle in pending:
+                handle._resolve(e)
+            raise
+        finally:
+            self.__restore_hooks(prev_hooks)
+
+        self.__logger.debug(
+            "CommandBatch flushed {} commands".format(len(pending)))
+        for handle, response in zip(pending, responses):
+            handle._resolve(response)
+
+    def raise_for_errors(self):
+        """Raise the first error of the calls not retrieved yet."""
+        self.flush()
+        for handle in self.__calls:
+            exception = handle._unretrieved_exception()
+            if exception is not None:
+                handle.exception()
+                raise exception
+
+    @staticmethod
+    def __pipelined_steps(func, args, kwargs):
+        """Return the generator of the build and parse parts of func, or None if func cannot be queued"""
+        owner = getattr(func, "__self__", None)
+        steps = getattr(getattr(func, "__func__", None), "pipelined_steps", None)
+        if owner is None or steps is None:
+            return None
+        return steps(owner, *args, **kwargs)
+
+    def __set_hooks(self, hook):
+        return (self.__ctrl_if._set_hook(hook), self.__data_if._set_hook(hook))
+
+    def __restore_hooks(self, hooks):
+        ctrl_hook, data_hook = hooks
+        self.__ctrl_if._set_hook(ctrl_hook)
+        self.__data_if._set_hook(data_hook)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import bisect
+import copy
+import threading
+
+"""
+cmdstats.py
+    - Per-command latency and byte-count statistics
+"""
+
+
+class CommandStat(object):
+    """Statistics of one command name"""
+
+    # Upper bounds (s) of the buckets of the wall time histogram.
+    # 10 us to about 10 s in powers of 2.  Longer commands fall in the last bucket.
+    BUCKET_BOUNDS = tuple(10e-6 * (1 << i) for i in range(21))
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.min_time = float("inf")
+        self.max_time = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.histogram = [0] * (len(self.BUCKET_BOUNDS) + 1)
+
+    def __repr__(self):
+        return "<CommandStat {} count={} errors={} mean={:.3g}s>".format(
+            self.name, self.count, self.errors, self.mean_time)
+
+    def add(self, elapsed, bytes_sent, bytes_received, failed):
+        self.count += 1
+        self.errors += int(bool(failed))
+        self.total_time += elapsed
+        self.min_time = min(self.min_time, elapsed)
+        self.max_time = max(self.max_time, elapsed)
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.histogram[self.__bucket(elapsed)] += 1
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """Wall time (s) below which q percent of the commands completed.
+
+        The value is the upper bound of the histogram bucket, so it is
+        accurate to a factor of 2.
+        """
+        if not (0 <= q <= 100):
+            raise ValueError("invalid percentile {}".format(q))
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, num in enumerate(self.histogram):
+            seen += num
+            if num and seen >= rank:
+                bound = self.BUCKET_BOUNDS[i] if i < len(self.BUCKET_BOUNDS) else self.max_time
+                return min(max(bound, self.min_time), self.max_time)
+        return self.max_time
+
+    def to_dict(self):
+        return {
+            "count" : self.count,
+            "errors" : self.errors,
+            "total_time" : self.total_time,
+            "mean_time" : self.mean_time,
+            "min_time" : self.min_time if self.count else 0.0,
+            "max_time" : self.max_time,
+            "p50" : self.percentile(50),
+            "p90" : self.percentile(90),
+            "p99" : self.percentile(99),
+            "bytes_sent" : self.bytes_sent,
+            "bytes_received" : self.bytes_received,
+            "histogram" : list(self.histogram),
+        }
+
+    def __bucket(self, elapsed):
+        return bisect.bisect_left(self.BUCKET_BOUNDS, elapsed)
+
+
+class CommandStats(object):
+    """Instrument of RftoolInterface which aggregates statistics per command name.
+
+    client.enable_stats()
+    ...
+    print(client.stats().report())
+    client.reset_stats()
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__stats = {}
+
+    def __getitem__(self, name):
+        return self.__stats[name]
+
+    def __contains__(self, name):
+        return name in self.__stats
+
+    def __iter__(self):
+        return iter(list(self.__stats))
+
+    def __len__(self):
+        return len(self.__stats)
+
+    def record(self, command, elapsed, bytes_sent, bytes_received, failed):
+        """Called by RftoolInterface when a command has completed."""
+        with self.__lock:
+            stat = self.__stats.get(command)
+            if stat is None:
+                stat = self.__stats[command] = CommandStat(command)
+            stat.add(elapsed, bytes_sent, bytes_received, failed)
+
+    def reset(self):
+        with self.__lock:
+            self.__stats = {}
+
+    def snapshot(self):
+        """Return a copy which is not updated any more."""
+        snapshot = CommandStats()
+        with self.__lock:
+            snapshot.__stats = copy.deepcopy(self.__stats)
+        return snapshot
+
+    @property
+    def total_time(self):
+        return sum(stat.total_time for stat in self.__stats.values())
+
+    def to_dict(self):
+        """{command name -> statistics}  (for JSON)"""
+        return {name : stat.to_dict() for name, stat in self.__stats.items()}
+
+    def report(self):
+        """Return a table of the commands in descending order of total time."""
+        lines = ["{:<28s} {:>7s} {:>6s} {:>10s} {:>10s} {:>10s} {:>12s} {:>12s}".format(
+            "command", "count", "errors", "total[ms]", "mean[ms]", "p99[ms]", "sent[B]", "recv[B]")]
+        stats = sorted(self.__stats.values(), key = lambda stat: stat.total_time, reverse = True)
+        for stat in stats:
+            lines.append("{:<28s} {:>7d} {:>6d} {:>10.3f} {:>10.3f} {:>10.3f} {:>12d} {:>12d}".format(
+                stat.name, stat.count, stat.errors, stat.total_time * 1e3,
+                stat.mean_time * 1e3, stat.percentile(99) * 1e3,
+                stat.bytes_sent, stat.bytes_received))
+        return "\n".join(lines)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import functools
 
 """
 cmdutil.py
@@ -40,3 +41,54 @@ class CmdUtil:
             except ValueError:
                 ret.append(str_resp)
         return ret
+
+    @classmethod
+    def check_recv_buffer(cls, out, size = 0):
+        """out が size バイト以上の書き込み可能で C-contiguous なバッファであるか調べる"""
+        try:
+            view = memoryview(out).cast("B")
+        except TypeError:
+            raise ValueError(
+                "'out' must be a C-contiguous bytes-like object, but {} found".format(type(out)))
+
+        if view.readonly:
+            raise ValueError("'out' must be writable.")
+
+        if view.nbytes < size:
+            raise ValueError(
+                "'out' is too small to store the data.  ({} < {} bytes)".format(view.nbytes, size))
+
+        return view.nbytes
+
+
+def pipelined(method):
+    """Decorator of the command methods which send exactly one control command.
+
+    method is written as a generator function in two parts.  It checks its
+    arguments and yields the command (build), then receives the response of
+    the command from the yield and returns the result (parse).  It must not
+    send or receive anything itself.
+
+    The decorated method puts the command with self._put_command and
+    returns the parsed result.  CommandBatch runs the two parts separately
+    (method.pipelined_steps), so that it can queue the command and send it
+    with others in one write.
+    """
+    @functools.wraps(method)
+    def put_and_parse(self, *args, **kwargs):
+        steps = method(self, *args, **kwargs)
+        command = next(steps)
+        return parse_pipelined(steps, self._put_command(command))
+
+    put_and_parse.pipelined_steps = method
+    return put_and_parse
+
+
+def parse_pipelined(steps, response):
+    """Pass response to the parse part of a method decorated with pipelined and return its result"""
+    try:
+        steps.send(response)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError("{} yielded more than one command".format(steps.__name__))
+
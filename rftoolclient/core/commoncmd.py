@@ -1,6 +1,11 @@
 import logging
+import socket
+import numpy as np
 import rftoolclient as rftc
 from .cmdutil import CmdUtil
+from . import capturefile
+from . import waitpolicy
+from rftoolclient.stimgen.memorymap import StgMasterCtrlRegs, DigitalOutMasterCtrlRegs
 
 class CommonCommand(object):
 
@@ -12,9 +17,11 @@ class CommonCommand(object):
         self.__rft_data_if = data_interface
         self.__joinargs = CmdUtil.joinargs
         self.__stim_reg_access = StimRegAccess(ctrl_interface, data_interface)
+        self.__data_reconnector = None
+        self.__last_transfer_retries = 0
 
 
-    def read_dram(self, offset, size, show_progress = False):
+    def read_dram(self, offset, size, show_progress = False, *, out = None, max_retries = 0, segment_size = 0x4000000):
         """
         PL に接続された外部 DRAM の任意のアドレスからデータを読み取る.
         
@@ -24,11 +31,22 @@ class CommonCommand(object):
             データを取得する DRAM 内部のアドレス.
         size : int
             読み取るサイズ (Bytes)
+        out : 書き込み可能な bytes-like object (bytearray, numpy.ndarray, numpy.memmap など)
+            指定した場合, 読み取ったデータを中間バッファを介さずに out の先頭から直接格納する.
+            out のサイズは size 以上でなければならない.
+        max_retries : int
+            1 以上を指定した場合, segment_size バイトずつ区切って読み取る.
+            タイムアウトなどの通信エラーで読み取りに失敗した場合は, データ用のソケットを再接続して,
+            失敗した区間から読み取りをやり直す.  やり直すのは全体で max_retries 回まで.
+            やり直した回数は last_transfer_retries で参照できる.
+        segment_size : int
+            max_retries が 1 以上の場合に, 1 回の ReadDram で読み取るサイズ (Bytes)
         
         Returns
         -------
-        data : bytes
-            DRAM のデータ
+        data : bytes, bytearray or int
+            DRAM のデータ.  max_retries を指定した場合は, 区間ごとに直接格納した bytearray.
+            out を指定した場合は, out に格納したバイト数.
         """
         if (not isinstance(offset, int) or (offset < 0 or 0xFFFFFFFF < offset)):
             raise ValueError("invalid offset " + str(offset))
@@ -38,12 +56,36 @@ class CommonCommand(object):
                 "invalid read addr range  ({} - {})\n".format(offset, size + offset - 1) + 
                 "The valid one is 0 to {}.".format(rftc.PL_DDR4_RAM_SIZE - 1))
 
+        if out is not None:
+            CmdUtil.check_recv_buffer(out, size)
+
+        if max_retries:
+            buf = bytearray(size) if out is None else out
+            view = memoryview(buf).cast("B")
+            try:
+                self.__run_segments(
+                    offset, size, segment_size, max_retries,
+                    lambda seg_offset, pos, seg_size: self.__read_dram(
+                        seg_offset, seg_size, show_progress, view[pos : pos + seg_size]))
+            finally:
+                view.release()
+            # bytes に変換するとピークメモリが倍になるので, 受信したバッファをそのまま返す
+            return buf if out is None else size
+
+        return self.__read_dram(offset, size, show_progress, out)
+
+
+    def __read_dram(self, offset, size, show_progress, out):
         command = self.__joinargs("ReadDram", [offset, size])
         self.__rft_data_if.send_command(command)
         res = self.__rft_data_if.recv_response().rstrip('\r\n') # キャプチャデータの前のコマンド成否レスポンス  AWG_SUCCESS/AWG_FAILURE
         if (res == "AWG_SUCCESS"):
-            data = self.__rft_data_if.recv_data(
-                size, bufsize = 0x400000, show_progress = show_progress)
+            if out is None:
+                data = self.__rft_data_if.recv_data(
+                    size, bufsize = 0x400000, show_progress = show_progress)
+            else:
+                data = self.__rft_data_if.recv_data_into(
+                    out, size, bufsize = 0x400000, show_progress = show_progress)
             res = self.__rft_data_if.recv_response() # end of capture data
 
         res = self.__rft_data_if.recv_response() # end of 'ReadDram' command
@@ -53,7 +95,122 @@ class CommonCommand(object):
         return data
 
 
-    def write_dram(self, offset, data, show_progress = False):
+    def iter_dram(self, offset, size, chunk_size = 0x1000000):
+        """
+        PL に接続された外部 DRAM の任意のアドレスからデータを chunk_size バイトずつ読み取るイテレータを作る.
+        読み取ったデータは 1 チャンクずつ numpy.ndarray (uint8) として返される.
+        各チャンクは 1 回の ReadDram で読み取るので, 途中で読み取りをやめてもよく,
+        チャンクを受け取ってから次のチャンクを要求するまでの間は他のコマンドを送ってもよい.
+
+        全てのチャンクは同じバッファに格納されるため, 返されたチャンクの内容は次のチャンクを読み取ると上書きされる.
+        チャンクを残しておく場合はコピーすること.
+
+        Parameters
+        ----------
+        offset : int
+            データを取得する DRAM 内部のアドレス.
+        size : int
+            読み取るサイズ (Bytes)
+        chunk_size : int
+            1 チャンクのサイズ (Bytes).  最後のチャンクはこれより小さい場合がある.
+
+        Returns
+        -------
+        chunks : iterator of numpy.ndarray
+            DRAM のデータを先頭から chunk_size バイトずつ返すイテレータ
+        """
+        if (not isinstance(offset, int) or (offset < 0 or 0xFFFFFFFF < offset)):
+            raise ValueError("invalid offset " + str(offset))
+
+        if (not isinstance(size, int) or (size <= 0 or rftc.PL_DDR4_RAM_SIZE < (size + offset))):
+            raise ValueError(
+                "invalid read addr range  ({} - {})\n".format(offset, size + offset - 1) + 
+                "The valid one is 0 to {}.".format(rftc.PL_DDR4_RAM_SIZE - 1))
+
+        if (not isinstance(chunk_size, int) or chunk_size <= 0):
+            raise ValueError("invalid chunk_size " + str(chunk_size))
+
+        return self.__iter_dram(offset, size, chunk_size)
+
+
+    def __iter_dram(self, offset, size, chunk_size):
+        buf = np.empty(min(chunk_size, size), dtype = np.uint8)
+        end = offset + size
+        while offset < end:
+            num_bytes = min(chunk_size, end - offset)
+            self.read_dram(offset, num_bytes, out = buf)
+            yield buf[:num_bytes]
+            offset += num_bytes
+
+
+    def save_dram(self, path, offset, size, *, chunk_size = 0x1000000, dtype = np.uint8, shape = None, metadata = None, max_retries = 0):
+        """
+        PL に接続された外部 DRAM の任意のアドレスからデータを読み取り, .npy ファイルに直接書き込む.
+        データはファイルをメモリマップした領域に chunk_size バイトずつ受信し, 受信するたびにファイルに書き出す.
+        そのため, 空きメモリより大きなデータも保存できる.
+
+        .npy ファイルのヘッダには dtype と shape が書かれる.
+        DRAM のアドレスとサイズ, および metadata は, path に '.json' を付けた名前のファイルに書かれる.
+        このファイルは全てのデータを書き込んだ後に作られる.
+        保存したデータは load_capture_file で読み込める.
+
+        Parameters
+        ----------
+        path : str or path-like
+            データを保存する .npy ファイルのパス
+        offset : int
+            データを取得する DRAM 内部のアドレス.
+        size : int
+            読み取るサイズ (Bytes)
+        chunk_size : int
+            1 回の ReadDram で読み取るサイズ (Bytes)
+        dtype : numpy.dtype
+            保存するデータの型
+        shape : tuple of int
+            保存するデータの形状.  None の場合は 1 次元.
+        metadata : dict
+            データと一緒に保存する情報.  JSON に変換できる値のみを含むこと.
+        max_retries : int
+            通信エラーで読み取りに失敗したチャンクを, データ用のソケットを再接続して読み取り直す回数の上限.
+            read_dram を参照.
+
+        Returns
+        -------
+        data : numpy.memmap
+            保存したデータ
+        """
+        if (not isinstance(offset, int) or (offset < 0 or 0xFFFFFFFF < offset)):
+            raise ValueError("invalid offset " + str(offset))
+
+        if (not isinstance(size, int) or (size <= 0 or rftc.PL_DDR4_RAM_SIZE < (size + offset))):
+            raise ValueError(
+                "invalid read addr range  ({} - {})\n".format(offset, size + offset - 1) + 
+                "The valid one is 0 to {}.".format(rftc.PL_DDR4_RAM_SIZE - 1))
+
+        if (not isinstance(chunk_size, int) or chunk_size <= 0):
+            raise ValueError("invalid chunk_size " + str(chunk_size))
+
+        dtype = np.dtype(dtype)
+        if shape is None:
+            shape = (size // dtype.itemsize,)
+        if int(np.prod(shape)) * dtype.itemsize != size:
+            raise ValueError(
+                "The size of dtype {} and shape {} is not {} bytes.".format(dtype, shape, size))
+
+        data = capturefile.open_capture_file(path, dtype, shape)
+        view = data.reshape(-1).view(np.uint8)
+        def read_chunk(chunk_offset, pos, num_bytes):
+            self.__read_dram(chunk_offset, num_bytes, False, view[pos : pos + num_bytes])
+            data.flush()
+        self.__run_segments(offset, size, chunk_size, max_retries, read_chunk)
+
+        info = {"dram_offset" : offset, "size" : size, "dtype" : dtype.str, "shape" : list(shape)}
+        info.update(metadata or {})
+        capturefile.write_metadata(path, info)
+        return data
+
+
+    def write_dram(self, offset, data, show_progress = False, *, max_retries = 0, segment_size = 0x4000000):
         """
         PL に接続された外部 DRAM の任意のアドレスにデータを書き込む.
         
@@ -61,21 +218,42 @@ class CommonCommand(object):
         ----------
         offset : int
             データを書き込む DRAM 内部のアドレス.
-        data : bytes
-            書き込みデータ
+        data : bytes-like object
+            書き込みデータ. bytes, bytearray の他, numpy.ndarray や mmap などバッファプロトコルをサポートするオブジェクトを指定できる.
+            送信スループット (MB/s) は, データ通信用の RftoolInterface の send_throughput で参照できる.
+        max_retries : int
+            1 以上を指定した場合, segment_size バイトずつ区切って書き込む.
+            通信エラーで書き込みに失敗した場合は, データ用のソケットを再接続して, 失敗した区間から書き込みをやり直す.
+            read_dram を参照.
+        segment_size : int
+            max_retries が 1 以上の場合に, 1 回の WriteDram で書き込むサイズ (Bytes)
         """
         if (not isinstance(offset, int) or (offset < 0 or 0xFFFFFFFF < offset)):
             raise ValueError("invalid offset " + str(offset))
         
-        if (not isinstance(data, (bytes, bytearray))):
-            raise ValueError("invalid write data type {}",format(type(data)))
+        try:
+            size = memoryview(data).nbytes
+        except TypeError:
+            raise ValueError("invalid write data type {}".format(type(data)))
 
-        size = len(data)
         if (not isinstance(size, int) or (size <= 0 or rftc.PL_DDR4_RAM_SIZE < (size + offset))):
             raise ValueError(
                 "invalid write addr range  ({} - {})\n".format(offset, size + offset - 1) + 
                 "The valid one is 0 to {}.".format(rftc.PL_DDR4_RAM_SIZE - 1))
 
+        if max_retries:
+            view = memoryview(data).cast("B")
+            self.__run_segments(
+                offset, size, segment_size, max_retries,
+                lambda seg_offset, pos, seg_size: self.__write_dram(
+                    seg_offset, view[pos : pos + seg_size], seg_size, show_progress))
+            return data
+
+        self.__write_dram(offset, data, size, show_progress)
+        return data
+
+
+    def __write_dram(self, offset, data, size, show_progress):
         command = self.__joinargs("WriteDram", [offset, size])
         self.__rft_data_if.send_command(command)
         res = self.__rft_data_if.recv_response().rstrip('\r\n') # キャプチャデータの前のコマンド成否レスポンス  AWG_SUCCESS/AWG_FAILURE
@@ -87,7 +265,48 @@ class CommonCommand(object):
         if res[:5] == "ERROR":
             raise rftc.RftoolExecuteCommandError(res)
 
-        return data
+
+    def set_data_reconnector(self, reconnector):
+        """
+        データ用のソケットを再接続する関数を登録する.
+        read_dram, write_dram, save_dram は, 通信エラーの後でこの関数を引数なしで呼んでから転送をやり直す.
+        """
+        self.__data_reconnector = reconnector
+
+
+    @property
+    def last_transfer_retries(self):
+        """直前に max_retries を指定して行った DRAM の転送で, 通信エラーのためにやり直した回数"""
+        return self.__last_transfer_retries
+
+
+    def __run_segments(self, offset, size, segment_size, max_retries, transfer):
+        """
+        offset から size バイトの範囲を segment_size バイトずつ区切って, transfer(区間のアドレス, 区間の先頭の位置, 区間のサイズ) を呼ぶ.
+        通信エラーで失敗した区間は, データ用のソケットを再接続してからやり直す.
+        """
+        if (not isinstance(max_retries, int) or max_retries < 0):
+            raise ValueError("invalid max_retries " + str(max_retries))
+
+        if (not isinstance(segment_size, int) or segment_size <= 0):
+            raise ValueError("invalid segment_size " + str(segment_size))
+
+        self.__last_transfer_retries = 0
+        pos = 0
+        while pos < size:
+            seg_size = min(segment_size, size - pos)
+            try:
+                transfer(offset + pos, pos, seg_size)
+            except (ConnectionError, socket.timeout) as e:
+                if self.__data_reconnector is None or self.__last_transfer_retries >= max_retries:
+                    raise
+                self.__last_transfer_retries += 1
+                self.__logger.warning(
+                    "DRAM transfer failed at offset {} ({}).  Reconnecting and retrying ({}/{})."
+                    .format(offset + pos, e, self.__last_transfer_retries, max_retries))
+                self.__data_reconnector()
+                continue
+            pos += seg_size
 
 
     def sync_dac_tiles(self):
@@ -116,10 +335,75 @@ class CommonCommand(object):
 class StimRegAccess:
     __REG_SIZE = 4 # bytes
 
+    # シャドウレジスタに値を保持するレジスタ.
+    # このクライアントだけが値を変更し, ハードウェアが値を変えない制御レジスタとマスクレジスタ.
+    # ステータスレジスタ (DONE/BUSY/READY など) はここに含めてはならない.
+    __SHADOWABLE_REGS = frozenset(
+        [StgMasterCtrlRegs.ADDR + offset for offset in [
+            StgMasterCtrlRegs.Offset.CTRL_TARGET_SEL,
+            StgMasterCtrlRegs.Offset.EXT_START_TRIG_ON,
+            StgMasterCtrlRegs.Offset.EXT_START_TRIG_ENABLE]] +
+        [DigitalOutMasterCtrlRegs.ADDR + offset for offset in [
+            DigitalOutMasterCtrlRegs.Offset.CTRL_TARGET_SEL_0,
+            DigitalOutMasterCtrlRegs.Offset.CTRL_TARGET_SEL_1,
+            DigitalOutMasterCtrlRegs.Offset.START_TRIG_MASK_0,
+            DigitalOutMasterCtrlRegs.Offset.START_TRIG_MASK_1,
+            DigitalOutMasterCtrlRegs.Offset.RESTART_TRIG_MASK_0,
+            DigitalOutMasterCtrlRegs.Offset.RESTART_TRIG_MASK_1,
+            DigitalOutMasterCtrlRegs.Offset.PAUSE_TRIG_MASK_0,
+            DigitalOutMasterCtrlRegs.Offset.PAUSE_TRIG_MASK_1,
+            DigitalOutMasterCtrlRegs.Offset.RESUME_TRIG_MASK_0,
+            DigitalOutMasterCtrlRegs.Offset.RESUME_TRIG_MASK_1]])
+
     def __init__(self, ctrl_interface, data_interface):
         self.__rft_ctrl_if = ctrl_interface
         self.__rft_data_if = data_interface
         self.__joinargs = CmdUtil.joinargs
+        self.__shadow = None # {addr -> val}.  None のときシャドウレジスタは無効
+
+
+    def enable_shadow_regs(self, enable = True):
+        """
+        シャドウレジスタを有効 / 無効にする.
+
+        | 有効にすると, 一括制御の対象を選択するレジスタやトリガのマスクレジスタなど
+        | このクライアントだけが値を変更するレジスタの値を手元に保持し, その読み出しを通信無しで済ませる.
+        | 書き込みは常にハードウェアにも行われる (ライトスルー).
+        | ステータスレジスタは常にハードウェアから読み出す.
+        | 他のクライアントが同じレジスタを書き換える場合は有効にしてはならない.
+
+        Parameters
+        ----------
+        enable : bool
+            True -> 有効にする.  False -> 無効にし, 保持していた値を破棄する.
+        """
+        self.__shadow = {} if enable else None
+
+
+    @property
+    def shadow_regs_enabled(self):
+        return self.__shadow is not None
+
+
+    def invalidate_shadow_regs(self):
+        """
+        シャドウレジスタに保持している値を全て破棄する.
+        レジスタがリセットされたとき (FPGA のコンフィギュレーション, STG のリセットなど) に呼ぶ.
+        """
+        if self.__shadow is not None:
+            self.__shadow.clear()
+
+
+    def transaction(self):
+        """
+        レジスタの書き込みと, ビットが特定の値になるまでの待ちをまとめて実行する StimRegTransaction を作成する.
+
+        Returns
+        -------
+        transaction : StimRegTransaction
+        """
+        return StimRegTransaction(self, self.__rft_ctrl_if)
+
 
     def write(self, addr, val):
         self.write_multi(addr, *[val])
@@ -132,12 +416,28 @@ class StimRegAccess:
             wr_data += val.to_bytes(self.__REG_SIZE, 'little')
 
         command = self.__joinargs('WriteStimRegs', [addr, len(wr_data)])
-        self.__rft_data_if.PutCmdWithData(command, wr_data, bufsize = 0x4000)
+        try:
+            self.__rft_data_if.PutCmdWithData(command, wr_data, bufsize = 0x4000)
+        except Exception:
+            self.__discard_shadow(addr, len(vals))
+            raise
+
+        if self.__shadow is not None:
+            for i, val in enumerate(vals):
+                reg_addr = addr + i * self.__REG_SIZE
+                if reg_addr in self.__SHADOWABLE_REGS:
+                    self.__shadow[reg_addr] = val & ((1 << (self.__REG_SIZE * 8)) - 1)
 
 
     def write_bits(self, addr, bit_offset, bit_len, val):
         command = self.__joinargs('WriteStimRegBits', [addr, bit_offset, bit_len, val])
-        self.__rft_ctrl_if.put(command)
+        try:
+            self.__rft_ctrl_if.put(command)
+        except Exception:
+            self.__discard_shadow(addr, 1)
+            raise
+
+        self._update_shadow_bits(addr, bit_offset, bit_len, val)
 
 
     def read(self, addr):
@@ -145,6 +445,11 @@ class StimRegAccess:
 
 
     def read_multi(self, addr, num_regs):
+        if self.__shadow is not None:
+            addr_list = [addr + i * self.__REG_SIZE for i in range(num_regs)]
+            if all(reg_addr in self.__shadow for reg_addr in addr_list):
+                return [self.__shadow[reg_addr] for reg_addr in addr_list]
+
         len = num_regs * self.__REG_SIZE
         command = self.__joinargs('ReadStimRegs', [addr, len])
         self.__rft_data_if.send_command(command)
@@ -153,11 +458,272 @@ class StimRegAccess:
         if res[:5] == "ERROR":
             raise rftc.RftoolExecuteCommandError(res)
 
-        return [
+        vals = [
             int.from_bytes(reg_data[i * self.__REG_SIZE : (i + 1) * self.__REG_SIZE], 'little') 
             for i in range(num_regs)]
 
+        if self.__shadow is not None:
+            for i, val in enumerate(vals):
+                reg_addr = addr + i * self.__REG_SIZE
+                if reg_addr in self.__SHADOWABLE_REGS:
+                    self.__shadow[reg_addr] = val
+        return vals
+
+
+    def read_bits_multi(self, fields):
+        """
+        複数のレジスタのビットフィールドを読み出す.
+
+        | 読み出しコマンドは制御用ソケットにパイプライン化して送られるので,
+        | 通信の往復はフィールドの数によらず 1 回で済む.
+
+        Parameters
+        ----------
+        fields : list of (int, int, int)
+            (アドレス, ビットフィールドの LSB の位置, ビットフィールドのビット幅) のリスト
+
+        Returns
+        -------
+        vals : list of int
+            fields の順に並んだ読み出し値
+        """
+        vals = [None] * len(fields)
+        cmd_idx = []
+        commands = []
+        for i, (addr, bit_offset, bit_len) in enumerate(fields):
+            if self.__shadow is not None and addr in self.__shadow:
+                vals[i] = (self.__shadow[addr] >> bit_offset) & ((1 << bit_len) - 1)
+            else:
+                cmd_idx.append(i)
+                commands.append(self.__joinargs('ReadStimRegBits', [addr, bit_offset, bit_len]))
+
+        results = self.__rft_ctrl_if.put_pipelined(commands) if commands else []
+        for i, res in zip(cmd_idx, results):
+            if isinstance(res, Exception):
+                raise res
+            vals[i] = int(res)
+        return vals
+
 
     def read_bits(self, addr, bit_offset, bit_len):
+        if self.__shadow is not None and addr in self.__shadow:
+            return (self.__shadow[addr] >> bit_offset) & ((1 << bit_len) - 1)
+
         command = self.__joinargs('ReadStimRegBits', [addr, bit_offset, bit_len])
         return int(self.__rft_ctrl_if.put(command))
+
+
+    def _update_shadow_bits(self, addr, bit_offset, bit_len, val):
+        """ハードウェアのレジスタのビットを書き換えた後に呼ぶ"""
+        if self.__shadow is not None and addr in self.__shadow:
+            mask = ((1 << bit_len) - 1) << bit_offset
+            self.__shadow[addr] = (self.__shadow[addr] & ~mask) | ((val << bit_offset) & mask)
+
+
+    def _discard_shadow(self, addr, num_regs = 1):
+        self.__discard_shadow(addr, num_regs)
+
+
+    def __discard_shadow(self, addr, num_regs):
+        """書き込みに失敗したレジスタの値は不明になるので破棄する"""
+        if self.__shadow is not None:
+            for i in range(num_regs):
+                self.__shadow.pop(addr + i * self.__REG_SIZE, None)
+
+
+class StimRegTransaction:
+    """
+    Stimulus Generator とディジタル出力モジュールのレジスタ操作をまとめて実行するクラス.
+
+    | 追加したレジスタ操作は execute を呼んだときに, 制御用ソケットにパイプライン化して送られる.
+    | 各操作の完了を待たずに次の操作を送るので, 個別に送る場合と比べて通信の往復回数が大幅に減る.
+    | wait_until_bits で追加した待ちの前後で送信は区切られ, 待ちの後の操作は条件が満たされてから送られる.
+    | 条件を調べる最初の読み出しは, 待ちの前の操作と一緒に送られる.
+    | レジスタには 1 ビット単位のフィールドを読み書きするコマンド (WriteStimRegBits / ReadStimRegBits) でアクセスする.
+
+    例::
+
+        transaction = reg_access.transaction()
+        transaction.write_bits(CTRL, PREPARE, 1, 1)
+        transaction.wait_until_bits([(STATUS, READY, 1, 1)], 5, StgTimeoutError('STG ready timed out'))
+        transaction.pulse(CTRL, START)
+        transaction.execute()
+    """
+    __REG_SIZE = 32 # bits
+
+    def __init__(self, reg_access, ctrl_interface):
+        self.__reg_access = reg_access
+        self.__rft_ctrl_if = ctrl_interface
+        self.__joinargs = CmdUtil.joinargs
+        self.__wait_policy = waitpolicy.WaitPolicy()
+        self.__steps = []
+
+
+    def write_bits(self, addr, bit_offset, bit_len, val):
+        """
+        レジスタの特定のビットに値を書き込む操作を追加する.
+
+        Parameters
+        ----------
+        addr : int
+            書き込むレジスタのアドレス
+        bit_offset : int
+            書き込むビットフィールドの LSB の位置
+        bit_len : int
+            書き込むビットフィールドのビット幅
+        val : int
+            書き込む値
+        """
+        self.__steps.append(('write', (addr, bit_offset, bit_len, val)))
+        return self
+
+
+    def pulse(self, addr, bit_pos):
+        """
+        レジスタの特定のビットを 0 -> 1 -> 0 と変化させる操作を追加する.
+
+        Parameters
+        ----------
+        addr : int
+            書き込むレジスタのアドレス
+        bit_pos : int
+            値を変化させるビットの位置
+        """
+        for val in (0, 1, 0):
+            self.write_bits(addr, bit_pos, 1, val)
+        return self
+
+
+    def wait_until_bits(self, conditions, timeout, error):
+        """
+        全ての条件が満たされるまで, 以降の操作の実行を待つ.
+
+        Parameters
+        ----------
+        conditions : list of (int, int, int, int)
+            (アドレス, ビットフィールドの LSB の位置, ビットフィールドのビット幅, 期待値) のリスト.
+            全てのビットフィールドが期待値になったとき, 待ちを終了する.
+        timeout : int or float
+            タイムアウト値 (単位: 秒)
+        error : Exception
+            タイムアウトした場合に送出する例外
+        """
+        return self.__add_wait(list(conditions), timeout, error)
+
+
+    def wait_until_masked(self, addr, mask, expected, timeout, error):
+        """
+        レジスタの値と mask の論理積が期待値になるまで, 以降の操作の実行を待つ.
+
+        | mask の各ビットを 1 ビットずつ読み出して調べる.  読み出しは全て 1 回の送信にまとめられる.
+
+        Parameters
+        ----------
+        addr : int
+            調べるレジスタのアドレス
+        mask : int
+            調べるビットを 1 にしたビットマスク
+        expected : int
+            レジスタの値と mask の論理積の期待値
+        timeout : int or float
+            タイムアウト値 (単位: 秒)
+        error : Exception
+            タイムアウトした場合に送出する例外
+        """
+        return self.__add_wait(
+            [(addr, bit, 1, (expected >> bit) & 1)
+             for bit in range(self.__REG_SIZE) if (mask >> bit) & 1],
+            timeout, error)
+
+
+    def __add_wait(self, conditions, timeout, error):
+        if (not isinstance(timeout, (int, float))) or (timeout < 0):
+            raise ValueError('Invalid timeout {}'.format(timeout))
+        self.__steps.append(('wait', (conditions, timeout, error)))
+        return self
+
+
+    def sleep(self, seconds):
+        """
+        それまでに追加した操作を実行した後, 指定した時間待ってから以降の操作を実行する.
+
+        Parameters
+        ----------
+        seconds : int or float
+            待ち時間 (単位: 秒)
+        """
+        self.__steps.append(('sleep', seconds))
+        return self
+
+
+    def execute(self):
+        """
+        追加したレジスタ操作を実行する.
+        
+        | 操作は待ちと sleep で区切られた区間ごとにまとめて送られる.
+        | 区間の中の操作は前の操作の結果を待たずに送られるので, ある操作が失敗しても同じ区間の後続の操作は実行される.
+        | 失敗した操作があった場合は, その区間の応答を全て受信した後, 以降の区間を送らずに RftoolExecuteCommandError を送出する.
+        | 待ちの条件は WaitPolicy に従って, 間隔を広げながら調べる.
+        | 待ちがタイムアウトした場合は, wait_until_bits で指定した例外を送出する.
+        """
+        steps, self.__steps = self.__steps, []
+        writes = []
+        for kind, args in steps:
+            if kind == 'write':
+                writes.append(args)
+                continue
+
+            if kind == 'sleep':
+                self.__send(writes, [])
+                writes = []
+                waitpolicy.sleep(args)
+                continue
+
+            conditions, timeout, error = args
+            delays = self.__wait_policy.delays(timeout)
+            next(delays)
+            # 待ちの前の書き込みと, 条件を調べる最初の読み出しを一緒に送る
+            pending = self.__send(writes, conditions)
+            writes = []
+            for delay in delays:
+                if not pending:
+                    break
+                waitpolicy.sleep(delay)
+                pending = self.__send([], pending)
+            if pending:
+                raise error
+
+        self.__send(writes, [])
+
+
+    def __send(self, writes, conditions):
+        """
+        書き込みと読み出しをパイプライン化して送り, 満たされていない条件のリストを返す
+        """
+        if not writes and not conditions:
+            return []
+
+        commands = [self.__joinargs('WriteStimRegBits', list(write)) for write in writes]
+        commands += [
+            self.__joinargs('ReadStimRegBits', [addr, bit_offset, bit_len])
+            for addr, bit_offset, bit_len, *_ in conditions]
+        try:
+            results = self.__rft_ctrl_if.put_pipelined(commands)
+        except Exception:
+            for addr, *_ in writes:
+                self.__reg_access._discard_shadow(addr)
+            raise
+
+        for write, res in zip(writes, results):
+            if isinstance(res, Exception):
+                self.__reg_access._discard_shadow(write[0])
+            else:
+                self.__reg_access._update_shadow_bits(*write)
+
+        errors = [res for res in results if isinstance(res, Exception)]
+        if errors:
+            raise errors[0]
+
+        return [
+            cond for cond, res in zip(conditions, results[len(writes):])
+            if int(res) != cond[3]]
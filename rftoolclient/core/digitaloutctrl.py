@@ -3,6 +3,7 @@ import rftoolclient.stimgen as sg
 import rftoolclient as rftc
 from rftoolclient.stimgen.memorymap import (
     DigitalOutMasterCtrlRegs, DigitalOutCtrlRegs, DigitalOutputDataListRegs)
+from .waitpolicy import WaitPolicy, CompletionTimes
 
 class DigitalOutCtrl:
     """ディジタル出力モジュールを制御するためのクラス"""
@@ -10,6 +11,9 @@ class DigitalOutCtrl:
     def __init__(self, common_cmd, logger=None):
         self.__logger = logger or rftc.get_null_logger()
         self.__reg_access = common_cmd.stim_reg_access
+        self.__wait_policy = WaitPolicy()
+        # ディジタル出力モジュールの動作の最短の完了時刻
+        self.__completion_times = CompletionTimes()
 
 
     def initialize(self, *dout_id_list):
@@ -24,6 +28,7 @@ class DigitalOutCtrl:
             rftc.log_error(e, self.__logger)
             raise
         
+        self.__reg_access.invalidate_shadow_regs()
         self.disable_trigger(sg.DigitalOutTrigger.all(), *dout_id_list)
         self.__deselect_ctrl_target(*dout_id_list)
         for dout_id in dout_id_list:
@@ -49,10 +54,12 @@ class DigitalOutCtrl:
             raise
         
         regs = []
+        total_time = 0
         for i in range(len(data_list)):
             bits, time = data_list[i]
             regs.append(bits)
             regs.append(time - 1)
+            total_time += time
         
         for dout_id in dout_id_list:
             base_addr = DigitalOutputDataListRegs.Addr.dout(dout_id)
@@ -64,6 +71,8 @@ class DigitalOutCtrl:
             self.__reg_access.write(addr, len(data_list))
             addr = base_addr + DigitalOutCtrlRegs.Offset.START_IDX
             self.__reg_access.write(addr, 0)
+            # 出力時間の単位はバージョンによって異なるので, 短い方の 10 [ns] で見積もる
+            self.__completion_times.set_duration(dout_id, total_time * 10e-9)
 
 
     def set_default_output_data(self, bits, *dout_id_list):
@@ -196,13 +205,8 @@ class DigitalOutCtrl:
             rftc.log_error(e, self.__logger)
             raise
         
-        self.__select_ctrl_target(*dout_id_list)
-        addr = DigitalOutMasterCtrlRegs.ADDR + DigitalOutMasterCtrlRegs.Offset.CTRL
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_START, 1, 0)
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_START, 1, 1)
-        time.sleep(10e-6)
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_START, 1, 0)   
-        self.__deselect_ctrl_target(*dout_id_list)
+        self.__pulse_ctrl_bit(DigitalOutMasterCtrlRegs.Bit.CTRL_START, 10e-6, *dout_id_list)
+        self.__completion_times.started(*dout_id_list)
 
 
     def pause_douts(self, *dout_id_list):
@@ -217,13 +221,7 @@ class DigitalOutCtrl:
             rftc.log_error(e, self.__logger)
             raise
 
-        self.__select_ctrl_target(*dout_id_list)
-        addr = DigitalOutMasterCtrlRegs.ADDR + DigitalOutMasterCtrlRegs.Offset.CTRL
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_PAUSE, 1, 0)
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_PAUSE, 1, 1)
-        time.sleep(10e-6)
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_PAUSE, 1, 0)   
-        self.__deselect_ctrl_target(*dout_id_list)
+        self.__pulse_ctrl_bit(DigitalOutMasterCtrlRegs.Bit.CTRL_PAUSE, 10e-6, *dout_id_list)
 
 
     def resume_douts(self, *dout_id_list):
@@ -238,13 +236,7 @@ class DigitalOutCtrl:
             rftc.log_error(e, self.__logger)
             raise
 
-        self.__select_ctrl_target(*dout_id_list)
-        addr = DigitalOutMasterCtrlRegs.ADDR + DigitalOutMasterCtrlRegs.Offset.CTRL
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_RESUME, 1, 0)
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_RESUME, 1, 1)
-        time.sleep(10e-6)
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_RESUME, 1, 0)
-        self.__deselect_ctrl_target(*dout_id_list)
+        self.__pulse_ctrl_bit(DigitalOutMasterCtrlRegs.Bit.CTRL_RESUME, 10e-6, *dout_id_list)
 
 
     def restart_douts(self, *dout_id_list):
@@ -261,13 +253,9 @@ class DigitalOutCtrl:
             rftc.log_error(e, self.__logger)
             raise
 
-        self.__select_ctrl_target(*dout_id_list)
-        addr = DigitalOutMasterCtrlRegs.ADDR + DigitalOutMasterCtrlRegs.Offset.CTRL
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_RESTART, 1, 0)
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_RESTART, 1, 1)
-        time.sleep(10e-6)
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_RESTART, 1, 0)
-        self.__deselect_ctrl_target(*dout_id_list)
+        self.__pulse_ctrl_bit(DigitalOutMasterCtrlRegs.Bit.CTRL_RESTART, 10e-6, *dout_id_list)
+        # 一時停止中でなかったモジュールは再スタートしないので, 完了時刻は分からなくなる
+        self.__completion_times.stopped(*dout_id_list)
 
 
     def terminate_douts(self, *dout_id_list):
@@ -282,11 +270,20 @@ class DigitalOutCtrl:
             rftc.log_error(e, self.__logger)
             raise
 
+        transaction = self.__reg_access.transaction()
+        for dout_id in dout_id_list:
+            addr = DigitalOutCtrlRegs.Addr.dout(dout_id) + DigitalOutCtrlRegs.Offset.CTRL
+            transaction.write_bits(addr, DigitalOutCtrlRegs.Bit.CTRL_TERMINATE, 1, 1)
+        transaction.wait_until_bits(
+            [(DigitalOutCtrlRegs.Addr.dout(dout_id) + DigitalOutCtrlRegs.Offset.STATUS,
+              DigitalOutCtrlRegs.Bit.STATUS_BUSY, 1, 0)
+             for dout_id in dout_id_list],
+            5, sg.DigitalOutTimeoutError('Digital output module idle timed out'))
         for dout_id in dout_id_list:
             addr = DigitalOutCtrlRegs.Addr.dout(dout_id) + DigitalOutCtrlRegs.Offset.CTRL
-            self.__reg_access.write_bits(addr, DigitalOutCtrlRegs.Bit.CTRL_TERMINATE, 1, 1)
-            self.__wait_for_douts_idle(5, dout_id)
-            self.__reg_access.write_bits(addr, DigitalOutCtrlRegs.Bit.CTRL_TERMINATE, 1, 0)
+            transaction.write_bits(addr, DigitalOutCtrlRegs.Bit.CTRL_TERMINATE, 1, 0)
+        self.__execute(transaction)
+        self.__completion_times.stopped(*dout_id_list)
 
 
     def clear_dout_stop_flags(self, *dout_id_list):
@@ -301,12 +298,7 @@ class DigitalOutCtrl:
             rftc.log_error(e, self.__logger)
             raise
     
-        self.__select_ctrl_target(*dout_id_list)
-        addr = DigitalOutMasterCtrlRegs.ADDR + DigitalOutMasterCtrlRegs.Offset.CTRL
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_DONE_CLR, 1, 0)
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_DONE_CLR, 1, 1)
-        self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_DONE_CLR, 1, 0)
-        self.__deselect_ctrl_target(*dout_id_list)
+        self.__pulse_ctrl_bit(DigitalOutMasterCtrlRegs.Bit.CTRL_DONE_CLR, 0, *dout_id_list)
 
 
     def wait_for_douts_to_stop(self, timeout, *dout_id_list):
@@ -326,24 +318,39 @@ class DigitalOutCtrl:
             rftc.log_error(e, self.__logger)
             raise
                 
-        start = time.time()
-        while True:
-            all_stopped = True
-            for dout_id in dout_id_list:
-                addr = DigitalOutCtrlRegs.Addr.dout(dout_id) + DigitalOutCtrlRegs.Offset.STATUS
-                val = self.__reg_access.read_bits(addr, DigitalOutCtrlRegs.Bit.STATUS_DONE, 1)
-                if val == 0:
-                    all_stopped = False
-                    break
-            if all_stopped:
-                return
-
-            elapsed_time = time.time() - start
-            if elapsed_time > timeout:
-                err = sg.DigitalOutTimeoutError('Digital output module stop timeout')
-                rftc.log_error(err, self.__logger)
-                raise err
-            time.sleep(0.01)
+        # 出力データの長さから求めた完了時刻の直前まで待ってから, 間隔を広げながら完了を確認する
+        if not self.__wait_policy.wait(
+            lambda: self.__all_douts_stopped(*dout_id_list),
+            timeout, self._time_to_completion(*dout_id_list)):
+            err = sg.DigitalOutTimeoutError('Digital output module stop timeout')
+            rftc.log_error(err, self.__logger)
+            raise err
+
+
+    def _time_to_completion(self, *dout_id_list):
+        """引数で指定した全てのディジタル出力モジュールの動作が完了し得る最短の時刻までの時間 (単位: 秒) を返す.
+
+        分からない場合は 0 を返す.
+        """
+        return self.__completion_times.time_to_completion(*dout_id_list)
+
+
+    def are_douts_stopped(self, *dout_id_list):
+        """引数で指定した全てのディジタル出力モジュールの波形の送信が終了しているかどうかを調べる
+
+        Args:
+            *dout_id_list (list of DigitalOut): 波形の送信が終了しているか調べるディジタル出力モジュールの ID
+
+        Returns:
+            bool: 全てのディジタル出力モジュールの波形の送信が終了している場合 True
+        """
+        try:
+            self.__validate_dout_id(*dout_id_list)
+        except Exception as e:
+            rftc.log_error(e, self.__logger)
+            raise
+
+        return self.__all_douts_stopped(*dout_id_list)
 
 
     def version(self):
@@ -390,6 +397,46 @@ class DigitalOutCtrl:
             *dout_id_list)
 
 
+    def __add_ctrl_target_sel(self, transaction, val, *dout_id_list):
+        """一括制御の対象の選択 (val = 1) / 選択解除 (val = 0) をトランザクションに追加する"""
+        for dout_id in dout_id_list:
+            if dout_id <= sg.DigitalOut.U31:
+                offset = DigitalOutMasterCtrlRegs.Offset.CTRL_TARGET_SEL_0
+            else:
+                offset = DigitalOutMasterCtrlRegs.Offset.CTRL_TARGET_SEL_1
+            transaction.write_bits(
+                DigitalOutMasterCtrlRegs.ADDR + offset,
+                DigitalOutMasterCtrlRegs.Bit.dout(dout_id), 1, val)
+
+
+    def __pulse_ctrl_bit(self, bit_pos, hold_time, *dout_id_list):
+        """一括制御レジスタの特定のビットを 0 -> 1 -> 0 と変化させる
+
+        Args:
+            bit_pos (int): 変化させるビットの位置
+            hold_time (float): ビットを 1 に保つ時間 (単位: 秒).  0 の場合は待たずに 0 に戻す.
+            *dout_id_list (list of DigitalOut): 一括制御の対象とするデジタル出力モジュールの ID
+        """
+        addr = DigitalOutMasterCtrlRegs.ADDR + DigitalOutMasterCtrlRegs.Offset.CTRL
+        transaction = self.__reg_access.transaction()
+        self.__add_ctrl_target_sel(transaction, 1, *dout_id_list)
+        transaction.write_bits(addr, bit_pos, 1, 0)
+        transaction.write_bits(addr, bit_pos, 1, 1)
+        if hold_time > 0:
+            transaction.sleep(hold_time)
+        transaction.write_bits(addr, bit_pos, 1, 0)
+        self.__add_ctrl_target_sel(transaction, 0, *dout_id_list)
+        self.__execute(transaction)
+
+
+    def __execute(self, transaction):
+        try:
+            transaction.execute()
+        except Exception as e:
+            rftc.log_error(e, self.__logger)
+            raise
+
+
     def __set_mask_bits(self, mask_reg_addr, *dout_id_list):
         """ビットマスクレジスタの特定のビットを 1 にする
         
@@ -435,25 +482,15 @@ class DigitalOutCtrl:
         time.sleep(10e-6)
         self.__reg_access.write_bits(addr, DigitalOutMasterCtrlRegs.Bit.CTRL_RESET, 1, 0)
         time.sleep(10e-6)
+        self.__reg_access.invalidate_shadow_regs()
         self.__deselect_ctrl_target(*dout_id_list)
 
 
-    def __wait_for_douts_idle(self, timeout, *dout_id_list):
-        start = time.time()
-        while True:
-            all_idle = True
-            for dout_id in dout_id_list:
-                addr = DigitalOutCtrlRegs.Addr.dout(dout_id) + DigitalOutCtrlRegs.Offset.STATUS
-                val = self.__reg_access.read_bits(addr, DigitalOutCtrlRegs.Bit.STATUS_BUSY, 1)
-                if val == 1:
-                    all_idle = False
-                    break
-            if all_idle:
-                return
-
-            elapsed_time = time.time() - start
-            if elapsed_time > timeout:
-                err = sg.DigitalOutTimeoutError('Digital output module idle timed out')
-                rftc.log_error(err, self.__logger)
-                raise err
-            time.sleep(0.01)
+    def __all_douts_stopped(self, *dout_id_list):
+        # ディジタル出力モジュールには一括ステータスレジスタが無いので,
+        # 各モジュールのステータスの読み出しをまとめて送る
+        vals = self.__reg_access.read_bits_multi([
+            (DigitalOutCtrlRegs.Addr.dout(dout_id) + DigitalOutCtrlRegs.Offset.STATUS,
+             DigitalOutCtrlRegs.Bit.STATUS_DONE, 1)
+            for dout_id in dout_id_list])
+        return all(val == 1 for val in vals)
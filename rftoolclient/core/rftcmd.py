@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-import logging, time
-from .cmdutil import CmdUtil
+import logging
+from .cmdutil import CmdUtil, pipelined
+from .waitpolicy import WaitPolicy
 
 """
 rftcmd.py
@@ -12,6 +13,9 @@ rftcmd.py
 
 class RftoolCommand(object):
     """Class wrapping rftool commands"""
+    # SetBitstream の直後の GetBitstreamStatus は前のコンフィギュレーションの状態 (1) を返すことがあるので,
+    # 少なくともこの時間 (秒) 待ってから確認を始める
+    __BITSTREAM_SETTLE_TIME = 0.5
 
     def __init__(self, interface, logger=None):
         self._logger = logging.getLogger(__name__)
@@ -23,10 +27,18 @@ class RftoolCommand(object):
         self.res = ""
         self._joinargs = CmdUtil.joinargs
         self._splitargs = CmdUtil.splitargs
+        self.__bitstream_listeners = []
+        # FPGA のコンフィギュレーションは数秒かかるので, 確認の間隔は 0.5 秒まで広げる
+        self.__config_wait_policy = WaitPolicy(min_interval = 0.01, max_interval = 0.5, lead_time = 0)
 
         self._logger.debug("RftoolCommand __init__")
         return
 
+    def _put_command(self, command):
+        """@pipelined のメソッドが組み立てたコマンドを送り, 応答を返す"""
+        return self.rft_if.put(command)
+
+    @pipelined
     def SetMixerSettings(
         self, type, tile_id, block_id, freq, phase_offset,
         event_source, mixer_type, coarse_mix_freq,
@@ -65,9 +77,10 @@ class RftoolCommand(object):
             event_source, mixer_type, coarse_mix_freq,
             mixer_mode, fine_mixer_scale
         ])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetMixerSettings(self, type, tile_id, block_id):
         """Get mixer settings of ADC/DAC.
 
@@ -108,7 +121,7 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "GetMixerSettings", [type, tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, block_id, freq, phase_offset,
             event_source, mixer_type, coarse_mixer_freq,
@@ -118,6 +131,7 @@ class RftoolCommand(object):
             event_source, mixer_type, coarse_mixer_freq, \
             mixer_mode, fine_mixer_scale
 
+    @pipelined
     def GetQMCSettings(self, type, tile_id, block_id):
         """Get QMC Gain, Phase, Offset settings of ADC/DAC.
            **has not been used yet.**
@@ -153,7 +167,7 @@ class RftoolCommand(object):
             (IMMEDIATE=0, SLICE=1, TILE=2, SYSREF=3, MARKER=4, PL=5)
         """
         self.cmd = self._joinargs("GetQMCSettings", [type, tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, block_id, gain_correction_factor,
             phase_correction_factor, enable_phase, enable_gain,
@@ -163,6 +177,7 @@ class RftoolCommand(object):
             phase_correction_factor, enable_phase, enable_gain, \
             offset_correction_factor, event_source
 
+    @pipelined
     def SetExtParentclk(self, board_id, freq):
         """Set parent clock (LMK04208) settings.
            **has not been used yet.**
@@ -186,12 +201,13 @@ class RftoolCommand(object):
             12M8_3072M_122M88_REVB=2)
         """
         self.cmd = self._joinargs("SetExtParentclk", [board_id, freq])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [board_id, freq] = self._splitargs(self.res)
 
         return board_id, freq
 
+    @pipelined
     def iic_write(self, iic_inst, slave_addr, reg_offset, size, data):
         """Write data to I2C slave (LMX2594/LMK04208) for clock settings.
            **has not been used yet.**
@@ -206,9 +222,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "iic_write", [iic_inst, slave_addr, reg_offset, size, data])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def iic_read(self, iic_inst, slave_addr, size):
         """Read data from I2C slave (LMX2594/LMK04208) for clock settings.
            **has not been used yet.**
@@ -216,9 +233,10 @@ class RftoolCommand(object):
         This command is NOT IMPLEMENTED YET on rftool (2019.1 ZCU111 TRD).
         """
         self.cmd = self._joinargs("iic_read", [iic_inst, slave_addr, size])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def SetExtPllClkRate(self, board_id, pll_src, freq):
         """Set external PLL clock (LMX2594) frequency.
 
@@ -245,12 +263,13 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "SetExtPllClkRate", [board_id, pll_src, freq])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [board_id, pll_src, freq] = self._splitargs(self.res)
 
         return board_id, pll_src, freq
 
+    @pipelined
     def SetDACPowerMode(self, board_id, tile_id, block_id, output_current):
         """Set DAC output current.
            **has not been used yet.**
@@ -281,13 +300,14 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "SetDACPowerMode", [board_id, tile_id, block_id, output_current])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [board_id, tile_id, block_id,
             output_current] = self._splitargs(self.res)
 
         return board_id, tile_id, block_id, output_current
 
+    @pipelined
     def GetDACPower(self, board_id, tile_id):
         """Get power values from driver.
            **has not been used yet.**
@@ -312,7 +332,7 @@ class RftoolCommand(object):
         adc_avcc : int
         """
         self.cmd = self._joinargs("GetDACPower", [board_id, tile_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [board_id, tile_id, dac_avtt, dac_avcc_aux, dac_avcc,
             adc_avcc_aux, adc_avcc] = self._splitargs(self.res)
@@ -320,6 +340,7 @@ class RftoolCommand(object):
         return board_id, tile_id, dac_avtt, dac_avcc_aux, dac_avcc, \
             adc_avcc_aux, adc_avcc
 
+    @pipelined
     def StartUp(self, type, tile_id):
         """Restart the requested ADC/DAC tile.
 
@@ -333,9 +354,10 @@ class RftoolCommand(object):
             ADC/DAC Tile ID number
         """
         self.cmd = self._joinargs("StartUp", [type, tile_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def Shutdown(self, type, tile_id):
         """Shutdown the requested ADC/DAC tile.
 
@@ -349,9 +371,10 @@ class RftoolCommand(object):
             ADC/DAC Tile ID number
         """
         self.cmd = self._joinargs("Shutdown", [type, tile_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def RfdcVersion(self):
         """Get Xilinx RFDC Version
 
@@ -361,10 +384,11 @@ class RftoolCommand(object):
             RFDC version
         """
         self.cmd = "RfdcVersion"
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         version = self.res.split(" ")[1]
         return version
 
+    @pipelined
     def Version(self):
         """Get Rftool Version
 
@@ -374,10 +398,11 @@ class RftoolCommand(object):
             Rftool version
         """
         self.cmd = "Version"
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         version = self.res.split(" ")[1]
         return version
 
+    @pipelined
     def JtagIdcode(self):
         """Get JTAG ID code
            **has not been used yet.**
@@ -388,10 +413,11 @@ class RftoolCommand(object):
             JTAG ID code
         """
         self.cmd = "JtagIdcode"
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         [idcode] = self._splitargs(self.res)
         return idcode
 
+    @pipelined
     def GetIPStatus(self):
         """Get status of ADC/DAC IP like block status, tile status,
         power up state and PLL state.
@@ -417,7 +443,7 @@ class RftoolCommand(object):
         print(ip_status["adc"][0]["pll_state"])  # get ADC Tile 0 PLLState
         """
         self.cmd = "GetIPStatus"
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         returns = self._splitargs(self.res)
         index = 0
         status = {
@@ -436,6 +462,7 @@ class RftoolCommand(object):
 
         return status
 
+    @pipelined
     def Reset(self, type, tile_id):
         """Reset the requested ADC/DAC tile.
 
@@ -449,9 +476,10 @@ class RftoolCommand(object):
             ADC/DAC Tile ID number
         """
         self.cmd = self._joinargs("Reset", [type, tile_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetPLLConfig(self, type, tile_id):
         """Get PLL configuration of ADC/DAC.
 
@@ -482,7 +510,7 @@ class RftoolCommand(object):
             Output divider
         """
         self.cmd = self._joinargs("GetPLLConfig", [type, tile_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, enabled, ref_clk_freq, sample_rate, ref_clk_divider,
             feedback_divider, output_divider] = self._splitargs(self.res)
@@ -490,6 +518,7 @@ class RftoolCommand(object):
         return type, tile_id, enabled, ref_clk_freq, sample_rate, \
             ref_clk_divider, feedback_divider, output_divider
 
+    @pipelined
     def GetLinkCoupling(self, tile_id, block_id):
         """Get ADC Link Coupling mode.
            **has not been used yet.**
@@ -511,12 +540,13 @@ class RftoolCommand(object):
             Link Coupling mode (DC=0, AC=1)
         """
         self.cmd = self._joinargs("GetLinkCoupling", [tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [tile_id, block_id, mode] = self._splitargs(self.res)
 
         return block_id, mode
 
+    @pipelined
     def SetQMCSettings(
         self, type, tile_id, block_id, enable_phase, enable_gain,
         gain_correction_factor, phase_correction_factor,
@@ -552,9 +582,10 @@ class RftoolCommand(object):
             gain_correction_factor, phase_correction_factor,
             offset_correction_factor, event_source
         ])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetCoarseDelaySettings(self, type, tile_id, block_id):
         """Get coarse delay settings of ADC/DAC.
            **has not been used yet.**
@@ -584,13 +615,14 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs("GetCoarseDelaySettings", [
             type, tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, block_id, coarse_delay,
             event_source] = self._splitargs(self.res)
 
         return type, tile_id, block_id, coarse_delay, event_source
 
+    @pipelined
     def SetCoarseDelaySettings(
         self, type, tile_id, block_id, coarse_delay, event_source
     ):
@@ -616,9 +648,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs("SetCoarseDelaySettings", [
             type, tile_id, block_id, coarse_delay, event_source])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetInterpolationFactor(self, tile_id, block_id):
         """Get DAC Interpolation factor.
 
@@ -640,12 +673,13 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "GetInterpolationFactor", [tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [tile_id, block_id, interpolation_factor] = self._splitargs(self.res)
 
         return tile_id, block_id, interpolation_factor
 
+    @pipelined
     def SetInterpolationFactor(self, tile_id, block_id, interpolation_factor):
         """Set DAC Interpolation factor.
 
@@ -660,9 +694,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs("SetInterpolationFactor", [
             tile_id, block_id, interpolation_factor])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetDecimationFactor(self, tile_id, block_id):
         """Get ADC Decimation factor.
 
@@ -683,12 +718,13 @@ class RftoolCommand(object):
             ADC Interpolation factor
         """
         self.cmd = self._joinargs("GetDecimationFactor", [tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [tile_id, block_id, decimation_factor] = self._splitargs(self.res)
 
         return tile_id, block_id, decimation_factor
 
+    @pipelined
     def SetDecimationFactor(self, tile_id, block_id, decimation_factor):
         """Set ADC Decimation factor.
 
@@ -703,9 +739,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs("SetDecimationFactor", [
             tile_id, block_id, decimation_factor])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetNyquistZone(self, type, tile_id, block_id):
         """Get Nyquist factor of ADC/DAC.
            **has not been used yet.**
@@ -731,12 +768,13 @@ class RftoolCommand(object):
             Nyquist factor (Odd=1, Even=2)
         """
         self.cmd = self._joinargs("GetNyquistZone", [type, tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, block_id, nyquist_zone] = self._splitargs(self.res)
 
         return type, tile_id, block_id, nyquist_zone
 
+    @pipelined
     def SetNyquistZone(self, type, tile_id, block_id, nyquist_zone):
         """Set Nyquist factor of ADC/DAC.
            **has not been used yet.**
@@ -754,9 +792,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs("SetNyquistZone", [
             type, tile_id, block_id, nyquist_zone])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetOutputCurr(self, tile_id, block_id):
         """Get DAC Output current.
            **has not been used yet.**
@@ -780,12 +819,13 @@ class RftoolCommand(object):
               SetDACPowerMode command.
         """
         self.cmd = self._joinargs("GetOutputCurr", [tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [tile_id, block_id, output_curr] = self._splitargs(self.res)
 
         return tile_id, block_id, output_curr
 
+    @pipelined
     def GetPLLLockStatus(self, type, tile_id):
         """Get PLL Lock status of ADC/DAC.
 
@@ -806,12 +846,13 @@ class RftoolCommand(object):
             PLL Lock status (UNLOCKED=1, LOCKED=2)
         """
         self.cmd = self._joinargs("GetPLLLockStatus", [type, tile_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, lock_status] = self._splitargs(self.res)
 
         return type, tile_id, lock_status
 
+    @pipelined
     def GetClockSource(self, type, tile_id):
         """Get Clock source of ADC/DAC.
            **has not been used yet.**
@@ -833,12 +874,13 @@ class RftoolCommand(object):
             Clock source
         """
         self.cmd = self._joinargs("GetClockSource", [type, tile_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, clock_source] = self._splitargs(self.res)
 
         return type, tile_id, clock_source
 
+    @pipelined
     def DynamicPLLConfig(
         self, type, tile_id, source, ref_clk_freq, sampling_rate
     ):
@@ -869,13 +911,14 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs("DynamicPLLConfig", [
             type, tile_id, source, ref_clk_freq, sampling_rate])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [ref_clk_divider, feedback_divider,
             output_divider] = self._splitargs(self.res)
 
         return ref_clk_divider, feedback_divider, output_divider
 
+    @pipelined
     def SetFabClkOutDiv(self, type, tile_id, fab_clk_div):
         """Set Fablic clock divider of ADC/DAC.
 
@@ -890,9 +933,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "SetFabClkOutDiv", [type, tile_id, fab_clk_div])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def SetupFIFO(self, type, tile_id, enable):
         """Enable and Disable the ADC/DAC FIFO.
 
@@ -906,8 +950,9 @@ class RftoolCommand(object):
             FIFO Enable/Disable (enable=1, disable=0)
         """
         self.cmd = self._joinargs("SetupFIFO", [type, tile_id, enable])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
+    @pipelined
     def GetFIFOStatus(self, type, tile_id):
         """Get FIFO status of ADC/DAC.
 
@@ -928,12 +973,13 @@ class RftoolCommand(object):
             FIFO Enable/Disable (enable=1, disable=0)
         """
         self.cmd = self._joinargs("GetFIFOStatus", [type, tile_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, enable] = self._splitargs(self.res)
 
         return type, tile_id, enable
 
+    @pipelined
     def SetFabWrVldWords(self, tile_id, block_id, fabric_data_rate):
         """Set Fabric write valid dWords of DAC.
            Configration parameters in DAC. In case it is not right vlaue, interrupt occurs.
@@ -949,9 +995,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs("SetFabWrVldWords", [
             tile_id, block_id, fabric_data_rate])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetFabWrVldWords(self, type, tile_id, block_id):
         """Get Fabric write valid dWords of ADC/DAC.
 
@@ -977,12 +1024,13 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "GetFabWrVldWords", [type, tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, block_id, fabric_data_rate] = self._splitargs(self.res)
 
         return type, tile_id, block_id, fabric_data_rate
 
+    @pipelined
     def SetFabRdVldWords(self, tile_id, block_id, fabric_data_rate):
         """Set Fabric read valid dWords of ADC.
            Configration parameters in ADC. In case it is not right vlaue, interrupt occurs.
@@ -998,9 +1046,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs("SetFabRdVldWords", [
             tile_id, block_id, fabric_data_rate])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetFabRdVldWords(self, type, tile_id, block_id):
         """Get Fabric read valid dWords of ADC/DAC.
 
@@ -1026,12 +1075,13 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "GetFabRdVldWords", [type, tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, block_id, fabric_data_rate] = self._splitargs(self.res)
 
         return type, tile_id, block_id, fabric_data_rate
 
+    @pipelined
     def SetDecoderMode(self, tile_id, block_id, decoder_mode):
         """Set DAC Decode mode.
            **has not been used yet.**
@@ -1047,9 +1097,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs("SetDecoderMode", [
             tile_id, block_id, decoder_mode])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetDecoderMode(self, tile_id, block_id):
         """Get DAC Decode mode.
            **has not been used yet.**
@@ -1071,12 +1122,13 @@ class RftoolCommand(object):
             DAC Decoder mode (MAX_SNR_MODE=1, MAX_LINEARITY_MODE=2)
         """
         self.cmd = self._joinargs("GetDecoderMode", [tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [tile_id, block_id, decoder_mode] = self._splitargs(self.res)
 
         return tile_id, block_id, decoder_mode
 
+    @pipelined
     def ResetNCOPhase(self, type, tile_id, block_id):
         """Reset NCO phase of ADC/DAC.
            Reset before changing from I/Q mode to Real mode
@@ -1091,9 +1143,10 @@ class RftoolCommand(object):
             ADC/DAC Block ID number
         """
         self.cmd = self._joinargs("ResetNCOPhase", [type, tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def DumpRegs(self, type, tile_id):
         """Dump ADC/DAC register values.
            **has not been used yet.**
@@ -1109,9 +1162,10 @@ class RftoolCommand(object):
             ADC/DAC Tile ID number
         """
         self.cmd = self._joinargs("DumpRegs", [type, tile_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def UpdateEvent(self, type, tile_id, block_id, event):
         """Trigger the update event for ADC/DAC.
            This function is always after configuring I/Q mixer parameters.
@@ -1129,9 +1183,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "UpdateEvent", [type, tile_id, block_id, event])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetCalibrationMode(self, tile_id, block_id):
         """Get ADC Calibration mode.
            **has not been used yet.**
@@ -1153,12 +1208,13 @@ class RftoolCommand(object):
             ADC Calibration mode (MODE1=1, MODE2=2)
         """
         self.cmd = self._joinargs("GetCalibrationMode", [tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [tile_id, block_id, calibration_mode] = self._splitargs(self.res)
 
         return tile_id, block_id, calibration_mode
 
+    @pipelined
     def SetCalibrationMode(self, tile_id, block_id, calibration_mode):
         """Set ADC Calibration mode.
            **has not been used yet.**
@@ -1174,9 +1230,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs("SetCalibrationMode", [
             tile_id, block_id, calibration_mode])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetBlockStatus(self, type, tile_id, block_id):
         """Get Data converter block status of ADC/DAC.
 
@@ -1229,7 +1286,7 @@ class RftoolCommand(object):
                1 bit : FIFO underflow flag (data read faster than written)
         """
         self.cmd = self._joinargs("GetBlockStatus", [type, tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, block_id, sampling_freq,
             analog_data_path_status, digital_data_path_status,
@@ -1241,6 +1298,7 @@ class RftoolCommand(object):
             data_path_clocks_status, is_fifo_flags_asserted, \
             is_fifo_flags_enabled
 
+    @pipelined
     def GetThresholdSettings(self, tile_id, block_id):
         """Get ADC Threshold settings.
            **has not been used yet.**
@@ -1279,7 +1337,7 @@ class RftoolCommand(object):
             Threshold 1 Over threshold
         """
         self.cmd = self._joinargs("GetThresholdSettings", [tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [tile_id, block_id, update_threshold, threshold_mode_0,
             threshold_mode_1, threshold_avg_val_0, threshold_avg_val_1,
@@ -1292,6 +1350,7 @@ class RftoolCommand(object):
             threshold_under_val_0, threshold_under_val_1, \
             threshold_over_val_0, threshold_over_val_1
 
+    @pipelined
     def RF_ReadReg32(self, address_offset):
         """Read RFDC register in 32 bits
            **has not been used yet.**
@@ -1306,12 +1365,13 @@ class RftoolCommand(object):
             Register value
         """
         self.cmd = self._joinargs("RF_ReadReg32", [address_offset])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [value] = self._splitargs(self.res)
 
         return value
 
+    @pipelined
     def RF_WriteReg32(self, address_offset, value):
         """Write RFDC register in 32 bits
            **has not been used yet.**
@@ -1324,9 +1384,10 @@ class RftoolCommand(object):
             Register value
         """
         self.cmd = self._joinargs("RF_WriteReg32", [address_offset, value])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def RF_ReadReg16(self, address_offset):
         """Read RFDC register in 16 bits
            **has not been used yet.**
@@ -1341,12 +1402,13 @@ class RftoolCommand(object):
             Register value
         """
         self.cmd = self._joinargs("RF_ReadReg16", [address_offset])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [value] = self._splitargs(self.res)
 
         return value
 
+    @pipelined
     def RF_WriteReg16(self, address_offset, value):
         """Write RFDC register in 16 bits
            **has not been used yet.**
@@ -1359,9 +1421,10 @@ class RftoolCommand(object):
             Register value
         """
         self.cmd = self._joinargs("RF_WriteReg16", [address_offset, value])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def RF_ReadReg8(self, address_offset):
         """Read RFDC register in 8 bits
            **has not been used yet.**
@@ -1376,12 +1439,13 @@ class RftoolCommand(object):
             Register value
         """
         self.cmd = self._joinargs("RF_ReadReg8", [address_offset])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [value] = self._splitargs(self.res)
 
         return value
 
+    @pipelined
     def RF_WriteReg8(self, address_offset, value):
         """Write RFDC register in 8 bits
            **has not been used yet.**
@@ -1394,9 +1458,10 @@ class RftoolCommand(object):
             Register value
         """
         self.cmd = self._joinargs("RF_WriteReg8", [address_offset, value])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def MultiBand(
         self, type, tile_id, digital_data_path_mask,
         data_type, data_converter_mask
@@ -1426,9 +1491,10 @@ class RftoolCommand(object):
         self.cmd = self._joinargs("MultiBand", [
             type, tile_id, digital_data_path_mask,
             data_type, data_converter_mask])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetConnectedData(self, type, tile_id, block_id):
         """Get Data converter connected for digital data path I/Q.
            **has not been used yet.**
@@ -1457,13 +1523,14 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "GetConnectedData", [type, tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, block_id,
             connected_I_data, connected_Q_data] = self._splitargs(self.res)
 
         return type, tile_id, block_id, connected_I_data, connected_Q_data
 
+    @pipelined
     def GetInvSincFIR(self, tile_id, block_id):
         """Get DAC Inverse-Sync filter enable/mode.
            **has not been used yet.**
@@ -1486,12 +1553,13 @@ class RftoolCommand(object):
             (disable=0, 1st nyquist zone=1, 2nd nyquist zone=2)
         """
         self.cmd = self._joinargs("GetInvSincFIR", [tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [tile_id, block_id, mode] = self._splitargs(self.res)
 
         return tile_id, block_id, mode
 
+    @pipelined
     def SetInvSincFIR(self, tile_id, block_id, mode):
         """Set DAC Inverse-Sync filter mode.
            **has not been used yet.**
@@ -1507,9 +1575,10 @@ class RftoolCommand(object):
             (disable=0, 1st nyquist zone=1, 2nd nyquist zone=2)
         """
         self.cmd = self._joinargs("SetInvSincFIR", [tile_id, block_id, mode])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def IntrClr(self, type, tile_id, block_id, interrupt_mask):
         """Clear interrupt status of ADC/DAC.
 
@@ -1539,9 +1608,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "IntrClr", [type, tile_id, block_id, interrupt_mask])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def IntrEnable(self, type, tile_id, block_id, interrupt_mask):
         """Enable interrupt status of ADC/DAC.
 
@@ -1571,9 +1641,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "IntrEnable", [type, tile_id, block_id, interrupt_mask])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def IntrDisable(self, type, tile_id, block_id, interrupt_mask):
         """Enable interrupt status of ADC/DAC.
 
@@ -1603,9 +1674,10 @@ class RftoolCommand(object):
         """
         self.cmd = self._joinargs(
             "IntrDisable", [type, tile_id, block_id, interrupt_mask])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
     
+    @pipelined
     def GetIntrStatus(self, type, tile_id, block_id):
         """Get interrupt status of ADC/DAC.
 
@@ -1677,12 +1749,13 @@ class RftoolCommand(object):
                 0x00000008 : XRFDC_IXR_FIFOMRGNIND_UF_MASK
         """
         self.cmd = self._joinargs("GetIntrStatus", [type, tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [type, tile_id, block_id, interrupt_status] = self._splitargs(self.res)
 
         return type, tile_id, block_id, interrupt_status
 
+    @pipelined
     def TermMode(self, enable):
         """Enable terminal mode.
 
@@ -1694,9 +1767,10 @@ class RftoolCommand(object):
             enable terminal mode (enable=1, disable=0)
         """
         self.cmd = self._joinargs("TermMode", [enable])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetExtPllFreqList(self, board_id, pll_src):
         """Get available frequencies of External PLL clock (LMX2594).
 
@@ -1713,12 +1787,13 @@ class RftoolCommand(object):
             Available frequencies of LMX2594
         """
         self.cmd = self._joinargs("GetExtPllFreqList", [board_id, pll_src])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         freq_list = self._splitargs(self.res)
 
         return freq_list
 
+    @pipelined
     def GetExtPllConfig(self, board_id, pll_src):
         """Get currently configured frequency of External PLL clock (LMX2594).
            **has not been used yet.**
@@ -1737,12 +1812,13 @@ class RftoolCommand(object):
             obtained by GetExtPllFreqList command
         """
         self.cmd = self._joinargs("GetExtPllConfig", [board_id, pll_src])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [freq] = self._splitargs(self.res)
 
         return freq
 
+    @pipelined
     def SetCalFreeze(self, tile_id, block_id, enable):
         """Set calibration freeze feature of ADC.
            **has not been used yet.**
@@ -1757,9 +1833,10 @@ class RftoolCommand(object):
             Calibration freeze enable (enable=1, disalbe=0)
         """
         self.cmd = self._joinargs("SetCalFreeze", [tile_id, block_id, enable])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetCalFreeze(self, tile_id, block_id):
         """Set calibration freeze feature of ADC.
            **has not been used yet.**
@@ -1781,12 +1858,13 @@ class RftoolCommand(object):
             Calibration freeze enable (enable=1, disalbe=0)
         """
         self.cmd = self._joinargs("GetCalFreeze", [tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [tile_id, block_id, enable] = self._splitargs(self.res)
 
         return tile_id, block_id, enable
 
+    @pipelined
     def SetBitstream(self, design):
         """Invoke thread to load the specified Bitstream.
 
@@ -1796,9 +1874,20 @@ class RftoolCommand(object):
             Design type (NON_MTS=1, MTS=2, DAC1_ADC1(SSR)=3)
         """
         self.cmd = self._joinargs("SetBitstream", [design])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
+        for listener in self.__bitstream_listeners:
+            listener()
         return
 
+    def add_bitstream_listener(self, listener):
+        """Register a function called with no arguments after SetBitstream.
+
+        The FPGA is reconfigured by SetBitstream, so everything cached
+        about the state of the PL must be discarded in the listener.
+        """
+        self.__bitstream_listeners.append(listener)
+
+    @pipelined
     def GetBitstream(self):
         """Get the enum value of loaded Bitstream.
 
@@ -1808,12 +1897,13 @@ class RftoolCommand(object):
             Design type (NON_MTS=1, MTS=2, DAC1_ADC1(SSR)=3)
         """
         self.cmd = "GetBitstream"
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [design] = self._splitargs(self.res)
 
         return design
 
+    @pipelined
     def GetBitstreamStatus(self):
         """Get the PL loading status.
 
@@ -1823,12 +1913,13 @@ class RftoolCommand(object):
             PL design ready (not_ready=0, ready=1)
         """
         self.cmd = "GetBitstreamStatus"
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [design_ready] = self._splitargs(self.res)
 
         return design_ready
 
+    @pipelined
     def GetDither(self, tile_id, block_id):
         """Get ADC Dither status.
 
@@ -1849,12 +1940,13 @@ class RftoolCommand(object):
             ADC Dither enable (enable=1, disable=0)
         """
         self.cmd = self._joinargs("GetDither", [tile_id, block_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
 
         [tile_id, block_id, enable] = self._splitargs(self.res)
 
         return tile_id, block_id, enable
 
+    @pipelined
     def SetDither(self, tile_id, block_id, enable):
         """Set ADC Dither status.
 
@@ -1868,9 +1960,10 @@ class RftoolCommand(object):
             ADC Dither enable (enable=1, disable=0)
         """
         self.cmd = self._joinargs("SetDither", [tile_id, block_id, enable])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         return
 
+    @pipelined
     def GetFabClkOutDiv(self, type, tile_id):
         """Get Fablic clock divider of ADC/DAC.
 
@@ -1891,7 +1984,7 @@ class RftoolCommand(object):
             Fablic clock divider (1 to 16)
         """
         self.cmd = self._joinargs("GetFabClkOutDiv", [type, tile_id])
-        self.res = self.rft_if.put(self.cmd)
+        self.res = yield self.cmd
         [type, tile_id, fab_clk_div] = self._splitargs(self.res)
 
         return type, tile_id, fab_clk_div
@@ -1905,13 +1998,10 @@ class RftoolCommand(object):
         """
         if self.GetBitstream() != design_id:
             self.SetBitstream(int(design_id))
-            time.sleep(0.5)
-            start = time.time()
-            while True:
-                if self.GetBitstreamStatus() == 1:                
-                    return
-                elapsed_time = time.time() - start
-                if elapsed_time > timeout:
-                    raise Exception(
-                        'Failed to configure bitstream, please reboot ZCU111.')
-                time.sleep(0.5)
+            if not self.__config_wait_policy.wait(
+                lambda: self.GetBitstreamStatus() == 1,
+                self.__BITSTREAM_SETTLE_TIME + timeout,
+                self.__BITSTREAM_SETTLE_TIME):
+                raise Exception(
+                    'Failed to configure bitstream, please reboot ZCU111.')
+
@@ -21,3 +21,18 @@ class RftoolExecuteCommandError(RftoolClientError):
 class RftoolInterfaceError(RftoolClientError):
     """Rftool Interface error"""
     pass
+
+
+class RftoolReplayError(RftoolInterfaceError):
+    """Exception thrown when a client replaying a traffic recording sends
+    something different from what was recorded"""
+    pass
+
+
+class RftoolPoolError(RftoolClientError):
+    """Exception thrown when a call fanned out by RftoolClientPool failed on some boards"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(", ".join(
+            "{}: {}".format(address, err) for address, err in errors.items()))
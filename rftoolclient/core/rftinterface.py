@@ -3,6 +3,8 @@
 
 import socket
 import logging
+import threading
+import time
 import rftoolclient as rftc
 from .cmdutil import CmdUtil
 
@@ -11,115 +13,343 @@ rftinterface.py
     - RFTOOLs command / data communication interface
 """
 
+class _CommandRecord(object):
+    """Wall time and byte counts of the command in progress"""
+    __slots__ = ("name", "start", "last", "sent", "received", "failed")
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.last = start
+        self.sent = 0
+        self.received = 0
+        self.failed = False
+
+
 class RftoolInterface(object):
+    __RECV_BUF_SIZE = 0x10000
+    # これ以下のサイズのデータはコマンドと一緒に 1 回で送信する
+    __MAX_COALESCED_DATA_SIZE = 0x10000
+
     def __init__(self, logger=None):
         self._logger = logging.getLogger(__name__)
         self._logger.addHandler(logging.NullHandler())
         self._logger = logger or self._logger
 
         self.sock = None
+        self.__rbuf = bytearray()
         self._joinargs = CmdUtil.joinargs
         self.err_connection = False
+        self.__send_throughput = 0.0
+        self.__recv_throughput = 0.0
+        self.__tls = threading.local()
+        # put / put_pipelined hold this while their request and response are on the wire,
+        # so that threads (e.g. the poller of RunFuture) can share the control socket
+        self.__put_lock = threading.RLock()
+        self.__instrument = None
+        # records of the commands in progress, one per thread which sends commands
+        # (e.g. the sender thread of AwgSaCommand.read_captures_and_set_wave_sequences)
+        self.__records = set()
+        self.__records_lock = threading.Lock()
         self._logger.debug("RftoolInterface __init__")
 
     def attach_socket(self, sock):
         self.sock = sock
+        self.__rbuf = bytearray()
+
+    def _set_hook(self, hook):
+        """Install a hook for the calling thread and return the previous one.
+
+        The hook is notified before a command is put (hook.on_put) and before
+        any other transaction starts (hook.on_send).  on_put may return a
+        response string to complete the put without touching the socket.
+        """
+        prev = getattr(self.__tls, "hook", None)
+        self.__tls.hook = hook
+        return prev
+
+    def set_instrument(self, instrument):
+        """Install an instrument and return the previous one.
+
+        instrument.record(command, elapsed, bytes_sent, bytes_received, failed)
+        is called once per command with the command name, the wall time (s)
+        from sending the command to receiving the last byte of its reply, the
+        bytes sent and received and whether it failed.  A command is reported
+        when the next one starts on the same thread or flush_instrument is
+        called.  Bytes are credited to the command last sent by the thread
+        which moves them.
+        None removes the instrument.
+        """
+        self.flush_instrument()
+        prev = self.__instrument
+        self.__instrument = instrument
+        return prev
+
+    def flush_instrument(self):
+        """Report the last command of every thread to the instrument."""
+        with self.__records_lock:
+            records = list(self.__records)
+        for record in records:
+            self.__report(record)
+
+    def __report(self, record):
+        with self.__records_lock:
+            if record not in self.__records:
+                return
+            self.__records.remove(record)
+            instrument = self.__instrument
+        if instrument is not None:
+            instrument.record(
+                record.name, record.last - record.start, record.sent, record.received, record.failed)
+
+    def __begin_command(self, command):
+        """Report the last command of the calling thread and start recording command"""
+        record = getattr(self.__tls, "record", None)
+        if record is not None:
+            self.__report(record)
+        record = _CommandRecord(command.split(" ", 1)[0], time.perf_counter())
+        with self.__records_lock:
+            self.__records.add(record)
+        self.__tls.record = record
+
+    def __end_command(self):
+        record = getattr(self.__tls, "record", None)
+        if record is not None:
+            self.__tls.record = None
+            self.__report(record)
+
+    def __count(self, sent = 0, received = 0, failed = False):
+        """Add the bytes to the command in progress on the calling thread, if any"""
+        cur = getattr(self.__tls, "record", None)
+        if cur is None:
+            return
+        cur.sent += sent
+        cur.received += received
+        cur.failed |= failed
+        cur.last = time.perf_counter()
+
+    def __notify_send(self):
+        hook = getattr(self.__tls, "hook", None)
+        if hook is not None:
+            hook.on_send(self)
+
+    def _sock_sendall(self, data):
+        self.sock.sendall(data)
+
+    def _sock_recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def _sock_recv_into(self, buf, nbytes):
+        return self.sock.recv_into(buf, nbytes)
+
+    def run_cpu_bound(self, func, *args):
+        """Call func(*args) and return its result.
+
+        Used for CPU-heavy work such as serializing wave sequences.
+        AsyncRftoolInterface runs func on an executor instead, so that the
+        event loop keeps serving the other boards meanwhile.
+        """
+        return func(*args)
 
     def send_command(self, cmd):
-        cmd = cmd.encode() + b"\r\n"
+        self.__notify_send()
+        if self.__instrument is not None:
+            self.__begin_command(cmd)
+        self.__send_line(cmd)
+
+    def __send_line(self, line):
+        line = line.encode() + b"\r\n"
         try:
-            self.sock.sendall(cmd)
+            self._sock_sendall(line)
         except (ConnectionError, socket.timeout):
             self.err_connection = True
+            self.__count(failed = True)
             raise
+        self.__count(sent = len(line))
 
     def recv_response(self):
-        res = b""
+        """Receive one response line terminated by LF.
+
+        Bytes received after the terminator stay in the receive buffer and
+        are served to the next recv_response / recv_data call.
+        """
         try:
-            while res[-1:] != b"\n":
-                res += self.sock.recv(1)
+            pos = self.__rbuf.find(b"\n")
+            while pos < 0:
+                searched = len(self.__rbuf)
+                buf = self._sock_recv(self.__RECV_BUF_SIZE)
+                if buf == b"":
+                    raise ConnectionError("socket connection broken")
+                self.__rbuf += buf
+                pos = self.__rbuf.find(b"\n", searched)
         except (ConnectionError, socket.timeout):
             self.err_connection = True
-            self._logger.error("received string: {}".format(res))
+            self.__count(failed = True)
+            self._logger.error("received string: {}".format(bytes(self.__rbuf)))
             raise
-        res = res.decode()
+        res = self.__rbuf[:pos + 1].decode()
+        del self.__rbuf[:pos + 1]
+        self.__count(received = pos + 1, failed = res[:5] == "ERROR")
         return res
 
     def put(self, command):
-        self._logger.debug("> " + command)
-        self.send_command(command)
-        res = self.recv_response().replace("\r\n", "")
-        self._logger.debug(res)
+        hook = getattr(self.__tls, "hook", None)
+        if hook is not None:
+            res = hook.on_put(self, command)
+            if res is not None:
+                return res
+
+        with self.__put_lock:
+            self._logger.debug("> " + command)
+            self.send_command(command)
+            res = self.recv_response().replace("\r\n", "")
+            self._logger.debug(res)
 
-        if res[:5] == "ERROR":
-            self.send_command("GetLog")
-            log = self.recv_response().replace("\r\n", "")
-            raise rftc.RftoolExecuteCommandError(
-                " ".join([res, log[6:]]))
+            if res[:5] == "ERROR":
+                self.__send_line("GetLog")
+                log = self.recv_response().replace("\r\n", "")
+                raise rftc.RftoolExecuteCommandError(
+                    " ".join([res, log[6:]]))
 
         return res
 
     def put_mult(self, commands):
-        is_error = False
-        responses = []
-        logs = []
+        results = self.put_pipelined(commands)
+        errors = [str(res) for res in results if isinstance(res, Exception)]
+        if errors:
+            raise rftc.RftoolExecuteCommandError(" ".join(errors))
 
-        self._logger.debug("> " + "\r\n.. ".join(commands))
-        self.send_command("\r\n".join(commands))
+        return results
 
-        for cmd in commands:
-            res = self.recv_response().replace("\r\n", "")
+    def put_pipelined(self, commands):
+        """Send commands in one write and receive their responses in order.
 
-            if res[:5] == "ERROR":
-                is_error = True
-                self.send_command("GetLog")
-                log = self.recv_response().replace("\r\n", "")
-                res = " ".join([res, log[6:]])
-                logs.append(res)
+        GetLog is sent only after all the responses have been received, so
+        that its reply cannot be mistaken for the response of a command
+        still in flight.
+
+        Returns
+        -------
+        A list with one element per command: the response string, or an
+        RftoolExecuteCommandError naming the command that failed.
+        """
+        if not commands:
+            return []
+
+        with self.__put_lock:
+            self._logger.debug("> " + "\r\n.. ".join(commands))
+            if self.__instrument is None:
+                self.send_command("\r\n".join(commands))
+                responses = [self.recv_response().replace("\r\n", "") for _ in commands]
             else:
+                responses = self.__put_pipelined_instrumented(commands)
+
+            failed = [i for i, res in enumerate(responses) if res[:5] == "ERROR"]
+            log = ""
+            if failed:
+                self.__send_line("GetLog")
+                log = self.recv_response().replace("\r\n", "")[6:]
+
+        results = []
+        for i, (cmd, res) in enumerate(zip(commands, responses)):
+            if res[:5] != "ERROR":
                 self._logger.debug(res)
+                results.append(res)
+                continue
+            # the log of the server describes the latest error
+            msg = " ".join([res, log]) if i == failed[-1] else res
+            results.append(rftc.RftoolExecuteCommandError(
+                "{}  (command: {})".format(msg, cmd)))
+
+        return results
+
+    def __put_pipelined_instrumented(self, commands):
+        """put_pipelined reporting every command with the time from sending
+        the batch to receiving the response of the command"""
+        self.__notify_send()
+        self.__end_command()
+        instrument = self.__instrument
+        start = time.perf_counter()
+        self.__send_line("\r\n".join(commands))
+        responses = []
+        try:
+            for command in commands:
+                res = self.recv_response()
+                instrument.record(
+                    command.split(" ", 1)[0], time.perf_counter() - start,
+                    len(command) + 2, len(res.encode()), res[:5] == "ERROR")
+                responses.append(res.replace("\r\n", ""))
+        except (ConnectionError, socket.timeout):
+            for command in commands[len(responses):]:
+                instrument.record(
+                    command.split(" ", 1)[0], time.perf_counter() - start,
+                    len(command) + 2, 0, True)
+            raise
+        return responses
 
-            responses.append(res)
+    def send_data(self, data, bufsize=0x400000, show_progress = False):
+        """Send data without copying it.
 
-        if is_error:
-            raise rftc.RftoolExecuteCommandError(
-                " ".join(logs))
+        Parameters
+        ----------
+        data : bytes-like object
+            The data to send.  (bytes, bytearray, numpy.ndarray, mmap, ...)
+        bufsize : int
+            The number of bytes passed to one sendall call.
 
-        return responses
+        Returns
+        -------
+        The number of bytes sent.
+        """
+        try:
+            view = memoryview(data).cast("B")
+        except TypeError:
+            raise ValueError(
+                "data must be a C-contiguous bytes-like object, but {} found".format(type(data)))
 
-    def send_data(self, data, bufsize=2048, show_progress = False):
         total = 0
-        size = len(data)
+        size = view.nbytes
         diff = 0
+        start = time.perf_counter()
         try:
             while total < size:
-                sent = self.sock.send(data[total:total + bufsize])
-                if sent < bufsize:
-                    sent += self.sock.send(data[total+sent:total+bufsize])
-                if sent == 0:
-                    raise ConnectionError("socket connection broken")
-                total += sent
-                diff += sent
+                chunk = view[total:total + bufsize]
+                self._sock_sendall(chunk)
+                total += chunk.nbytes
+                diff += chunk.nbytes
+                chunk.release()
                 if show_progress and (diff >= 0x2000000):
                     self._logger.info("  ... sent {} bytes".format(total))
                     diff = 0
 
         except (ConnectionError, socket.timeout):
             self.err_connection = True
+            self.__count(failed = True)
             raise
 
         finally:
+            view.release()
+            self.__send_throughput = self.__calc_throughput(total, start)
+            self.__count(sent = total)
             if show_progress:
-                self._logger.info("  total sent {} bytes".format(total))
+                self._logger.info("  total sent {} bytes  ({:.1f} MB/s)".format(
+                    total, self.__send_throughput))
         return total
 
     def recv_data(self, size, bufsize=2048, show_progress = False):
         chunks = []
         received = 0
         diff = 0
+        start = time.perf_counter()
+        if self.__rbuf:
+            # payload bytes that arrived together with the preceding response line
+            buf = bytes(self.__rbuf[:size])
+            del self.__rbuf[:size]
+            chunks.append(buf)
+            received += len(buf)
         try:
             while received < size:
-                buf = self.sock.recv(min(size - received, bufsize))
+                buf = self._sock_recv(min(size - received, bufsize))
                 if buf == b"":
                     raise ConnectionError("socket connection broken")
                 chunks.append(buf)
@@ -131,23 +361,104 @@ class RftoolInterface(object):
 
         except (ConnectionError, socket.timeout):
             self.err_connection = True
+            self.__count(received = received, failed = True)
             raise
 
         recvdata = b"".join(chunks)
+        self.__count(received = received)
+        self.__recv_throughput = self.__calc_throughput(received, start)
         if show_progress:
-            self._logger.info("  total received {} bytes".format(len(recvdata)))
+            self._logger.info("  total received {} bytes  ({:.1f} MB/s)".format(
+                len(recvdata), self.__recv_throughput))
         return recvdata
 
+    def recv_data_into(self, buf, size=None, bufsize=0x400000, show_progress = False):
+        """Receive data directly into a writable buffer.
 
+        Parameters
+        ----------
+        buf : writable bytes-like object
+            The buffer to fill.  (bytearray, numpy.ndarray, mmap, ...)
+        size : int
+            The number of bytes to receive.  Defaults to the size of buf.
 
-    def PutCmdWithData(self, command, data, bufsize = 2048):
+        Returns
+        -------
+        The number of bytes received.
+        """
+        try:
+            view = memoryview(buf).cast("B")
+        except TypeError:
+            raise ValueError(
+                "the receive buffer must be a C-contiguous bytes-like object, but {} found".format(type(buf)))
+        if size is None:
+            size = view.nbytes
+        if view.readonly:
+            raise ValueError("the receive buffer is read-only")
+        if view.nbytes < size:
+            raise ValueError(
+                "the receive buffer is too small  ({} < {} bytes)".format(view.nbytes, size))
+
+        received = 0
+        diff = 0
+        start = time.perf_counter()
+        if self.__rbuf:
+            # payload bytes that arrived together with the preceding response line
+            received = min(size, len(self.__rbuf))
+            view[:received] = self.__rbuf[:received]
+            del self.__rbuf[:received]
+        try:
+            while received < size:
+                nbytes = self._sock_recv_into(
+                    view[received:size], min(size - received, bufsize))
+                if nbytes == 0:
+                    raise ConnectionError("socket connection broken")
+                received += nbytes
+                diff += nbytes
+                if show_progress and (diff >= 0x2000000):
+                    self._logger.info("  ... received {} bytes".format(received))
+                    diff = 0
+
+        except (ConnectionError, socket.timeout):
+            self.err_connection = True
+            self.__count(received = received, failed = True)
+            raise
+
+        finally:
+            view.release()
+
+        self.__count(received = received)
+        self.__recv_throughput = self.__calc_throughput(received, start)
+        if show_progress:
+            self._logger.info("  total received {} bytes  ({:.1f} MB/s)".format(
+                received, self.__recv_throughput))
+        return received
+
+    @property
+    def send_throughput(self):
+        """Throughput (MB/s) of the last send_data call."""
+        return self.__send_throughput
+
+    @property
+    def recv_throughput(self):
+        """Throughput (MB/s) of the last recv_data / recv_data_into call."""
+        return self.__recv_throughput
+
+    @staticmethod
+    def __calc_throughput(nbytes, start):
+        elapsed = time.perf_counter() - start
+        return nbytes / elapsed / 1e6 if elapsed > 0 else 0.0
+
+
+
+    def PutCmdWithData(self, command, data, bufsize = 0x400000):
         """Send a command followed by data.
 
         Parameters
         ----------
         cmd : string
             The command to send.
-        data : bytes
+        data : bytes-like object
             The data to send
 
         Returns
@@ -155,13 +466,24 @@ class RftoolInterface(object):
         The response of the sent command.
         """
 
-        self.send_command(command)
-        self._logger.debug("> " + command)
+        self.__notify_send()
+        if self.__instrument is not None:
+            self.__begin_command(command)
 
+        self._logger.debug("> " + command)
         try:
-            self.send_data(data, bufsize = bufsize)
+            view = memoryview(data).cast("B")
+            if view.nbytes <= self.__MAX_COALESCED_DATA_SIZE:
+                # small payloads (register values, sequence parameters) share one segment with the command
+                packet = b"".join([command.encode(), b"\r\n", view])
+                self._sock_sendall(packet)
+                self.__count(sent = len(packet))
+            else:
+                self.__send_line(command)
+                self.send_data(data, bufsize = bufsize)
         except (ConnectionError, socket.timeout):
             self.err_connection = True
+            self.__count(failed = True)
             raise
 
         try:
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import heapq
+import itertools
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+import rftoolclient.awgsa as ag
+from .waitpolicy import WaitPolicy
+
+"""
+runfuture.py
+    - Futures of wave sequences and STG runs, completed by a background poller
+"""
+
+
+class _Poller(object):
+    """One daemon thread which polls the outstanding RunFutures of all clients.
+
+    The thread is started by the first future and exits after it has been
+    idle for a while.
+    """
+    __IDLE_TIMEOUT = 5.0
+
+    def __init__(self):
+        self.__cond = threading.Condition()
+        self.__queue = []
+        self.__seq = itertools.count()
+        self.__thread = None
+
+    def submit(self, future, delay):
+        with self.__cond:
+            heapq.heappush(self.__queue, (time.perf_counter() + delay, next(self.__seq), future))
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                    target = self.__run, name = "RunFuturePoller", daemon = True)
+                self.__thread.start()
+            self.__cond.notify()
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                future = self.__next_due()
+                if future is None:
+                    self.__thread = None
+                    return
+            delay = future._poll()
+            if delay is not None:
+                self.submit(future, delay)
+
+    def __next_due(self):
+        """Wait for the next future to poll.  None if idle for __IDLE_TIMEOUT."""
+        while True:
+            if not self.__queue:
+                if not self.__cond.wait(self.__IDLE_TIMEOUT) and not self.__queue:
+                    return None
+                continue
+            due, _, future = self.__queue[0]
+            delay = due - time.perf_counter()
+            if delay <= 0:
+                heapq.heappop(self.__queue)
+                return future
+            self.__cond.wait(delay)
+
+
+_poller = _Poller()
+
+
+class RunFuture(Future):
+    """concurrent.futures.Future completed when the hardware reports that a run is done.
+
+    A run is started with start_wave_sequence(as_future = True) or
+    start_stgs(..., as_future = True).  The result is a SequenceResult or an
+    StgRunResult, which reads the data of the run lazily.
+
+    Callbacks added with add_done_callback run on the poller thread, which
+    is shared by all the futures.  They should not block, and should not use
+    the data socket while another thread may be using it.
+    A RunFuture cannot be cancelled.  Terminate the hardware to stop a run.
+
+    Parameters
+    ----------
+    probe : callable
+        Called on the poller thread.  Returns a true value once the run is done.
+    make_result : callable
+        Called with the value returned by probe to build the result.
+    expected_time : float
+        Time (s) from now before which the run cannot complete.
+    policy : WaitPolicy
+        Schedule of the polls.
+    """
+
+    def __init__(self, probe, make_result, expected_time = 0.0, policy = None):
+        super().__init__()
+        self.set_running_or_notify_cancel()
+        self.__probe = probe
+        self.__make_result = make_result
+        self.__delays = (policy or WaitPolicy()).delays(float("inf"), expected_time)
+        _poller.submit(self, next(self.__delays))
+
+    def _poll(self):
+        """Poll the hardware once.  Return the delay to the next poll, or None if done."""
+        try:
+            res = self.__probe()
+            if res:
+                self.set_result(self.__make_result(res))
+                return None
+        except Exception as e:
+            self.set_exception(e)
+            return None
+        return next(self.__delays)
+
+
+CaptureHealth = namedtuple("CaptureHealth", ["step_skipped", "fifo_overflowed", "accum_overranged"])
+CaptureHealth.__doc__ = """Health flags of a capture step (True means the problem occurred)"""
+
+
+class _RunResult(object):
+
+    def __init__(self, ctrl, run_id):
+        self.__ctrl = ctrl
+        self.__run_id = run_id
+        self.__cache = {}
+
+    @property
+    def is_current(self):
+        """False once the next run has been started.  The data of this run are lost then."""
+        return self.__ctrl._run_id == self.__run_id
+
+    def _cached(self, key, read):
+        if key not in self.__cache:
+            if not self.is_current:
+                raise ag.InvalidOperationError(
+                    "The data of this run have been overwritten by a later run.")
+            self.__cache[key] = read()
+        return self.__cache[key]
+
+
+class SequenceResult(_RunResult):
+    """Result of a wave sequence started with start_wave_sequence(as_future = True).
+
+    Capture data, spectra and health flags are read from the board when
+    they are first asked for and then cached.  Read them before the next
+    start_wave_sequence, which overwrites them.
+    """
+
+    def __init__(self, awg_sa_cmd, run_id, awg_to_status):
+        super().__init__(awg_sa_cmd, run_id)
+        self.__awg_sa_cmd = awg_sa_cmd
+        self.__awg_to_status = dict(awg_to_status)
+
+    def __repr__(self):
+        return "<SequenceResult {}>".format(
+            {int(awg_id) : status.name for awg_id, status in self.__awg_to_status.items()})
+
+    @property
+    def awg_to_status(self):
+        """{AwgId -> WAVE_SEQUENCE_COMPLETE or WAVE_SEQUENCE_ERROR}"""
+        return dict(self.__awg_to_status)
+
+    @property
+    def failed_awgs(self):
+        """AWGs which reported WAVE_SEQUENCE_ERROR"""
+        return [awg_id for awg_id, status in self.__awg_to_status.items()
+                if status == ag.AwgSaCmdResult.WAVE_SEQUENCE_ERROR]
+
+    def capture_data(self, awg_id, step_id):
+        """See AwgSaCommand.read_capture_data."""
+        return self._cached(
+            ("capture_data", awg_id, step_id),
+            lambda: self.__awg_sa_cmd.read_capture_data(awg_id, step_id))
+
+    def spectrum(self, awg_id, step_id, start_sample_idx, num_frames, *, is_iq_data = False):
+        """See AwgSaCommand.get_spectrum."""
+        return self._cached(
+            ("spectrum", awg_id, step_id, start_sample_idx, num_frames, is_iq_data),
+            lambda: self.__awg_sa_cmd.get_spectrum(
+                awg_id, step_id, start_sample_idx, num_frames, is_iq_data = is_iq_data))
+
+    def health(self, awg_id, step_id):
+        """Return the CaptureHealth of a capture step.  See AwgSaCommand.get_capture_health."""
+        return self._cached(
+            ("health", awg_id, step_id),
+            lambda: self.__awg_sa_cmd.get_capture_health([(awg_id, step_id)])[(awg_id, step_id)])
+
+
+class StgRunResult(_RunResult):
+    """Result of a run started with start_stgs(..., as_future = True).
+
+    The error flags are read from the board when they are first asked for
+    and then cached.
+    """
+
+    def __init__(self, stg_ctrl, run_id, stg_id_list):
+        super().__init__(stg_ctrl, run_id)
+        self.__stg_ctrl = stg_ctrl
+        self.__stg_id_list = list(stg_id_list)
+
+    def __repr__(self):
+        return "<StgRunResult {}>".format([int(stg_id) for stg_id in self.__stg_id_list])
+
+    @property
+    def stg_id_list(self):
+        return list(self.__stg_id_list)
+
+    def errors(self):
+        """See StimGenCtrl.check_stg_err."""
+        return self._cached(
+            "errors", lambda: self.__stg_ctrl.check_stg_err(*self.__stg_id_list))
+
+    def dac_interrupts(self):
+        """See StimGenCtrl.check_dac_interrupt."""
+        return self._cached(
+            "dac_interrupts", lambda: self.__stg_ctrl.check_dac_interrupt(*self.__stg_id_list))
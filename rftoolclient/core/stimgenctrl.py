@@ -3,7 +3,9 @@ import rftoolclient as rftc
 import rftoolclient.stimgen as sg
 from functools import reduce
 from rftoolclient.stimgen.memorymap import StgMasterCtrlRegs, StgCtrlRegs, WaveParamRegs
-from rftoolclient.stimgen.stghwparam import WAVE_RAM_WORD_SIZE, WAVE_RAM_SIZE
+from rftoolclient.stimgen.stghwparam import WAVE_RAM_WORD_SIZE, WAVE_RAM_SIZE, STG_SAMPLING_RATE
+from .waitpolicy import WaitPolicy, CompletionTimes
+from .runfuture import RunFuture, StgRunResult
 
 class StimGenCtrl(object):
     """Stimulus Generator を制御するクラス"""
@@ -13,6 +15,11 @@ class StimGenCtrl(object):
         self.__common_cmd = common_cmd
         self.__reg_access = common_cmd.stim_reg_access
         self.__rft_cmd = rft_cmd
+        self.__wait_policy = WaitPolicy()
+        # STG の波形送信の最短の完了時刻
+        self.__completion_times = CompletionTimes()
+        # start_stgs を呼んだ回数
+        self.__run_id = 0
 
 
     def initialize(self, *stg_id_list):
@@ -27,6 +34,7 @@ class StimGenCtrl(object):
             rftc.log_error(e, self.__logger)
             raise
 
+        self.__reg_access.invalidate_shadow_regs()
         self.__deselect_ctrl_target(*stg_id_list)
         for stg_id in stg_id_list:
             addr = StgCtrlRegs.Addr.stg(stg_id) + StgCtrlRegs.Offset.CTRL
@@ -59,7 +67,10 @@ class StimGenCtrl(object):
             self.__check_stimulus(stg_to_stim.values())
             
             addr = 0
+            self.__completion_times.clear()
             for stg_id, stimulus in stg_to_stim.items():
+                self.__completion_times.set_duration(
+                    stg_id, stimulus.num_all_samples / STG_SAMPLING_RATE)
                 self.__set_wave_seq_params(stg_id, stimulus)
                 for chunk_no, chunk in enumerate(stimulus.chunk_list):
                     sample_data = chunk.wave_data.serialize()
@@ -72,11 +83,17 @@ class StimGenCtrl(object):
             raise
 
 
-    def start_stgs(self, *stg_id_list):
+    def start_stgs(self, *stg_id_list, as_future = False):
         """引数で指定した Stimulus Generator の波形送信を開始する.
 
         Args:
             *stg_id_list (list of STG): 波形送信を開始する STG の ID
+            as_future (bool):
+                | True の場合, 全ての STG の波形送信が終了したときに完了する RunFuture を返す.
+                | RunFuture の結果は StgRunResult で, エラーは読み出したときに取得される.
+
+        Returns:
+            RunFuture or None: as_future が True の場合 RunFuture. False の場合 None.
         """
         try:
             self.__validate_stg_id(*stg_id_list)
@@ -84,17 +101,35 @@ class StimGenCtrl(object):
             rftc.log_error(e, self.__logger)
             raise
 
-        self.__select_ctrl_target(*stg_id_list)
+        transaction = self.__reg_access.transaction()
+        self.__add_ctrl_target_sel(transaction, 1, *stg_id_list)
         addr = StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.CTRL
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_PREPARE, 1, 0)
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_PREPARE, 1, 1)
-        self.__wait_for_stgs_ready(5, *stg_id_list)
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_PREPARE, 1, 0)
-
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_START, 1, 0)
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_START, 1, 1)
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_START, 1, 0)        
-        self.__deselect_ctrl_target(*stg_id_list)
+        transaction.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_PREPARE, 1, 0)
+        transaction.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_PREPARE, 1, 1)
+        mask = self.__stg_mask(*stg_id_list)
+        transaction.wait_until_masked(
+            StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.READY_STATUS, mask, mask,
+            5, sg.StgTimeoutError('STG ready timed out'))
+        transaction.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_PREPARE, 1, 0)
+        transaction.pulse(addr, StgMasterCtrlRegs.Bit.CTRL_START)
+        self.__add_ctrl_target_sel(transaction, 0, *stg_id_list)
+        self.__execute(transaction)
+        self.__run_id += 1
+        self.__completion_times.started(*stg_id_list)
+        if not as_future:
+            return None
+
+        run_id = self.__run_id
+        return RunFuture(
+            lambda: self.__all_stgs_stopped(*stg_id_list),
+            lambda _: StgRunResult(self, run_id, stg_id_list),
+            self._time_to_completion(*stg_id_list),
+            self.__wait_policy)
+
+
+    @property
+    def _run_id(self):
+        return self.__run_id
 
 
     def terminate_stgs(self, *stg_id_list):
@@ -109,11 +144,19 @@ class StimGenCtrl(object):
             rftc.log_error(e, self.__logger)
             raise
 
+        transaction = self.__reg_access.transaction()
+        for stg_id in stg_id_list:
+            addr = StgCtrlRegs.Addr.stg(stg_id) + StgCtrlRegs.Offset.CTRL
+            transaction.write_bits(addr, StgCtrlRegs.Bit.CTRL_TERMINATE, 1, 1)
+        transaction.wait_until_masked(
+            StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.BUSY_STATUS,
+            self.__stg_mask(*stg_id_list), 0,
+            5, sg.StgTimeoutError('STG idle timed out'))
         for stg_id in stg_id_list:
             addr = StgCtrlRegs.Addr.stg(stg_id) + StgCtrlRegs.Offset.CTRL
-            self.__reg_access.write_bits(addr, StgCtrlRegs.Bit.CTRL_TERMINATE, 1, 1)
-            self.__wait_for_stgs_idle(5, stg_id)
-            self.__reg_access.write_bits(addr, StgCtrlRegs.Bit.CTRL_TERMINATE, 1, 0)
+            transaction.write_bits(addr, StgCtrlRegs.Bit.CTRL_TERMINATE, 1, 0)
+        self.__execute(transaction)
+        self.__completion_times.stopped(*stg_id_list)
 
 
     def clear_stg_stop_flags(self, *stg_id_list):
@@ -128,12 +171,7 @@ class StimGenCtrl(object):
             rftc.log_error(e, self.__logger)
             raise
     
-        self.__select_ctrl_target(*stg_id_list)
-        addr = StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.CTRL
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_DONE_CLR, 1, 0)
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_DONE_CLR, 1, 1)
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_DONE_CLR, 1, 0)
-        self.__deselect_ctrl_target(*stg_id_list)
+        self.__pulse_ctrl_bit(StgMasterCtrlRegs.Bit.CTRL_DONE_CLR, *stg_id_list)
 
 
     def pause_stgs(self, *stg_id_list):
@@ -148,12 +186,7 @@ class StimGenCtrl(object):
             rftc.log_error(e, self.__logger)
             raise
     
-        self.__select_ctrl_target(*stg_id_list)
-        addr = StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.CTRL
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_PAUSE, 1, 0)
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_PAUSE, 1, 1)
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_PAUSE, 1, 0)
-        self.__deselect_ctrl_target(*stg_id_list)
+        self.__pulse_ctrl_bit(StgMasterCtrlRegs.Bit.CTRL_PAUSE, *stg_id_list)
 
 
     def resume_stgs(self, *stg_id_list):
@@ -168,12 +201,7 @@ class StimGenCtrl(object):
             rftc.log_error(e, self.__logger)
             raise
     
-        self.__select_ctrl_target(*stg_id_list)
-        addr = StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.CTRL
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_RESUME, 1, 0)
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_RESUME, 1, 1)
-        self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_RESUME, 1, 0)
-        self.__deselect_ctrl_target(*stg_id_list)
+        self.__pulse_ctrl_bit(StgMasterCtrlRegs.Bit.CTRL_RESUME, *stg_id_list)
 
 
     def wait_for_stgs_to_stop(self, timeout, *stg_id_list):
@@ -193,24 +221,39 @@ class StimGenCtrl(object):
             rftc.log_error(e, self.__logger)
             raise
                 
-        start = time.time()
-        while True:
-            all_stopped = True
-            for stg_id in stg_id_list:
-                addr = StgCtrlRegs.Addr.stg(stg_id) + StgCtrlRegs.Offset.STATUS
-                val = self.__reg_access.read_bits(addr, StgCtrlRegs.Bit.STATUS_DONE, 1)
-                if val == 0:
-                    all_stopped = False
-                    break
-            if all_stopped:
-                return
-
-            elapsed_time = time.time() - start
-            if elapsed_time > timeout:
-                err = sg.StgTimeoutError('STG stop timeout')
-                rftc.log_error(err, self.__logger)
-                raise err
-            time.sleep(0.01)
+        # 波形の長さから求めた完了時刻の直前まで待ってから, 間隔を広げながら完了を確認する
+        if not self.__wait_policy.wait(
+            lambda: self.__all_stgs_stopped(*stg_id_list),
+            timeout, self._time_to_completion(*stg_id_list)):
+            err = sg.StgTimeoutError('STG stop timeout')
+            rftc.log_error(err, self.__logger)
+            raise err
+
+
+    def _time_to_completion(self, *stg_id_list):
+        """引数で指定した全ての Stimulus Generator の波形送信が完了し得る最短の時刻までの時間 (単位: 秒) を返す.
+
+        分からない場合は 0 を返す.
+        """
+        return self.__completion_times.time_to_completion(*stg_id_list)
+
+
+    def are_stgs_stopped(self, *stg_id_list):
+        """引数で指定した全ての Stimulus Generator の波形の送信が終了しているかどうかを調べる
+
+        Args:
+            *stg_id_list (list of STG): 波形の送信が終了しているか調べる STG の ID
+
+        Returns:
+            bool: 全ての STG の波形の送信が終了している場合 True
+        """
+        try:
+            self.__validate_stg_id(*stg_id_list)
+        except Exception as e:
+            rftc.log_error(e, self.__logger)
+            raise
+
+        return self.__all_stgs_stopped(*stg_id_list)
 
 
     def check_stg_err(self, *stg_id_list):
@@ -233,15 +276,16 @@ class StimGenCtrl(object):
             rftc.log_error(e, self.__logger)
             raise
 
+        # READ_ERR と SAMPLE_SHORTAGE_ERR は隣接しているので 1 回で読む
+        read_err, sample_shortage_err = self.__reg_access.read_multi(
+            StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.READ_ERR, 2)
         stg_to_errs = {}
         for stg_id in stg_id_list:
             err_list = []
-            addr = StgCtrlRegs.Addr.stg(stg_id) + StgCtrlRegs.Offset.ERR
-            err = self.__reg_access.read_bits(addr, StgCtrlRegs.Bit.ERR_READ, 1)
-            if err == 1:
+            bit_pos = StgMasterCtrlRegs.Bit.stg(stg_id)
+            if (read_err >> bit_pos) & 1:
                 err_list.append(sg.StgErr.MEM_RD)
-            err = self.__reg_access.read_bits(addr, StgCtrlRegs.Bit.ERR_SAMPLE_SHORTAGE, 1)
-            if err == 1:
+            if (sample_shortage_err >> bit_pos) & 1:
                 err_list.append(sg.StgErr.SAMPLE_SHORTAGE)
 
             if err_list:
@@ -507,6 +551,30 @@ class StimGenCtrl(object):
         self.__reg_access.write(addr, reg_val)
 
 
+    def __add_ctrl_target_sel(self, transaction, val, *stg_id_list):
+        """一括制御の対象の選択 (val = 1) / 選択解除 (val = 0) をトランザクションに追加する"""
+        addr = StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.CTRL_TARGET_SEL
+        for stg_id in stg_id_list:
+            transaction.write_bits(addr, StgMasterCtrlRegs.Bit.stg(stg_id), 1, val)
+
+
+    def __pulse_ctrl_bit(self, bit_pos, *stg_id_list):
+        """一括制御レジスタの特定のビットを 0 -> 1 -> 0 と変化させる"""
+        transaction = self.__reg_access.transaction()
+        self.__add_ctrl_target_sel(transaction, 1, *stg_id_list)
+        transaction.pulse(StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.CTRL, bit_pos)
+        self.__add_ctrl_target_sel(transaction, 0, *stg_id_list)
+        self.__execute(transaction)
+
+
+    def __execute(self, transaction):
+        try:
+            transaction.execute()
+        except Exception as e:
+            rftc.log_error(e, self.__logger)
+            raise
+
+
     def __reset_stgs(self, *stg_id_list):
         self.__select_ctrl_target(*stg_id_list)
         addr = StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.CTRL
@@ -514,49 +582,23 @@ class StimGenCtrl(object):
         time.sleep(10e-6)
         self.__reg_access.write_bits(addr, StgMasterCtrlRegs.Bit.CTRL_RESET, 1, 0)
         time.sleep(10e-6)
+        self.__reg_access.invalidate_shadow_regs()
         self.__deselect_ctrl_target(*stg_id_list)
 
 
-    def __wait_for_stgs_ready(self, timeout, *stg_id_list):
-        start = time.time()
-        while True:
-            all_ready = True
-            for stg_id in stg_id_list:
-                addr = StgCtrlRegs.Addr.stg(stg_id) + StgCtrlRegs.Offset.STATUS
-                val = self.__reg_access.read_bits(addr, StgCtrlRegs.Bit.STATUS_READY, 1)
-                if val == 0:
-                    all_ready = False
-                    break
-            if all_ready:
-                return
-
-            elapsed_time = time.time() - start
-            if elapsed_time > timeout:
-                err = sg.StgTimeoutError('STG ready timed out')
-                rftc.log_error(err, self.__logger)
-                raise err
-            time.sleep(0.01)
-
-
-    def __wait_for_stgs_idle(self, timeout, *stg_id_list):
-        start = time.time()
-        while True:
-            all_idle = True
-            for stg_id in stg_id_list:
-                addr = StgCtrlRegs.Addr.stg(stg_id) + StgCtrlRegs.Offset.STATUS
-                val = self.__reg_access.read_bits(addr, StgCtrlRegs.Bit.STATUS_BUSY, 1)
-                if val == 1:
-                    all_idle = False
-                    break
-            if all_idle:
-                return
-
-            elapsed_time = time.time() - start
-            if elapsed_time > timeout:
-                err = sg.StgTimeoutError('STG idle timed out')
-                rftc.log_error(err, self.__logger)
-                raise err
-            time.sleep(0.01)
+    def __all_stgs_stopped(self, *stg_id_list):
+        addr = StgMasterCtrlRegs.ADDR + StgMasterCtrlRegs.Offset.DONE_STATUS
+        vals = self.__reg_access.read_bits_multi([
+            (addr, StgMasterCtrlRegs.Bit.stg(stg_id), 1) for stg_id in stg_id_list])
+        return all(vals)
+
+
+    def __stg_mask(self, *stg_id_list):
+        """一括ステータスレジスタの中で, 引数の STG に対応するビットを 1 にしたマスクを返す"""
+        mask = 0
+        for stg_id in stg_id_list:
+            mask |= 1 << StgMasterCtrlRegs.Bit.stg(stg_id)
+        return mask
 
 
     def __set_wave_seq_params(self, stg_id, stimulus):
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import hashlib
+import json
+import struct
+import threading
+import time
+import zlib
+from .rftinterface import RftoolInterface
+from .rfterr import RftoolInterfaceError, RftoolReplayError
+
+"""
+trafficrec.py
+    - Record / replay of the traffic between RftoolClient and a board
+
+A recording holds every exchange on the control and data sockets in order.
+The bytes the board sent are stored (zlib compressed), so that they can be
+played back.  The bytes the client sent are stored as their length, a hash
+and a short prefix for diagnostics, so that a replay can check that the
+client still sends the same commands.
+
+File layout
+    MAGIC
+    header length (uint32 LE) + header (JSON)
+    records...
+        channel (uint8), kind (uint8), time (float64), length (uint64)
+        SENT     : digest (16 bytes), prefix length (uint8), prefix
+        RECEIVED : stored length (uint64), zlib compressed bytes
+"""
+
+MAGIC = b"RFTREC\x00\x01"
+CTRL = 0
+DATA = 1
+SENT = 0
+RECEIVED = 1
+
+_RECORD = struct.Struct("<BBdQ")
+_STORED_LEN = struct.Struct("<Q")
+_DIGEST_SIZE = 16
+# 診断用に保存する, クライアントが送ったデータの先頭部分の最大長
+_PREFIX_SIZE = 64
+
+
+def _digest(data = b""):
+    return hashlib.blake2b(data, digest_size = _DIGEST_SIZE)
+
+
+class TrafficRecorder(object):
+    """Writes the traffic of a client to a file.
+
+    Parameters
+    ----------
+    path : str
+        File to write to.
+    meta : dict
+        Information stored in the header (address, ports, ...).
+    compress_level : int
+        zlib compression level of the received bytes.
+    """
+
+    def __init__(self, path, meta = None, compress_level = 1):
+        self.__file = open(path, "wb")
+        self.__lock = threading.Lock()
+        self.__compress_level = compress_level
+        self.__start = time.perf_counter()
+        header = dict(meta or {})
+        header.setdefault("created", time.time())
+        header = json.dumps(header).encode()
+        self.__file.write(MAGIC + struct.pack("<I", len(header)) + header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excep_type, excep_val, trace):
+        self.close()
+
+    @property
+    def closed(self):
+        return self.__file.closed
+
+    def sent(self, channel, data):
+        view = memoryview(data).cast("B")
+        prefix = bytes(view[:_PREFIX_SIZE])
+        record = b"".join([
+            _RECORD.pack(channel, SENT, time.perf_counter() - self.__start, view.nbytes),
+            _digest(view).digest(),
+            bytes([len(prefix)]), prefix])
+        with self.__lock:
+            self.__file.write(record)
+
+    def received(self, channel, data):
+        view = memoryview(data).cast("B")
+        stored = zlib.compress(view, self.__compress_level)
+        header = _RECORD.pack(channel, RECEIVED, time.perf_counter() - self.__start, view.nbytes)
+        with self.__lock:
+            self.__file.write(header + _STORED_LEN.pack(len(stored)))
+            self.__file.write(stored)
+
+    def close(self):
+        with self.__lock:
+            if not self.__file.closed:
+                self.__file.close()
+
+
+class _Event(object):
+    __slots__ = ("kind", "time", "length", "digest", "prefix", "offset", "stored_length")
+
+    def __init__(self, kind, time, length):
+        self.kind = kind
+        self.time = time
+        self.length = length
+        self.digest = None
+        self.prefix = b""
+        self.offset = 0
+        self.stored_length = 0
+
+
+class TrafficRecording(object):
+    """A recording opened for replay.
+
+    Parameters
+    ----------
+    path : str
+        File written by TrafficRecorder.
+    realtime : bool
+        False -> Play the board's bytes back as fast as the client reads them.
+        True  -> Hold each reply of the board until the time it was received
+                 in the recording, relative to the start of the replay.
+    """
+
+    def __init__(self, path, realtime = False):
+        self.__file = open(path, "rb")
+        self.__lock = threading.Lock()
+        self.realtime = realtime
+        self.__start = None
+        self.header, self.__events = self.__load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excep_type, excep_val, trace):
+        self.close()
+
+    def events(self, channel):
+        return self.__events[channel]
+
+    def payload(self, event):
+        """Return the bytes the board sent in a RECEIVED event."""
+        with self.__lock:
+            self.__file.seek(event.offset)
+            stored = self.__file.read(event.stored_length)
+        data = zlib.decompress(stored)
+        if len(data) != event.length:
+            raise RftoolInterfaceError("corrupted traffic recording")
+        return data
+
+    def wait_for(self, event):
+        if not self.realtime:
+            return
+        with self.__lock:
+            if self.__start is None:
+                self.__start = time.perf_counter() - event.time
+            start = self.__start
+        delay = start + event.time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def close(self):
+        self.__file.close()
+
+    def __load(self):
+        f = self.__file
+        if f.read(len(MAGIC)) != MAGIC:
+            raise RftoolInterfaceError("{} is not a traffic recording".format(f.name))
+        (header_len,) = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(header_len).decode())
+
+        events = {CTRL : [], DATA : []}
+        while True:
+            buf = f.read(_RECORD.size)
+            if not buf:
+                break
+            if len(buf) < _RECORD.size:
+                raise RftoolInterfaceError("truncated traffic recording")
+            channel, kind, timestamp, length = _RECORD.unpack(buf)
+            event = _Event(kind, timestamp, length)
+            if kind == SENT:
+                event.digest = f.read(_DIGEST_SIZE)
+                event.prefix = f.read(f.read(1)[0])
+            else:
+                (event.stored_length,) = _STORED_LEN.unpack(f.read(_STORED_LEN.size))
+                event.offset = f.tell()
+                f.seek(event.stored_length, 1)
+            events[channel].append(event)
+        return header, events
+
+
+class RecordingInterface(RftoolInterface):
+    """RftoolInterface which writes its socket traffic to a TrafficRecorder"""
+
+    def __init__(self, recorder, channel, logger=None):
+        super().__init__(logger)
+        self.__recorder = recorder
+        self.__channel = channel
+
+    def _sock_sendall(self, data):
+        super()._sock_sendall(data)
+        self.__recorder.sent(self.__channel, data)
+
+    def _sock_recv(self, bufsize):
+        data = super()._sock_recv(bufsize)
+        if data:
+            self.__recorder.received(self.__channel, data)
+        return data
+
+    def _sock_recv_into(self, buf, nbytes):
+        nbytes = super()._sock_recv_into(buf, nbytes)
+        if nbytes:
+            with memoryview(buf) as view:
+                self.__recorder.received(self.__channel, view[:nbytes])
+        return nbytes
+
+
+class ReplayInterface(RftoolInterface):
+    """RftoolInterface which plays the board's side of a recording back.
+
+    The bytes the client sends are checked against the recording, and
+    RftoolReplayError is raised as soon as the client diverges from it.
+    """
+
+    def __init__(self, recording, channel, logger=None):
+        super().__init__(logger)
+        self.__recording = recording
+        self.__channel = channel
+        self.__events = recording.events(channel)
+        self.__next = 0
+        self.__pending = memoryview(b"")
+        self.__send_event = None
+        self.__send_hash = None
+        self.__send_left = 0
+        self.__send_prefix = bytearray()
+
+    @property
+    def finished(self):
+        """True if the whole recording of this channel has been played back."""
+        return (self.__next == len(self.__events) and
+                self.__send_left == 0 and len(self.__pending) == 0)
+
+    def _sock_sendall(self, data):
+        view = memoryview(data).cast("B")
+        while view.nbytes > 0:
+            if self.__send_left == 0:
+                if len(self.__pending) > 0:
+                    self.__diverged(
+                        "the client sent {} before reading the whole reply".format(
+                            bytes(view[:_PREFIX_SIZE])))
+                event = self.__next_event()
+                if event is None or event.kind != SENT:
+                    self.__diverged("the client sent {} where the recording has no data to send"
+                                    .format(bytes(view[:_PREFIX_SIZE])))
+                self.__send_event = event
+                self.__send_hash = _digest()
+                self.__send_left = event.length
+                self.__send_prefix = bytearray()
+
+            nbytes = min(self.__send_left, view.nbytes)
+            self.__send_hash.update(view[:nbytes])
+            if len(self.__send_prefix) < _PREFIX_SIZE:
+                self.__send_prefix += view[:_PREFIX_SIZE - len(self.__send_prefix)]
+            view = view[nbytes:]
+            self.__send_left -= nbytes
+            if self.__send_left == 0 and self.__send_hash.digest() != self.__send_event.digest:
+                self.__diverged("the client sent {} where the recording has {}".format(
+                    bytes(self.__send_prefix), self.__send_event.prefix))
+
+    def _sock_recv(self, bufsize):
+        return bytes(self.__take(bufsize))
+
+    def _sock_recv_into(self, buf, nbytes):
+        data = self.__take(nbytes)
+        buf[:len(data)] = data
+        return len(data)
+
+    def __take(self, nbytes):
+        if len(self.__pending) == 0:
+            if self.__send_left:
+                self.__diverged(
+                    "the client sent {} and waits for a reply where the recording has {}".format(
+                        bytes(self.__send_prefix), self.__send_event.prefix))
+            event = self.__next_event()
+            if event is None:
+                # the board closed the connection
+                return b""
+            if event.kind != RECEIVED:
+                self.__diverged("the client waits for a reply where it should send {}".format(
+                    event.prefix))
+            self.__recording.wait_for(event)
+            self.__pending = memoryview(self.__recording.payload(event))
+
+        data = self.__pending[:nbytes]
+        self.__pending = self.__pending[nbytes:]
+        return data
+
+    def __next_event(self):
+        if self.__next == len(self.__events):
+            return None
+        event = self.__events[self.__next]
+        self.__next += 1
+        return event
+
+    def __diverged(self, msg):
+        # the rest of the recording cannot be played back any more
+        self.err_connection = True
+        channel = "ctrl" if self.__channel == CTRL else "data"
+        raise RftoolReplayError(
+            "replay diverged on the {} channel at record {}: {}".format(channel, self.__next, msg))
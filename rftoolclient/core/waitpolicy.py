@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import contextvars
+import time
+
+"""
+waitpolicy.py
+    - Poll scheduling of the wait methods
+"""
+
+# AsyncRftoolClient replaces time.sleep in the greenlets which run its
+# commands, so that the waits of the commands do not block the event loop.
+_sleep = contextvars.ContextVar("_sleep", default = time.sleep)
+
+
+def sleep(seconds):
+    """time.sleep, or a sleep on the event loop while AsyncRftoolClient runs a command"""
+    _sleep.get()(seconds)
+
+
+class WaitPolicy(object):
+    """Decides when a wait method polls the board.
+
+    A wait has two phases.
+
+    1. If the caller knows the earliest time the operation can complete
+       (e.g. the duration of the programmed wave sequence), it sleeps until
+       just before that time without polling.
+    2. It then polls, starting at min_interval and multiplying the interval
+       by backoff after each poll, up to max_interval.
+
+    Short operations are noticed within about min_interval of completion,
+    and long ones cost a handful of commands instead of one per 10 ms.
+
+    Parameters
+    ----------
+    min_interval : float
+        Interval (s) between the first and second polls.
+    max_interval : float
+        Upper bound (s) of the interval between polls.
+    backoff : float
+        Factor by which the interval grows after each poll.
+    lead_time : float
+        How long (s) before the expected completion the first poll is made.
+    """
+
+    def __init__(self, min_interval = 1e-3, max_interval = 0.05, backoff = 2.0, lead_time = 1e-3):
+        if not (0 < min_interval <= max_interval):
+            raise ValueError('Invalid poll intervals {}, {}'.format(min_interval, max_interval))
+        if backoff < 1:
+            raise ValueError('Invalid backoff {}'.format(backoff))
+        if lead_time < 0:
+            raise ValueError('Invalid lead time {}'.format(lead_time))
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.lead_time = lead_time
+
+    def __repr__(self):
+        return "WaitPolicy(min_interval={}, max_interval={}, backoff={}, lead_time={})".format(
+            self.min_interval, self.max_interval, self.backoff, self.lead_time)
+
+    def delays(self, timeout, expected_time = 0.0):
+        """Generate the time (s) to sleep before each poll.
+
+        The generator ends when the timeout has passed, after a last poll
+        made at the timeout.
+
+        Parameters
+        ----------
+        timeout : int or float
+            Timeout (s) of the wait.
+        expected_time : float
+            Time (s) from now before which the operation cannot complete.
+        """
+        deadline = time.perf_counter() + timeout
+        yield min(max(expected_time - self.lead_time, 0.0), timeout)
+        interval = self.min_interval
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return
+            yield min(interval, remaining)
+            interval = min(interval * self.backoff, self.max_interval)
+
+    def wait(self, probe, timeout, expected_time = 0.0):
+        """Call probe until it returns a true value.
+
+        Returns
+        -------
+        result : object
+            The value returned by probe, or None if the wait timed out.
+        """
+        for delay in self.delays(timeout, expected_time):
+            if delay > 0:
+                sleep(delay)
+            res = probe()
+            if res:
+                return res
+        return None
+
+
+class CompletionTimes(object):
+    """Earliest completion times of the units (AWG, STG, ...) of a board.
+
+    The duration of a unit is the minimum run time (s) of the content
+    programmed to it, or None if the unit does not stop by itself.  Triggers
+    and pauses can only delay completion, so a wait may sleep until the
+    earliest completion time before it starts polling.
+    """
+
+    def __init__(self):
+        self.__durations = {}
+        self.__ends = {}
+
+    def set_duration(self, unit, duration):
+        """Record the minimum run time (s) of the content programmed to unit."""
+        self.__durations[unit] = duration
+
+    def started(self, *units):
+        """Record that units have started from the beginning of their content."""
+        now = time.perf_counter()
+        for unit in units:
+            duration = self.__durations.get(unit)
+            if duration is None:
+                self.__ends.pop(unit, None)
+            else:
+                self.__ends[unit] = now + duration
+
+    def stopped(self, *units):
+        """Forget the completion times of units which have been stopped."""
+        for unit in units:
+            self.__ends.pop(unit, None)
+
+    def clear(self):
+        self.__durations.clear()
+        self.__ends.clear()
+
+    def time_to_completion(self, *units):
+        """Time (s) from now before which not all of units can complete.
+
+        0 if it is unknown.
+        """
+        ends = [self.__ends[unit] for unit in units if unit in self.__ends]
+        if not ends:
+            return 0.0
+        return max(max(ends) - time.perf_counter(), 0.0)
@@ -5,6 +5,8 @@ STG_WAVE_SAMPLE_SIZE = 2
 STG_WORD_SIZE = 32
 # STG から 1 サイクルで出力されるデータのサンプル数
 NUM_SAMPLES_IN_STG_WORD = STG_WORD_SIZE // STG_WAVE_SAMPLE_SIZE
+# STG のサンプリングレート (単位 : サンプル/秒)
+STG_SAMPLING_RATE = 614.4e6
 # 波形チャンクの波形パートを構成可能なサンプル数の最小単位
 MIN_UNIT_SAMPLES_FOR_WAVE_PART = 1024
 
@@ -1,5 +1,5 @@
 import copy
-import struct
+import numpy as np
 import rftoolclient as rftc
 from .stghwparam import (
     STG_WAVE_SAMPLE_SIZE,
@@ -516,10 +516,9 @@ class WaveData(object):
 
     def serialize(self):
         sample_mask = (1 << (self.__wave_sample_size * 8)) - 1
-        payload = bytearray()
-        for sample in self.__samples:
-            sample = sample & sample_mask
-            payload += struct.pack('<H', sample)
+        payload = bytearray(len(self.__samples) * 2)
+        samples = np.asarray(self.__samples, dtype = np.int64) & sample_mask
+        np.frombuffer(payload, dtype = '<u2')[:] = samples
         return payload
 
     @classmethod